@@ -0,0 +1,487 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import sys, os, time, json
+import numpy as np
+from libtbx.phil import parse
+
+message = ''' Benchmark and regression suite of the consensus clustering on the data sets shipped with
+the repository: the unit cells of clustering/lysozyme100.txt and lysozyme1341.txt and the IOTA
+trials of orientation/composite_0_25trials_iota.pickle and exps_100trials_composite_0.pickle.
+Every data set is also scaled up to scale times its size with synthetic replicas of its models
+(jittered cell lengths and orientations, seeded). For each set the suite times NCDist_flatten,
+estimate_d_c, clustering_manager, the orientational Dij build and get_uc_consensus, and records
+the chosen centroids: d_c, the central unit cell of every uc cluster and the crystal models
+returned by get_uc_consensus. They are checked against benchmark_centroids.json, the centroids
+of the code before the clustering optimizations (commit 00f5175), or against reference=<file>.
+write_reference=<file> saves the centroids of this run. compare_reference_code=True also times
+the vectorized estimate_d_c and cluster_centers against the element by element code they
+replaced and checks they agree. compare_sparse_mode=True runs clustering_manager on the G6
+embedding of the lysozyme cells (sparse k-NN mode) next to the dense NCDist path and checks that
+rho, the cluster centers and the assignments agree. compare_close_pairs=True checks on the IOTA
+trial sets that the rotation index candidates of prune_close_models (close_pairs) include every
+pair the all pairs loop they replaced finds within min_angle.
+Usage: libtbx.python benchmark_clustering.py [scale=1,4] [reference=centroids.json]
+To write benchmark_centroids.json, copy this script into a checkout of the baseline commit and
+run it there with baseline_code=True write_reference=benchmark_centroids.json
+'''
+
+def reference_estimate_d_c(Dij):
+  ''' estimate_d_c before vectorization '''
+  from scitbx.array_family import flex
+  Dij_max=max(Dij.as_1d())
+  n_slots=(int(Dij_max)//10+1)*10
+  if n_slots == 10:
+    return 1.0
+  hist_data=flex.histogram(Dij.as_1d(), n_slots=n_slots)
+  y=hist_data.slots()
+  moving_avg_bin=[]
+  for i in range(0, n_slots, 10):
+    moving_avg_bin.append(flex.mean(flex.double(list(y[i:i+10]))))
+  min_avg = min(moving_avg_bin)*2.0
+  d_c=1.0
+  for i, avg in enumerate(moving_avg_bin):
+    if avg<=min_avg:
+      d_c= float(i*10.0)
+      break
+  return d_c
+
+def reference_cluster_centers(rho, delta, rho_order, strategy='default'):
+  ''' Cluster centers as picked by clustering_manager before vectorization, in cluster id order '''
+  from scitbx.array_family import flex
+  import numpy as np
+  NN = len(rho)
+  centers = []
+  pick_top_solution=False
+  rho_stdev = flex.mean_and_variance(rho.as_double()).unweighted_sample_standard_deviation()
+  delta_stdev = flex.mean_and_variance(delta).unweighted_sample_standard_deviation()
+  if rho_stdev !=0.0 and delta_stdev !=0:
+    rho_z=(rho.as_double()-flex.mean(rho.as_double()))/(rho_stdev)
+    delta_z=(delta-flex.mean(delta))/(delta_stdev)
+  else:
+    pick_top_solution=True
+    if rho_stdev == 0.0:
+      centroids = [flex.first_index(delta,flex.max(delta))]
+    elif delta_stdev == 0.0:
+      centroids = [flex.first_index(rho,flex.max(rho))]
+  significant_delta = []
+  significant_rho = []
+  debug_fix_clustering = True
+  strategy2 = strategy3 = False
+  if strategy=='one_cluster':
+    debug_fix_clustering=False
+    strategy2=True
+  if strategy=='strategy_3':
+    debug_fix_clustering=False
+    strategy3=True
+  if debug_fix_clustering:
+    if not pick_top_solution:
+      delta_z_cutoff = min(1.0, max(delta_z))
+      rho_z_cutoff = min(1.0, max(rho_z))
+      for ic in range(NN):
+        if delta_z[ic] >= delta_z_cutoff or delta_z[ic] <= -delta_z_cutoff:
+          significant_delta.append(ic)
+        if rho_z[ic] >= rho_z_cutoff or rho_z[ic] <= -rho_z_cutoff:
+          significant_rho.append(ic)
+      centroid_candidates=list(significant_delta)
+      candidate_delta_z=flex.double()
+      for ic in centroid_candidates:
+        if ic == rho_order[0]:
+          delta_z_of_rho_order_0=delta_z[ic]
+        candidate_delta_z.append(delta_z[ic])
+      i_sorted=flex.sort_permutation(candidate_delta_z, reverse=True)
+      centroids=[]
+      centroids.append(rho_order[0])
+      for i in range(0, len(i_sorted[:])):
+        if centroid_candidates[i_sorted[i]] == rho_order[0]:
+          continue
+        if delta_z_of_rho_order_0-candidate_delta_z[i_sorted[i]] > 1.0:
+          if i>1:
+            if -candidate_delta_z[i_sorted[i-1]]+candidate_delta_z[i_sorted[0]] > 1.0:
+              centroids.append(centroid_candidates[i_sorted[i]])
+          else:
+            centroids.append(centroid_candidates[i_sorted[i]])
+        else:
+          break
+    centers.extend(centroids)
+  elif strategy2:
+    product_list_of_ranks=[]
+    for ic in range(NN):
+      product_list_of_ranks.append(rho[ic]*delta[ic])
+    centers.append(np.argmax(product_list_of_ranks))
+  elif strategy3:
+    product_list_of_ranks=flex.double()
+    for ic in range(NN):
+      product_list_of_ranks.append(rho[ic]*delta[ic])
+    iid_sorted=flex.sort_permutation(product_list_of_ranks, reverse=True)
+    centers.append(iid_sorted[0])
+    stdev=np.std(product_list_of_ranks)
+    mean=np.mean(product_list_of_ranks)
+    for iid in iid_sorted[1:3]:
+      z_score=(product_list_of_ranks[iid]-mean)/stdev
+      if z_score > 3.0:
+        centers.append(iid)
+      else:
+        break
+  return [int(i) for i in centers]
+
+def reference_close_pairs(crystals, min_angle):
+  ''' Pairs (i_a, i_b) of prune_close_models within min_angle degrees, from the loop over all
+      pairs that close_pairs replaced '''
+  from dials.algorithms.indexing.compare_orientation_matrices import difference_rotation_matrix_axis_angle
+  from cctbx_orientation_ext import crystal_orientation
+  from dxtbx.model import Crystal
+  close_models_list = []
+  for i_a in range(0,len(crystals)-1):
+    for i_b in range(i_a+1,len(crystals)):
+      cryst_a = crystals[i_a]
+      cryst_b = crystals[i_b]
+      cryst_a_ori = crystal_orientation(cryst_a.get_A(), True)
+      cryst_b_ori = crystal_orientation(cryst_b.get_A(), True)
+      try:
+        best_similarity_transform = cryst_b_ori.best_similarity_transformation(
+          other = cryst_a_ori, fractional_length_tolerance = 20.00,
+          unimodular_generator_range=1)
+        cryst_b_ori_best=cryst_b_ori.change_basis(best_similarity_transform)
+      except Exception as e:
+        cryst_b_ori_best = cryst_b_ori
+      cryst_b_best=Crystal(cryst_b_ori_best.direct_matrix()[0:3], cryst_b_ori_best.direct_matrix()[3:6], cryst_b_ori_best.direct_matrix()[6:9], 'P 1 21 1')
+      R_ab, axis, angle, cb_op_ab = difference_rotation_matrix_axis_angle(cryst_a, cryst_b_best)
+      if abs(angle) < min_angle: # degrees
+        close_models_list.append((i_a, i_b))
+  return close_models_list
+
+benchmark_phil_scope = parse('''
+  dataset = *lysozyme100 *lysozyme1341 *composite_0_25trials_iota *exps_100trials_composite_0
+    .type = choice(multi=True)
+    .help = Data sets to run
+  scale = 1 4
+    .type = ints(value_min=1)
+    .help = Sizes of the synthetic data sets, in multiples of the original size
+  n_repeat = 3
+    .type = int(value_min=1)
+    .help = Every step is timed n_repeat times and the best time is reported
+  seed = 0
+    .type = int
+    .help = Seed of the synthetic replicas
+  cell_jitter = 0.001
+    .type = float(value_min=0)
+    .help = Relative standard deviation of the cell lengths of the replicas
+  angle_jitter_deg = 0.1
+    .type = float(value_min=0)
+    .help = Standard deviation of the rotation applied to the orientation of the replicas
+  n_orientations = 3
+    .type = int(value_min=1)
+    .help = Number of random lattice orientations given to the unit cells of the txt data sets
+  get_uc_consensus_max_models = 2000
+    .type = int
+    .help = get_uc_consensus and the orientational Dij are skipped above this many models
+  compare_reference_code = True
+    .type = bool
+    .help = Compare the vectorized estimate_d_c and cluster_centers with the code they replaced
+  compare_sparse_mode = True
+    .type = bool
+    .help = Compare the sparse k-NN density peaks on the G6 embedding with the dense NCDist path \
+            on the lysozyme data sets
+  compare_close_pairs = True
+    .type = bool
+    .help = Check that the rotation index candidates (close_pairs) of prune_close_models include \
+            all the close pairs of the all pairs loop, on the IOTA trial data sets
+  close_pairs_min_angle = 5.0
+    .type = float(value_min=0)
+    .help = min_angle of the close_pairs check, prune_close_models uses 5 degrees
+  reference = None
+    .type = path
+    .help = json file written by write_reference, the centroids have to be the same. \
+            By default benchmark_centroids.json next to the data sets
+  write_reference = None
+    .type = path
+    .help = Write the centroids of this run to a json file
+  baseline_code = False
+    .type = bool
+    .help = Only use what the code before the clustering optimizations provides, to write \
+            the reference centroids from a checkout of that code. Skips the orientational \
+            Dij timing and the reference code comparison
+''')
+
+def read_cells(file_name):
+  ''' crystal.symmetry of every line (a b c alpha beta gamma space_group) of file_name '''
+  from cctbx import crystal
+  symmetries = []
+  for line in open(file_name, "r"):
+    tokens = line.strip().split()
+    if len(tokens) < 7:
+      continue
+    unit_cell = tuple(float(x) for x in tokens[0:6])
+    symmetries.append(crystal.symmetry(unit_cell = unit_cell, space_group_symbol = tokens[6]))
+  return symmetries
+
+def random_rotation(rng, sigma_deg):
+  ''' Rotation about a random axis by a normally distributed angle, a scitbx.matrix.sqr '''
+  from scitbx.matrix import col
+  axis = rng.normal(size=3)
+  axis = col(tuple(axis/np.sqrt((axis*axis).sum())))
+  return axis.axis_and_angle_as_r3_rotation_matrix(rng.normal(0.0, sigma_deg), deg=True)
+
+def crystal_from_vectors(vectors, space_group_symbol):
+  from dxtbx.model import Crystal
+  return Crystal(vectors[0], vectors[1], vectors[2], space_group_symbol=space_group_symbol)
+
+def crystals_from_cells(symmetries, n_orientations, rng):
+  ''' Crystal models of the unit cells, each in one of n_orientations random orientations '''
+  from scitbx.matrix import sqr
+  orientations = [random_rotation(rng, 180.0) for i in range(n_orientations)]
+  crystals = []
+  for i, symmetry in enumerate(symmetries):
+    O = sqr(symmetry.unit_cell().orthogonalization_matrix())
+    U = orientations[i%n_orientations]
+    vectors = [(U*O.col(k)).elems for k in range(3)]
+    crystals.append(crystal_from_vectors(vectors, str(symmetry.space_group_info())))
+  return crystals
+
+def replica(crystal, params, rng):
+  ''' Copy of a crystal model with jittered cell lengths and orientation '''
+  from scitbx.matrix import col
+  R = random_rotation(rng, params.angle_jitter_deg)
+  vectors = [(R*col(v)*(1.0 + rng.normal(0.0, params.cell_jitter))).elems
+             for v in crystal.get_real_space_vectors()]
+  return crystal_from_vectors(vectors, str(crystal.get_space_group().info()))
+
+def scaled(crystals, scale, params):
+  ''' The crystals followed by scale-1 replicas of each of them, single crystal experiments '''
+  from dxtbx.model.experiment_list import ExperimentList, Experiment
+  rng = np.random.RandomState(params.seed)
+  models = list(crystals)
+  for k in range(scale-1):
+    models.extend([replica(crystal, params, rng) for crystal in crystals])
+  experiments_list = []
+  for crystal in models:
+    experiments = ExperimentList()
+    experiments.append(Experiment(crystal=crystal))
+    experiments_list.append(experiments)
+  return experiments_list
+
+def load_dataset(name, params):
+  ''' First crystal model of every trial of one of the shipped data sets '''
+  here = os.path.dirname(os.path.abspath(__file__))
+  if name.startswith('lysozyme'):
+    rng = np.random.RandomState(params.seed)
+    return crystals_from_cells(read_cells(os.path.join(here, name + '.txt')), params.n_orientations, rng)
+  from libtbx.easy_pickle import load
+  trials = load(os.path.join(here, '..', 'orientation', name + '.pickle'))
+  return [experiments.crystals()[0] for experiments in trials if len(experiments.crystals()) > 0]
+
+def ncdist_matrix(cells):
+  from scitbx.array_family import flex
+  from cctbx.uctbx.determine_unit_cell import NCDist_flatten
+  MM_double = flex.double()
+  for c in cells:
+    MM_double.extend(flex.double(c.mm))
+  return NCDist_flatten(MM_double)
+
+class quiet(object):
+  ''' Swallows the printout of the timed functions '''
+  def __enter__(self):
+    from six import StringIO
+    self.stdout = sys.stdout
+    sys.stdout = StringIO()
+  def __exit__(self, *args):
+    sys.stdout = self.stdout
+
+def best_time(function, n_repeat):
+  ''' (smallest wall time of n_repeat calls, result of the last call) '''
+  best = None
+  for i in range(n_repeat):
+    st = time.time()
+    with quiet():
+      result = function()
+    elapsed = time.time() - st
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, result
+
+def compare_reference_code(Dij, n_repeat):
+  ''' Time and compare the reference and vectorized estimate_d_c and cluster_centers on Dij.
+      Returns False if they disagree '''
+  from xfel.clustering import Rodriguez_Laio_clustering_2014 as RL
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.consensus_functions import estimate_d_c, cluster_centers
+  NN = Dij.focus()[0]
+  ok = True
+  t_ref, d_c_ref = best_time(lambda: reference_estimate_d_c(Dij), n_repeat)
+  t_new, d_c = best_time(lambda: estimate_d_c(Dij), n_repeat)
+  ok = ok and d_c == d_c_ref
+  print ('  estimate_d_c          reference %8.4f s vectorized %8.4f s speedup %6.1f d_c %s %s'%(
+    t_ref, t_new, t_ref/max(t_new, 1.e-9), d_c, 'OK' if d_c == d_c_ref else 'MISMATCH %s'%d_c_ref))
+  R = RL(distance_matrix = Dij, d_c = d_c)
+  rho = R.get_rho()
+  i_max = flex.max_index(rho)
+  rho_order = flex.sort_permutation(rho, reverse=True)
+  delta = R.get_delta(rho_order=rho_order, delta_i_max=flex.max(Dij.as_1d()[i_max*NN:(i_max+1)*NN]))
+  for strategy in ['default', 'one_cluster', 'strategy_3']:
+    t_ref, centers_ref = best_time(lambda: reference_cluster_centers(rho, delta, rho_order, strategy=strategy), n_repeat)
+    t_new, centers = best_time(lambda: cluster_centers(rho, delta, rho_order, strategy=strategy), n_repeat)
+    centers = [int(i) for i in centers]
+    ok = ok and centers == centers_ref
+    print ('  cluster_centers %-11s reference %8.4f s vectorized %8.4f s speedup %6.1f centers %s %s'%(
+      strategy, t_ref, t_new, t_ref/max(t_new, 1.e-9), centers, 'OK' if centers == centers_ref else 'MISMATCH %s'%centers_ref))
+  return ok
+
+def compare_close_pairs(crystals, min_angle, n_repeat):
+  ''' Time close_pairs (margin and lattice symmetry as in prune_close_models) against the all
+      pairs loop. Returns False if a pair the loop finds within min_angle is not a candidate '''
+  from exafel_project.ADSE13_25.orientation.rotation_index import close_pairs
+  t_ref, pairs_ref = best_time(lambda: reference_close_pairs(crystals, min_angle), n_repeat)
+  t_new, pairs = best_time(lambda: close_pairs(crystals, min_angle, margin=1.0, lattice_symmetry=True), n_repeat)
+  missing = sorted(set(pairs_ref) - set(pairs))
+  print ('  close_pairs           all pairs %8.4f s rotation index %8.4f s speedup %6.1f %d close pairs, %d candidates %s'%(
+    t_ref, t_new, t_ref/max(t_new, 1.e-9), len(pairs_ref), len(pairs),
+    'OK' if len(missing) == 0 else 'MISSING %s'%missing))
+  return len(missing) == 0
+
+def compare_sparse_mode(Dij, cells, d_c, n_repeat):
+  ''' Time and compare clustering_manager in dense mode on the NCDist matrix Dij and in sparse
+      mode on the G6 embedding of cells. Returns False if rho, the cluster centers or the
+      cluster assignments differ '''
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.consensus_functions import clustering_manager
+  from exafel_project.ADSE13_25.clustering.sparse_density_peaks import g6_embedding
+  NN = Dij.focus()[0]
+  g6 = g6_embedding([c.mm for c in cells])
+  # The G6 distance equals NCDist away from the Niggli reduction boundaries
+  differences = flex.abs(Dij.as_1d() - flex.double(np.sqrt(((g6[:,None,:] - g6[None,:,:])**2).sum(axis=2)).ravel()))
+  t_dense, CM = best_time(lambda: clustering_manager(Dij=Dij, d_c=d_c, Z_delta=2.0, strategy='strategy_3'), n_repeat)
+  t_sparse, CM_sparse = best_time(lambda: clustering_manager(points=g6, d_c=d_c, Z_delta=2.0, strategy='strategy_3'), n_repeat)
+  same_rho = list(CM.rho) == list(CM_sparse.rho)
+  same_centers = list(CM.cluster_id_maxima) == list(CM_sparse.cluster_id_maxima)
+  same_clusters = list(CM.cluster_id_final) == list(CM_sparse.cluster_id_final)
+  ok = same_rho and same_centers and same_clusters
+  print ('  sparse mode           dense %8.4f s sparse %8.4f s max |G6 - NCDist| %.3g max |delta diff| %.3g %s'%(
+    t_dense, t_sparse, flex.max(differences) if NN > 0 else 0.0,
+    flex.max(flex.abs(CM.delta - CM_sparse.delta)) if NN > 0 else 0.0,
+    'OK' if ok else 'MISMATCH rho %s centers %s clusters %s'%(same_rho, same_centers, same_clusters)))
+  return ok
+
+def benchmark(experiments_list, params):
+  ''' Timings and centroids of the consensus clustering steps on one data set '''
+  from xfel.clustering.singleframe import CellOnlyFrame
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.consensus_functions import clustering_iota_scope, \
+    clustering_manager, estimate_d_c, get_uc_consensus
+  clustering_params = clustering_iota_scope.extract().clustering
+  crystals = [experiments.crystals()[0] for experiments in experiments_list]
+  cells = [CellOnlyFrame(crystal.get_crystal_symmetry()) for crystal in crystals]
+  timings = []
+  centroids = {}
+  t, Dij = best_time(lambda: ncdist_matrix(cells), params.n_repeat)
+  timings.append(('NCDist_flatten', t))
+  t, d_c = best_time(lambda: estimate_d_c(Dij), params.n_repeat)
+  timings.append(('estimate_d_c', t))
+  centroids['d_c'] = d_c
+  kwargs = dict(Dij=Dij, d_c=d_c, Z_delta=clustering_params.Z_delta, strategy='strategy_3')
+  if params.baseline_code:
+    # The baseline clustering_manager still reads max_percentile_rho
+    kwargs['max_percentile_rho'] = clustering_params.max_percentile_rho_uc
+  t, CM = best_time(lambda: clustering_manager(**kwargs), params.n_repeat)
+  timings.append(('clustering_manager', t))
+  centroids['uc_centers'] = [[i, int(cluster)] for i, cluster in enumerate(CM.cluster_id_maxima) if cluster >= 0]
+  centroids['uc_central_cells'] = [list(cells[i].uc) for i, cluster in centroids['uc_centers']]
+  if len(crystals) <= params.get_uc_consensus_max_models and not params.baseline_code:
+    from exafel_project.ADSE13_25.clustering.orientation_distance import orientational_distance_engine
+    from exafel_project.ADSE13_25.orientation.similarity_cache import similarity_transformations
+    # Orientational Dij of every unit cell cluster big enough to be clustered, as get_uc_consensus.
+    # Every repeat starts with an empty transformation cache
+    def build_Dij_ori():
+      from collections import Counter
+      similarity = similarity_transformations(crystals)
+      uc_cluster_count = Counter(list(CM.cluster_id_final))
+      members = {}
+      for i, cluster in enumerate(CM.cluster_id_full):
+        members.setdefault(cluster, []).append(i)
+      return dict([(cluster, orientational_distance_engine(similarity, members[cluster]).condensed_matrix(
+                     nproc=clustering_params.orientation_distance_nproc))
+                   for cluster in uc_cluster_count if uc_cluster_count[cluster] >= clustering_params.min_datapts])
+    t, Dij_ori = best_time(build_Dij_ori, params.n_repeat)
+    timings.append(('Dij_ori build', t))
+  if len(crystals) <= params.get_uc_consensus_max_models:
+    t, result = best_time(lambda: get_uc_consensus(experiments_list, clustering_params=clustering_params), params.n_repeat)
+    timings.append(('get_uc_consensus', t))
+    crystal_models, clustered_experiments_list = result
+    centroids['consensus_A'] = [list(crystal.get_A()) for crystal in crystal_models]
+    centroids['consensus_cells'] = [list(crystal.get_unit_cell().parameters()) for crystal in crystal_models]
+    centroids['clustered_experiments_list'] = None if clustered_experiments_list is None else \
+      [int(i) for i in clustered_experiments_list]
+  return Dij, cells, timings, centroids
+
+def same_centroids(result, reference, tolerance=1.e-6):
+  ''' Names of the centroid entries that differ from the reference '''
+  differences = []
+  for key in sorted(reference):
+    if key not in result:
+      differences.append(key)
+      continue
+    a, b = result[key], reference[key]
+    if isinstance(b, list) and len(b) > 0 and isinstance(b[0], list) and isinstance(b[0][0], float):
+      if len(a) != len(b) or any([not np.allclose(x, y, rtol=tolerance, atol=tolerance) for x, y in zip(a, b)]):
+        differences.append(key)
+    elif a != b:
+      differences.append(key)
+  return differences
+
+default_reference = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_centroids.json')
+
+def run(params):
+  reference_file = params.reference
+  if reference_file is None and not params.baseline_code and os.path.exists(default_reference):
+    reference_file = default_reference
+  reference = None
+  ok = True
+  if reference_file is not None:
+    with open(reference_file) as f:
+      reference = json.load(f)
+    print ('Checking the centroids against %s'%reference_file)
+  elif not params.baseline_code:
+    # Without the reference the centroids cannot be checked, which is a failure of the suite
+    print ('No reference centroids, %s is missing. Write it from the baseline commit, see --help'%default_reference)
+    ok = False
+  results = {}
+  for name in params.dataset:
+    crystals = load_dataset(name, params)
+    for scale in params.scale:
+      key = '%s_x%d'%(name, scale)
+      experiments_list = scaled(crystals, scale, params)
+      print ('%s: %d models'%(key, len(experiments_list)))
+      Dij, cells, timings, centroids = benchmark(experiments_list, params)
+      for step, t in timings:
+        print ('  %-20s %10.4f s'%(step, t))
+      if params.compare_reference_code and scale == 1 and not params.baseline_code:
+        ok = compare_reference_code(Dij, params.n_repeat) and ok
+      if params.compare_sparse_mode and scale == 1 and name.startswith('lysozyme') and not params.baseline_code:
+        ok = compare_sparse_mode(Dij, cells, centroids['d_c'], params.n_repeat) and ok
+      if params.compare_close_pairs and scale == 1 and not name.startswith('lysozyme') and not params.baseline_code:
+        ok = compare_close_pairs(crystals, params.close_pairs_min_angle, params.n_repeat) and ok
+      print ('  d_c = %s, %d uc clusters, %s consensus models'%(centroids['d_c'], len(centroids['uc_centers']),
+             len(centroids['consensus_A']) if 'consensus_A' in centroids else 'no'))
+      if reference is not None:
+        if key not in reference:
+          print ('  no reference centroids for %s'%key)
+          ok = False
+        else:
+          differences = same_centroids(centroids, reference[key])
+          ok = ok and len(differences) == 0
+          print ('  centroids %s'%('unchanged' if len(differences) == 0 else 'CHANGED: %s'%', '.join(differences)))
+      results[key] = centroids
+  if params.write_reference is not None:
+    with open(params.write_reference, 'w') as f:
+      json.dump(results, f, indent=1, sort_keys=True)
+    print ('Wrote centroids to %s'%params.write_reference)
+  print ('All checks passed' if ok else 'Some checks FAILED')
+  return ok
+
+if __name__ == '__main__':
+  if '-h' in sys.argv[1:] or '--help' in sys.argv[1:]:
+    print (message)
+    benchmark_phil_scope.show()
+    sys.exit(0)
+  from exafel_project.ADSE13_25.command_line.indexing_analytics import params_from_phil
+  params = params_from_phil(sys.argv[1:], phil_scope=benchmark_phil_scope)
+  sys.exit(0 if run(params) else 1)
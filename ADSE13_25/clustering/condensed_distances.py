@@ -0,0 +1,129 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import numpy as np
+
+#
+# Condensed storage of a symmetric distance matrix with zero diagonal for the density peak
+# clustering of consensus_functions. Only the upper triangle i < j is kept, as n*(n-1)/2
+# float32 values in the order of orientation_distance.condensed_index, i.e. a quarter of
+# the memory of the full flex.double square. It provides what clustering_manager and
+# estimate_d_c use of the square matrix: single rows, the maximum and the histogram of all
+# n*n entries (the diagonal zeros and both triangles, as flex.histogram of the square).
+# condensed_density_peaks is the Rodriguez_Laio_clustering_2014 interface on top of it.
+#
+
+def histogram_slots(values, n_slots, data_min, data_max):
+  ''' Counts of the float64 array values in n_slots slots between data_min and data_max, as
+      flex.histogram. Everything goes to the first slot if data_min == data_max '''
+  slots = np.zeros(n_slots, dtype=np.int64)
+  slot_width = (data_max - data_min)/n_slots
+  if slot_width == 0:
+    slots[0] = len(values)
+    return slots
+  slot = np.minimum(((values - data_min)/slot_width).astype(np.int64), n_slots-1)
+  return slots + np.bincount(slot, minlength=n_slots)
+
+class condensed_distances(object):
+  ''' n x n symmetric distances from the n*(n-1)/2 values of the upper triangle, row by row '''
+  def __init__(self, n, values=None):
+    self.n = n
+    n_pairs = n*(n-1)//2
+    if values is None:
+      self.values = np.zeros(n_pairs, dtype=np.float32)
+    else:
+      self.values = np.fromiter(values, dtype=np.float32, count=n_pairs)
+    # Position of the pair (i, i+1), the start of the upper triangle part of row i
+    i = np.arange(n, dtype=np.int64)
+    self._row_start = i*n - i*(i+1)//2
+
+  @classmethod
+  def from_square(cls, Dij):
+    ''' From a square flex.double, e.g. NCDist_flatten '''
+    n = Dij.focus()[0]
+    square = np.fromiter(Dij.as_1d(), dtype=np.float64, count=n*n).reshape(n, n)
+    return cls(n, square[np.triu_indices(n, k=1)])
+
+  def focus(self):
+    return (self.n, self.n)
+
+  def row(self, i):
+    ''' float64 array of the distances from i to all points, 0 for i itself '''
+    row = np.zeros(self.n)
+    j = np.arange(i)
+    row[:i] = self.values[self._row_start[j] + (i-j-1)]
+    row[i+1:] = self.values[self._row_start[i]:self._row_start[i] + self.n-i-1]
+    return row
+
+  def max(self):
+    if len(self.values) == 0:
+      return 0.0
+    return float(self.values.max())
+
+  def min(self):
+    if len(self.values) == 0:
+      return 0.0
+    return min(0.0, float(self.values.min()))
+
+  def histogram(self, n_slots):
+    ''' Counts of the n*n entries of the square in n_slots slots between its min and max, as
+        flex.histogram(Dij.as_1d(), n_slots=n_slots).slots() '''
+    data_min, data_max = self.min(), self.max()
+    # Both triangles, then the diagonal
+    slots = 2*histogram_slots(self.values.astype(np.float64), n_slots, data_min, data_max)
+    slots += self.n*histogram_slots(np.zeros(1), n_slots, data_min, data_max)
+    return slots
+
+  def as_square(self):
+    ''' Full n x n flex.double, e.g. for plotting '''
+    from scitbx.array_family import flex
+    square = np.zeros((self.n, self.n))
+    upper = np.triu_indices(self.n, k=1)
+    square[upper] = self.values
+    square.T[upper] = self.values
+    Dij = flex.double(square.ravel().tolist())
+    Dij.reshape(flex.grid(self.n, self.n))
+    return Dij
+
+class condensed_density_peaks(object):
+  ''' Rodriguez_Laio_clustering_2014 for clustering_manager on condensed_distances. Every
+      quantity is computed one row at a time, no n x n array is built '''
+  def __init__(self, distances, d_c):
+    self.distances = distances
+    self.n = distances.n
+    self.d_c = d_c
+    self.nearest_neighbor = None
+
+  def get_rho(self):
+    ''' flex.int of the number of points closer than d_c to each point, itself included '''
+    from exafel_project.ADSE13_25.clustering.sparse_density_peaks import _as_flex_int
+    self.rho = np.array([(self.distances.row(i) < self.d_c).sum() for i in range(self.n)], dtype=np.int64)
+    return _as_flex_int(self.rho)
+
+  def max_distance_from(self, i):
+    return float(self.distances.row(i).max())
+
+  def get_delta(self, rho_order, delta_i_max):
+    ''' flex.double of the distance of each point to the nearest point before it in rho_order,
+        ties go to the earliest in rho_order, delta_i_max for the first one '''
+    from exafel_project.ADSE13_25.clustering.sparse_density_peaks import _as_flex_double
+    rho_order = np.fromiter(rho_order, dtype=np.int64, count=self.n)
+    rank = np.empty(self.n, dtype=np.int64)
+    rank[rho_order] = np.arange(self.n)
+    delta = np.zeros(self.n)
+    nearest_neighbor = np.arange(self.n)
+    for i in rho_order[1:]:
+      row = self.distances.row(i)
+      earlier = rho_order[:rank[i]]
+      # earlier is in rho_order so argmin takes the earliest of tied distances
+      j = int(np.argmin(row[earlier]))
+      delta[i] = row[earlier[j]]
+      nearest_neighbor[i] = earlier[j]
+    delta[rho_order[0]] = delta_i_max
+    self.delta = delta
+    self.nearest_neighbor = nearest_neighbor
+    return _as_flex_double(delta)
+
+  def cluster_assignment(self, rho_order, cluster_id, rho):
+    from exafel_project.ADSE13_25.clustering.sparse_density_peaks import assign_to_nearest_neighbor
+    assert self.nearest_neighbor is not None, 'get_delta has to be called first'
+    assign_to_nearest_neighbor(self.nearest_neighbor, rho_order, cluster_id)
@@ -23,19 +23,59 @@ clustering {
     .help = d_c parameter used during clustering by orientational matrix A
   max_percentile_rho_uc = 0.95
     .type = float
-    .help = rho of a data point needs to be above this value to be considered a mediod during uc clustering
+    .help = Deprecated, has no effect. Cluster centers are picked from the rho and delta Z-scores, see cluster_centers
   max_percentile_rho_ori = 0.85
     .type = float
-    .help = rho of a data point needs to be above this value to be considered a mediod during orientational clustering
+    .help = Deprecated, has no effect. Cluster centers are picked from the rho and delta Z-scores, see cluster_centers
   min_datapts = 5
     .type = int
     .help = Minimum number of datapoints in each cluster to be able to be considered \
             for further indexing
+  orientation_distance_nproc = 1
+    .type = int(value_min=1)
+    .help = Number of worker processes used to compute the pairwise orientational distances \
+            of a unit cell cluster. 1 computes them in the calling process. More than 1 \
+            forks the workers after MPI_Init, which several MPI transports (e.g. InfiniBand \
+            verbs, Cray/Slingshot) do not support: check the MPI library of the site first
 }
 
 '''
 clustering_iota_scope = parse(clustering_iota_phil_str)
 
+sequential_consensus_phil_str = '''
+sequential_consensus
+  .help = Run the random sub-sampling trials in batches and stop as soon as the dominant \
+          unit cell/orientation cluster found by get_uc_consensus is stable
+{
+  enable = False
+    .type = bool
+    .help = If True, update the consensus after every batch of trials and stop early once stable
+  min_trials = 10
+    .type = int(value_min=1)
+    .help = Number of trials run before the consensus is evaluated for the first time
+  batch_size = 5
+    .type = int(value_min=1)
+    .help = Number of trials run between consensus updates
+  membership_tolerance = 0.9
+    .type = float(value_min=0, value_max=1)
+    .help = Fraction of the members of the dominant cluster at the previous update that have to \
+            still be members for the cluster to count as stable
+  unit_cell_tolerance = 0.01
+    .type = float(value_min=0)
+    .help = Maximum relative change of any unit cell parameter of the dominant cluster centroid \
+            between updates for the cluster to count as stable
+  orientation_tolerance = 1.0
+    .type = float(value_min=0)
+    .help = Maximum angle in degrees between each consensus crystal model (one per orientational \
+            cluster) and the closest model of the previous update for the orientations to count \
+            as stable. The number of orientational clusters has to stay the same as well
+  n_stable = 1
+    .type = int(value_min=1)
+    .help = Number of consecutive stable updates needed before the trials are stopped
+}
+'''
+sequential_consensus_scope = parse(sequential_consensus_phil_str)
+
 def get_dij_ori(cryst1, cryst2, is_reciprocal=True):
   '''
   Takes in 2 dxtbx crystal models, returns the distance between the 2 models in crystal
@@ -46,223 +86,176 @@ def get_dij_ori(cryst1, cryst2, is_reciprocal=True):
   unimodular_generator_range = to keep the volume to be 1. If volume doubles on change of basis, make it 2
 
   '''
-  from scitbx.math import flex
   from cctbx_orientation_ext import crystal_orientation
+  from exafel_project.ADSE13_25.clustering.orientation_distance import orientation_distance
   cryst1_ori = crystal_orientation(cryst1.get_A(), is_reciprocal)
   cryst2_ori = crystal_orientation(cryst2.get_A(), is_reciprocal)
-  try:
-    best_similarity_transform = cryst2_ori.best_similarity_transformation(
-        other = cryst1_ori, fractional_length_tolerance = 50.00,
-        unimodular_generator_range=1)
-    cryst2_ori_best=cryst2_ori.change_basis(best_similarity_transform)
-  except Exception as e:
-    #print (str(e))
-    cryst2_ori_best = cryst2_ori
-  #print 'difference z-score = ', cryst1_ori.difference_Z_score(cryst2_ori_best)
-  return cryst1_ori.difference_Z_score(cryst2_ori_best)
+  return orientation_distance(cryst1_ori, cryst2_ori)
 
 def estimate_d_c(Dij):
   ''' Estimate the value of d_c using the assumption that each cluster will be gaussian distributed in it's dij values.
       If we can find out how many of those gaussians are there in the Dij distribution, we can get an estimate of the d_c
       from the standard deviation of the individual gaussians'''
   from scitbx.array_family import flex
-  Dij_max=max(Dij.as_1d())
-  Dij_min=min(Dij.as_1d())
+  import numpy as np
+  from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances, histogram_slots
+  condensed = isinstance(Dij, condensed_distances)
+  # A square numpy array is used as is, e.g. by incremental_consensus
+  square_numpy = isinstance(Dij, np.ndarray)
+  if condensed:
+    Dij_max=Dij.max()
+  elif square_numpy:
+    Dij_max=float(Dij.max())
+  else:
+    Dij_max=flex.max(Dij.as_1d())
   # Rounding off to closest multiple of 10
   n_slots=(int(Dij_max)//10+1)*10
   if n_slots == 10:
     return 1.0
-  hist_data=flex.histogram(Dij.as_1d(), n_slots=n_slots)
-  # Divide the data further into bins and see if there are dead zones with data on either sides. 
+  # Divide the data further into bins and see if there are dead zones with data on either sides.
   # This will indicate that there are 2+ clusters
-  y=hist_data.slots()
-  x=hist_data.slot_centers()
-  moving_avg_bin=[]
-  for i in range(0, n_slots, 10):
-    moving_avg_bin.append(flex.mean(flex.double(list(y[i:i+10]))))
+  if condensed:
+    y=Dij.histogram(n_slots).astype(np.float64)
+  elif square_numpy:
+    y=histogram_slots(Dij.ravel(), n_slots, float(Dij.min()), Dij_max).astype(np.float64)
+  else:
+    y=flex.histogram(Dij.as_1d(), n_slots=n_slots).slots().as_numpy_array().astype(np.float64)
+  moving_avg_bin=y.reshape(-1, 10).mean(axis=1)
   # There has to be one cluster close to 0.0, take that as reference point and find out where the next cluster is
-  min_avg = min(moving_avg_bin)*2.0
-  d_c=1.0
-  for i, avg in enumerate(moving_avg_bin):
-    if avg<=min_avg:
-      d_c= float(i*10.0)
-      break
-  return d_c
+  min_avg = moving_avg_bin.min()*2.0
+  # The smallest bin always qualifies
+  i = int(np.flatnonzero(moving_avg_bin <= min_avg)[0])
+  return float(i*10.0)
+
+def cluster_centers(rho, delta, rho_order, strategy='default'):
+  ''' Indices of the cluster centers of the decision graph (rho, delta) of Rodriguez_Laio_clustering_2014,
+      center i gets cluster id i. strategy is the one of clustering_manager '''
+  import numpy as np
+  rho_np = rho.as_double().as_numpy_array()
+  delta_np = delta.as_numpy_array()
+  centers = []
+
+  pick_top_solution=False
+  rho_stdev = flex.mean_and_variance(rho.as_double()).unweighted_sample_standard_deviation()
+  delta_stdev = flex.mean_and_variance(delta).unweighted_sample_standard_deviation()
+  if rho_stdev !=0.0 and delta_stdev !=0:
+    delta_z=((delta-flex.mean(delta))/(delta_stdev)).as_numpy_array()
+  else:
+    pick_top_solution=True
+    if rho_stdev == 0.0:
+      centroids = [flex.first_index(delta,flex.max(delta))]
+    elif delta_stdev == 0.0:
+      centroids = [flex.first_index(rho,flex.max(rho))]
+
+  # Define strategy to decide cluster center here. Only one should be true
+  debug_fix_clustering = strategy not in ['one_cluster', 'strategy_3']
+  strategy2 = strategy == 'one_cluster'
+  strategy3 = strategy == 'strategy_3'
+
+  if debug_fix_clustering:
+    if not pick_top_solution:
+      delta_z_cutoff = min(1.0, delta_z.max())
+      # Use idea quoted in Rodriguez Laio 2014 paper
+      # " Thus, cluster centers are recognized as points for which the value of delta is anomalously large."
+      centroid_candidates = np.flatnonzero((delta_z >= delta_z_cutoff) | (delta_z <= -delta_z_cutoff))
+      candidate_delta_z = delta_z[centroid_candidates]
+      # rho_order[0] has the largest delta so it is always a candidate
+      delta_z_of_rho_order_0 = delta_z[rho_order[0]]
+      i_sorted=flex.sort_permutation(flex.double(candidate_delta_z), reverse=True)
+      # Check that once sorted the top one is not equal to the 2nd or 3rd position
+      # If there is a tie, assign centroid to the first one in rho order
+      centroids=[]
+      # rho_order[0] has to be a centroid
+      centroids.append(rho_order[0])
+      for i in range(0, len(i_sorted)):
+        if centroid_candidates[i_sorted[i]] == rho_order[0]:
+          continue
+        if delta_z_of_rho_order_0-candidate_delta_z[i_sorted[i]] > 1.0:
+          if i>1:
+            if -candidate_delta_z[i_sorted[i-1]]+candidate_delta_z[i_sorted[0]] > 1.0:
+              centroids.append(int(centroid_candidates[i_sorted[i]]))
+          else:
+            centroids.append(int(centroid_candidates[i_sorted[i]]))
+        else:
+          break
+    for item_idx in centroids:
+      print ('CLUSTERING_STATS',item_idx,len(centers))
+      centers.append(item_idx)
+  elif strategy2:
+    # This will only assign one cluster center based on highest product of rho and delta
+    item_idx=int(np.argmax(rho_np*delta_np))
+    print ('CLUSTERING_STATS',item_idx,len(centers))
+    centers.append(item_idx)
+  elif strategy3:
+    # use product of delta and rho and pick out top candidates
+    # have to use a significance z_score to filter out the very best
+    product_list_of_ranks=rho.as_double()*delta
+    iid_sorted=flex.sort_permutation(product_list_of_ranks, reverse=True)
+    product_np=product_list_of_ranks.as_numpy_array()
+    centers.append(iid_sorted[0]) # first point always a cluster
+    print ('CLUSTERING_STATS S3',iid_sorted[0],0)
+    stdev=np.std(product_np)
+    mean=np.mean(product_np)
+    n_sorted=3
+    z_critical = 3.0
+    # Only go through say 3-4 datapoints
+    # basically there won't be more than 2-3 lattices on an image realistically
+    for iid in iid_sorted[1:n_sorted]:
+      z_score=(product_np[iid]-mean)/stdev
+      if z_score > z_critical:
+        print ('CLUSTERING_STATS S3',iid,len(centers))
+        centers.append(iid)
+      else:
+        break # No point going over all points once below threshold z_score
+  return centers
 
 class clustering_manager(group_args):
   def __init__(self, **kwargs):
     group_args.__init__(self, **kwargs)
     print ('finished Dij, now calculating rho_i and density')
-    from xfel.clustering import Rodriguez_Laio_clustering_2014 as RL
-    R = RL(distance_matrix = self.Dij, d_c = self.d_c)
+    dense = False
+    if hasattr(self, 'density_peaks'):
+      # rho/delta computed elsewhere, e.g. distributed over MPI ranks, see precomputed_density_peaks
+      R = self.density_peaks
+    elif hasattr(self, 'points'):
+      # Sparse mode for large data sets: points are coordinates in a metric embedding and
+      # rho/delta come from a k nearest neighbor search instead of a dense Dij matrix
+      from exafel_project.ADSE13_25.clustering.sparse_density_peaks import sparse_density_peaks
+      if hasattr(self, 'k_neighbors') is False:
+        self.k_neighbors = 32
+      R = sparse_density_peaks(self.points, d_c = self.d_c, k = self.k_neighbors)
+    else:
+      from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances, condensed_density_peaks
+      if isinstance(self.Dij, condensed_distances):
+        # Upper triangle float32 storage, rho/delta are computed row by row
+        R = condensed_density_peaks(self.Dij, d_c = self.d_c)
+      else:
+        from xfel.clustering import Rodriguez_Laio_clustering_2014 as RL
+        R = RL(distance_matrix = self.Dij, d_c = self.d_c)
+        dense = True
     #from clustering.plot_with_dimensional_embedding import plot_with_dimensional_embedding
     #plot_with_dimensional_embedding(1-self.Dij/flex.max(self.Dij), show_plot=True)
     if hasattr(self, 'strategy') is False:
       self.strategy='default'
     self.rho = rho = R.get_rho()
     ave_rho = flex.mean(rho.as_double())
-    NN = self.Dij.focus()[0]
     i_max = flex.max_index(rho)
-    delta_i_max = flex.max(flex.double([self.Dij[i_max,j] for j in range(NN)]))
+    if dense:
+      NN = self.Dij.focus()[0]
+      delta_i_max = flex.max(self.Dij.as_1d()[i_max*NN:(i_max+1)*NN])
+    else:
+      NN = R.n
+      delta_i_max = R.max_distance_from(i_max)
     rho_order = flex.sort_permutation(rho, reverse=True)
-    rho_order_list = list(rho_order)
     self.delta = delta = R.get_delta(rho_order=rho_order, delta_i_max=delta_i_max)
-    cluster_id = flex.int(NN, -1) # -1 means no cluster
-    delta_order = flex.sort_permutation(delta, reverse=True)
-    MAX_PERCENTILE_RHO = self.max_percentile_rho # cluster centers have to be in the top percentile
-    n_cluster = 0
-#
-#
     print ('Z_DELTA = ',self.Z_delta)
-
-
-    pick_top_solution=False
-    rho_stdev = flex.mean_and_variance(rho.as_double()).unweighted_sample_standard_deviation()
-    delta_stdev = flex.mean_and_variance(delta).unweighted_sample_standard_deviation()
-    if rho_stdev !=0.0 and delta_stdev !=0:
-      rho_z=(rho.as_double()-flex.mean(rho.as_double()))/(rho_stdev)
-      delta_z=(delta-flex.mean(delta))/(delta_stdev)
-    else:
-      pick_top_solution=True
-      if rho_stdev == 0.0:
-        centroids = [flex.first_index(delta,flex.max(delta))]
-      elif delta_stdev == 0.0:
-        centroids = [flex.first_index(rho,flex.max(rho))]
-
-    significant_delta = []
-    significant_rho = []
-    # Define strategy to decide cluster center here. Only one should be true
-    debug_fix_clustering = True
-    if self.strategy=='one_cluster':
-        debug_fix_clustering=False
-        strategy2=True
-    if self.strategy=='strategy_3':
-        debug_fix_clustering=False
-        strategy3=True
-        strategy2=False
-
-    if debug_fix_clustering:
-      if not pick_top_solution:
-        delta_z_cutoff = min(1.0, max(delta_z))
-        rho_z_cutoff = min(1.0, max(rho_z))
-        for ic in range(NN):
-          # test the density & rho
-          if delta_z[ic] >= delta_z_cutoff or delta_z[ic] <= -delta_z_cutoff:
-            significant_delta.append(ic)
-          if rho_z[ic] >= rho_z_cutoff or rho_z[ic] <= -rho_z_cutoff:
-            significant_rho.append(ic)
-        if True:
-          # Use idea quoted in Rodriguez Laio 2014 paper
-          # " Thus, cluster centers are recognized as points for which the value of delta is anomalously large."
-          centroid_candidates=list(significant_delta)
-          candidate_delta_z=flex.double()
-          for ic in centroid_candidates:
-            if ic == rho_order[0]:
-              delta_z_of_rho_order_0=delta_z[ic]
-            candidate_delta_z.append(delta_z[ic])
-          i_sorted=flex.sort_permutation(candidate_delta_z, reverse=True)
-          # Check that once sorted the top one is not equal to the 2nd or 3rd position
-          # If there is a tie, assign centroid to the first one in rho order
-          centroids=[]
-          # rho_order[0] has to be a centroid
-          centroids.append(rho_order[0])
-          
-          #centroids.append(centroid_candidates[i_sorted[0]])
-          for i in range(0, len(i_sorted[:])):
-            if centroid_candidates[i_sorted[i]] == rho_order[0]:
-              continue
-            if delta_z_of_rho_order_0-candidate_delta_z[i_sorted[i]] > 1.0:
-              if i>1:
-                if -candidate_delta_z[i_sorted[i-1]]+candidate_delta_z[i_sorted[0]] > 1.0:
-                  centroids.append(centroid_candidates[i_sorted[i]])
-              else:
-                centroids.append(centroid_candidates[i_sorted[i]])
-            else:
-              break
-        if False:
-          centroid_candidates = list(set(significant_delta).intersection(set(significant_rho)))
-          # Now compare the relative orders of the max delta_z and max rho_z to make sure they are within 1 stdev
-          centroids = []
-          max_delta_z_candidates = -999.9
-          max_rho_z_candidates = -999.9
-          for ic in centroid_candidates:
-            if delta_z[ic] > max_delta_z_candidates:
-              max_delta_z_candidates = delta_z[ic]
-            if rho_z[ic] > max_rho_z_candidates:
-              max_rho_z_candidates = rho_z[ic]
-          for ic in centroid_candidates:
-            if max_delta_z_candidates - delta_z[ic] < 1.0 and max_rho_z_candidates - rho_z[ic] < 1.0:
-              centroids.append(ic)
-
-      #item_idxs = [delta_order[ic] for ic,centroid in enumerate(centroids)]
-      item_idxs=centroids
-      for item_idx in item_idxs:
-        cluster_id[item_idx] = n_cluster
-        print ('CLUSTERING_STATS',item_idx,cluster_id[item_idx] )
-        n_cluster +=1
-        ####
-    elif strategy2:
-      # Go through list of clusters, see which one has highest joint rank in both rho and delta lists
-      # This will only assign one cluster center based on highest product of rho and delta ranks
-      product_list_of_ranks=[]
-      for ic in range(NN):
-        rho_tmp=self.rho[ic]
-        delta_tmp=self.delta[ic]
-        product_list_of_ranks.append(rho_tmp*delta_tmp)
-      import numpy as np
-      item_idx=np.argmax(product_list_of_ranks)
-      cluster_id[item_idx]=n_cluster # Only cluster assigned
-      print ('CLUSTERING_STATS',item_idx,cluster_id[item_idx])
-      n_cluster +=1
-    elif strategy3:
-      # use product of delta and rho and pick out top candidates
-      # have to use a significance z_score to filter out the very best
-      product_list_of_ranks=flex.double()
-      for ic in range(NN):
-        rho_tmp=self.rho[ic]
-        delta_tmp=self.delta[ic]
-        product_list_of_ranks.append(rho_tmp*delta_tmp)
-      import numpy as np
-      iid_sorted=flex.sort_permutation(product_list_of_ranks, reverse=True)
-      cluster_id[iid_sorted[0]]=n_cluster # first point always a cluster
-      n_cluster +=1
-      print ('CLUSTERING_STATS S3',iid_sorted[0],cluster_id[iid_sorted[0]])
-      #product_list_of_ranks[iid_sorted[0]]=0.0 # set this to 0.0 so that the mean/stdev does not get biased by one point
-      stdev=np.std(product_list_of_ranks)
-      mean=np.mean(product_list_of_ranks)
-      n_sorted=3
-      #if stdev == 0.0:
-      #  n_sorted=1
-      
-      z_critical = 3.0 # 2 sigma significance ?
-      # Only go through say 3-4 datapoints 
-      # basically there won't be more than 2-3 lattices on an image realistically
-      for iid in iid_sorted[1:n_sorted]:
-        z_score=(product_list_of_ranks[iid]-mean)/stdev
-        if z_score > z_critical:
-          cluster_id[iid]=n_cluster
-          n_cluster +=1
-          print ('CLUSTERING_STATS S3',iid,cluster_id[iid])
-        else:
-          break # No point going over all points once below threshold z_score
-
-    else:
-      for ic in range(NN):
-        item_idx = delta_order[ic]
-        if ic != 0:
-          if delta[item_idx] <= 0.25*delta[delta_order[0]]: # too low to be a medoid
-            continue
-        item_rho_order = rho_order_list.index(item_idx)
-        if (item_rho_order)/NN < MAX_PERCENTILE_RHO:
-          cluster_id[item_idx] = n_cluster
-          print ('CLUSTERING_STATS',ic,item_idx,item_rho_order,cluster_id[item_idx])
-          n_cluster +=1
-    ###
-#
-    print ('Found %d clusters'%n_cluster)
-    for x in range(NN):
-      if cluster_id[x] >= 0:
-        print ("XC", x,cluster_id[x], rho[x], delta[x])
+    centers = cluster_centers(rho, delta, rho_order, strategy=self.strategy)
+    cluster_id = flex.int(NN, -1) # -1 means no cluster
+    for n_cluster, item_idx in enumerate(centers):
+      cluster_id[item_idx] = n_cluster
+    print ('Found %d clusters'%len(centers))
+    for x in sorted(centers):
+      print ("XC", x,cluster_id[x], rho[x], delta[x])
     self.cluster_id_maxima = cluster_id.deep_copy()
     R.cluster_assignment(rho_order, cluster_id, rho)
     self.cluster_id_full = cluster_id.deep_copy()
@@ -284,10 +277,62 @@ class clustering_manager(group_args):
     #      cluster_id.set_selected(too_sparse,-1)
     self.cluster_id_final = cluster_id.deep_copy()
 
-def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_only_first_indexed_model=False,finalize_method = 'reindex_with_known_crystal_models', clustering_params = None):
+def prune_close_models(dxtbx_crystal_models, clustered_experiments_list, min_angle, similarity=None):
+  ''' Crystal models of get_uc_consensus without the ones within min_angle degrees of an
+      earlier model. clustered_experiments_list (flex.int) is renumbered in place. The
+      transformations between models of similarity (similarity_transformations) are cached '''
+  from dials.algorithms.indexing.compare_orientation_matrices import difference_rotation_matrix_axis_angle
+  from cctbx_orientation_ext import crystal_orientation
+  from dxtbx.model import Crystal
+  from exafel_project.ADSE13_25.orientation.rotation_index import close_pairs
+  from exafel_project.ADSE13_25.orientation.similarity_cache import similarity_transformations
+  if similarity is None:
+    similarity = similarity_transformations()
+  dxtbx_crystal_models = list(dxtbx_crystal_models)
+  close_models_list = []
+  # Only the pairs whose lattices are within min_angle (plus a margin for the reindexing
+  # below) in the rotation index are compared, in the order of the all pairs loop
+  for i_a, i_b in close_pairs(dxtbx_crystal_models, min_angle, margin=1.0, lattice_symmetry=True):
+    cryst_a = dxtbx_crystal_models[i_a]
+    cryst_b = dxtbx_crystal_models[i_b]
+    try:
+      cryst_b_ori_best = similarity.align(cryst_a, cryst_b, fractional_length_tolerance = 20.00,
+        unimodular_generator_range=1)
+    except Exception as e:
+      cryst_b_ori_best = crystal_orientation(cryst_b.get_A(), True)
+
+    # FIXME hardcoded space group for myoglobin LS49
+    cryst_b_best=Crystal(cryst_b_ori_best.direct_matrix()[0:3], cryst_b_ori_best.direct_matrix()[3:6], cryst_b_ori_best.direct_matrix()[6:9], 'P 1 21 1')
+    R_ab, axis, angle, cb_op_ab = difference_rotation_matrix_axis_angle(cryst_a, cryst_b_best)
+    # FIXME
+    if abs(angle) < min_angle: # degrees
+      close_models_list.append((i_a, i_b))
+
+  # Now prune the dxtbx_crystal_models list
+  unique_experiments_list=flex.int(range(len(dxtbx_crystal_models)))
+  for close_models in close_models_list:
+    i_a,i_b = close_models
+    if dxtbx_crystal_models[i_a] is not None and dxtbx_crystal_models[i_b] is not None:
+      dxtbx_crystal_models[i_b]=None
+      unique_experiments_list[i_b]=i_a
+      clustered_experiments_list.set_selected(clustered_experiments_list==i_b, i_a)
+
+  counter=-1
+  for ii,model in enumerate(dxtbx_crystal_models):
+    if model is not None:
+      counter +=1 
+      clustered_experiments_list.set_selected(clustered_experiments_list==unique_experiments_list[ii], counter)
+  return [x for x in dxtbx_crystal_models if x is not None]
+
+def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_only_first_indexed_model=False,finalize_method = 'reindex_with_known_crystal_models', clustering_params = None, similarity = None):
   '''
   Uses the Rodriguez Laio 2014 method to do a hierarchical clustering of the crystal models and
-  then vote for the highest consensus crystal mode. Input needs to be a list of experiments object.
+  then vote for the highest consensus crystal mode. Input needs to be a list of experiments object,
+  or an iota_trial_records object of the trials.
+  similarity is an orientation.similarity_cache.similarity_transformations for the models of
+  experiments_list (or of the beginning of it), so that the best_similarity_transformation of
+  the orientational clustering can be reused, e.g. when union_and_reindex realigns the cluster
+  members onto the consensus models.
   Clustering code taken from github.com/cctbx-xfel/cluster_regression
   Clustering is first done first based on unit cell dimensions. Then for each of the clusters identified,
   a further clustering is done based on orientational matrix A
@@ -360,7 +405,7 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
   print ('d_c = ',d_c)
   if len(cells) < 5:
     return [experiments_list[0].crystals()[0]], None
-  CM = clustering_manager(Dij=Dij, d_c=d_c, max_percentile_rho=clustering_params.max_percentile_rho_uc,Z_delta=clustering_params.Z_delta, strategy='strategy_3')
+  CM = clustering_manager(Dij=Dij, d_c=d_c, Z_delta=clustering_params.Z_delta, strategy='strategy_3')
   n_cluster = 1+flex.max(CM.cluster_id_final)
   print (len(cells), ' datapoints have been analyzed')
   print ('%d CLUSTERS'%n_cluster)
@@ -398,6 +443,9 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
   # idea is to cluster the orientational component in each of the unit cell clusters
   #
   do_orientational_clustering = not return_only_first_indexed_model # temporary.
+  if similarity is None:
+    from exafel_project.ADSE13_25.orientation.similarity_cache import similarity_transformations
+    similarity = similarity_transformations()
   dxtbx_crystal_models = []
   if do_orientational_clustering:
     print ('IOTA: Starting orientational clustering')
@@ -405,20 +453,11 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
     uc_experiments_list = {} # dictionary to store experiments_lists for each cluster
     from collections import Counter
     uc_cluster_count = Counter(list(CM.cluster_id_final))
-    # instantiate the Dij_ori flat 1-d array
+    # The crystal orientation of every model is built once and shared by the clusters, the
+    # transformations between the models are cached on their indices in experiments_list
+    from exafel_project.ADSE13_25.clustering.orientation_distance import orientational_distance_engine
+    similarity.extend_to(experiments_list)
     # Put all experiments list from same uc cluster together
-    if True:
-      from scitbx.matrix import sqr
-      from cctbx_orientation_ext import crystal_orientation
-      crystal_orientation_list = []
-      all_A= []
-      for i in range(len(experiments_list)):
-        crystal_orientation_list.append(crystal_orientation(experiments_list[i].crystals()[0].get_A(), True))
-        #exit()
-        A_direct = sqr(crystal_orientation_list[i].reciprocal_matrix()).transpose().inverse()
-        all_A.append(A_direct[0])
-        #print ("Direct A matrix 1st element = %12.6f %12.6f %12.6f"%(A_direct[0], A_direct[1], A_direct[2]))
-    #  exit()
     CM_mapping = {}
     for i in range(len(experiments_list)):
       if CM.cluster_id_full[i] not in uc_experiments_list:
@@ -432,17 +471,9 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
       # Make sure there are atleast a minimum number of samples in the cluster
       if uc_cluster_count[cluster] < clustering_params.min_datapts:
         continue
-      Dij_ori[cluster] = flex.double([[0.0]*uc_cluster_count[cluster]]*uc_cluster_count[cluster])
-    # Now populate the Dij_ori array
-      N_samples_in_cluster = len(uc_experiments_list[cluster])
-      for i in range(N_samples_in_cluster-1):
-        for j in range(i+1, N_samples_in_cluster):
-          dij_ori = get_dij_ori(uc_experiments_list[cluster][i].crystals()[0],uc_experiments_list[cluster][j].crystals()[0])
-          A_direct_i = sqr(uc_experiments_list[cluster][i].crystals()[0].get_A()).transpose().inverse()
-          A_direct_j = sqr(uc_experiments_list[cluster][j].crystals()[0].get_A()).transpose().inverse()
-          #print ("Direct A matrix 1st element = %12.6f %12.6f %12.6f %12.6f %12.6f %12.6f %12.6f"%(dij_ori, A_direct_i[0], A_direct_j[0], A_direct_i[1],A_direct_j[1], A_direct_i[2], A_direct_j[2] ))
-          Dij_ori[cluster][N_samples_in_cluster*i+j] = dij_ori
-          Dij_ori[cluster][N_samples_in_cluster*j+i] = dij_ori
+      # Populate the Dij_ori array from the upper triangle of pairwise distances
+      engine = orientational_distance_engine(similarity, [i for i, _ in CM_mapping[cluster]])
+      Dij_ori[cluster] = engine.condensed_matrix(nproc=clustering_params.orientation_distance_nproc)
 
     # Now do the orientational cluster analysis
     d_c_ori = clustering_params.d_c_ori # 0.13
@@ -456,7 +487,7 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
       #else:
       #d_c_ori=flex.mean_and_variance(Dij_ori[cluster].as_1d()).unweighted_sample_standard_deviation()
       print ('d_c_ori=',d_c_ori)
-      CM_ori = clustering_manager(Dij=Dij_ori[cluster], d_c=d_c_ori, max_percentile_rho=clustering_params.max_percentile_rho_ori, Z_delta=clustering_params.Z_delta, strategy='strategy_3')
+      CM_ori = clustering_manager(Dij=Dij_ori[cluster], d_c=d_c_ori, Z_delta=clustering_params.Z_delta, strategy='strategy_3')
       n_cluster_ori = 1+flex.max(CM_ori.cluster_id_final)
       #from IPython import embed; embed(); exit()
       for i in range(n_cluster_ori):
@@ -497,49 +528,11 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
   # FIXME should be a PHIL
   #from IPython import embed; embed(); exit()
   min_angle = 5.0 # taken from indexer.py
-  close_models_list = []
   # Not used really; other fixes have been made to code to figure out outliers
   # Still keeping this in case it it useful later on. 
   if len(dxtbx_crystal_models) > 10000:
-    from dials.algorithms.indexing.compare_orientation_matrices import difference_rotation_matrix_axis_angle
-    from cctbx_orientation_ext import crystal_orientation
-    from dxtbx.model import Crystal
-    for i_a in range(0,len(dxtbx_crystal_models)-1):
-      for i_b in range(i_a+1,len(dxtbx_crystal_models)):
-        cryst_a = dxtbx_crystal_models[i_a]
-        cryst_b = dxtbx_crystal_models[i_b]
-        cryst_a_ori = crystal_orientation(cryst_a.get_A(), True)
-        cryst_b_ori = crystal_orientation(cryst_b.get_A(), True)
-        try:
-          best_similarity_transform = cryst_b_ori.best_similarity_transformation(
-            other = cryst_a_ori, fractional_length_tolerance = 20.00,
-            unimodular_generator_range=1)
-          cryst_b_ori_best=cryst_b_ori.change_basis(best_similarity_transform)
-        except Exception as e:
-          cryst_b_ori_best = cryst_b_ori
-
-        # FIXME hardcoded space group for myoglobin LS49
-        cryst_b_best=Crystal(cryst_b_ori_best.direct_matrix()[0:3], cryst_b_ori_best.direct_matrix()[3:6], cryst_b_ori_best.direct_matrix()[6:9], 'P 1 21 1')
-        R_ab, axis, angle, cb_op_ab = difference_rotation_matrix_axis_angle(cryst_a, cryst_b_best)
-        # FIXME
-        if abs(angle) < min_angle: # degrees
-          close_models_list.append((i_a, i_b))
-
-  # Now prune the dxtbx_crystal_models list
-    unique_experiments_list=flex.int(range(len(dxtbx_crystal_models)))
-    for close_models in close_models_list:
-      i_a,i_b = close_models
-      if dxtbx_crystal_models[i_a] is not None and dxtbx_crystal_models[i_b] is not None:
-        dxtbx_crystal_models[i_b]=None
-        unique_experiments_list[i_b]=i_a
-        clustered_experiments_list.set_selected(clustered_experiments_list==i_b, i_a)
-
-    counter=-1
-    for ii,model in enumerate(dxtbx_crystal_models):
-      if model is not None:
-        counter +=1 
-        clustered_experiments_list.set_selected(clustered_experiments_list==unique_experiments_list[ii], counter)
-    dxtbx_crystal_models=[x for x in dxtbx_crystal_models if x is not None]
+    dxtbx_crystal_models = prune_close_models(dxtbx_crystal_models, clustered_experiments_list, min_angle,
+                                              similarity=similarity)
 
   #from IPython import embed; embed(); exit()
   if len(dxtbx_crystal_models) > 0:
@@ -547,3 +540,102 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
   else:
     # If nothing works, atleast return the 1st crystal model that was found
     return [experiments_list[0].crystals()[0]], None
+
+class sequential_consensus(object):
+  '''
+  Keeps track of the consensus while trials are still being run. update is called with the
+  growing experiments_list after every batch of trials, adds the new trials to an
+  incremental_consensus (same result as get_uc_consensus without recomputing the distances
+  of the earlier trials) and returns True once the dominant cluster (the one with most trials
+  assigned) kept its members and its central unit cell, and the orientational clusters kept
+  their number and their consensus orientations, for n_stable consecutive updates. The
+  consensus of the last update is kept in result so that it does not have to be computed again.
+  similarity is passed on to the incremental_consensus, see get_uc_consensus.
+  '''
+  def __init__(self, params, clustering_params=None, finalize_method='reindex_with_known_crystal_models',
+               similarity=None):
+    self.params = params
+    self.clustering_params = clustering_params
+    self.similarity = similarity
+    self.finalize_method = finalize_method
+    self.result = None
+    self.incremental = None
+    self.n_experiments = 0
+    self.n_stable = 0
+    self.members = None
+    self.unit_cell = None
+    self.crystal_models = None
+
+  def same_orientations(self, crystal_models):
+    ''' True if there are as many consensus models as at the previous update and each of them
+        is within orientation_tolerance degrees of one of the previous models '''
+    if self.crystal_models is None or len(crystal_models) != len(self.crystal_models):
+      return False
+    from dials.algorithms.indexing.compare_orientation_matrices import difference_rotation_matrix_axis_angle
+    for cryst_b in crystal_models:
+      close = False
+      for cryst_a in self.crystal_models:
+        try:
+          R_ab, axis, angle, cb_op_ab = difference_rotation_matrix_axis_angle(cryst_a, cryst_b)
+        except Exception:
+          continue
+        if abs(angle) <= self.params.orientation_tolerance: # degrees
+          close = True
+          break
+      if not close:
+        return False
+    return True
+
+  def batches(self, ntrials):
+    ''' (first_trial, n_trials) of each batch '''
+    batches = []
+    first_trial = 0
+    n = min(ntrials, max(self.params.min_trials, self.params.batch_size))
+    while n > 0:
+      batches.append((first_trial, n))
+      first_trial += n
+      n = min(ntrials - first_trial, self.params.batch_size)
+    return batches
+
+  def update(self, experiments_list):
+    if len(experiments_list) == 0:
+      return False
+    if self.incremental is None:
+      from exafel_project.ADSE13_25.clustering.incremental_consensus import incremental_consensus
+      self.incremental = incremental_consensus(clustering_params=self.clustering_params,
+                                               similarity=self.similarity)
+    # experiments_list only grows between updates, the earlier trials are already in
+    for i in range(len(self.incremental), len(experiments_list)):
+      self.incremental.add(experiments_list[i])
+    self.result = self.incremental.consensus()
+    self.n_experiments = len(experiments_list)
+    crystal_models, clustered_experiments_list = self.result
+    if clustered_experiments_list is None:
+      self.n_stable = 0
+      self.members = None
+      self.crystal_models = None
+      return False
+    from collections import Counter
+    cluster_count = Counter([c for c in clustered_experiments_list if c >= 0])
+    if len(cluster_count) == 0:
+      self.n_stable = 0
+      self.members = None
+      self.crystal_models = None
+      return False
+    dominant = cluster_count.most_common(1)[0][0]
+    members = set([i for i, c in enumerate(clustered_experiments_list) if c == dominant])
+    unit_cell = crystal_models[dominant].get_unit_cell().parameters()
+    stable = False
+    if self.members is not None:
+      kept = len(self.members & members)/len(self.members)
+      cell_change = max([abs(p - q)/abs(q) for p, q in zip(unit_cell, self.unit_cell)])
+      stable = kept >= self.params.membership_tolerance and cell_change <= self.params.unit_cell_tolerance \
+               and self.same_orientations(crystal_models)
+    if stable:
+      self.n_stable += 1
+    else:
+      self.n_stable = 0
+    self.members = members
+    self.unit_cell = unit_cell
+    self.crystal_models = list(crystal_models)
+    return self.n_stable >= self.params.n_stable
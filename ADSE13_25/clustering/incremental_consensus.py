@@ -0,0 +1,246 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import numpy as np
+
+#
+# Incremental version of get_uc_consensus for IOTA trials that arrive one at a time. The
+# batch function rebuilds every CellOnlyFrame, the full NCDist_flatten matrix and the pairwise
+# orientational distances each time it is called, so checking the consensus after every
+# batch of trials costs O(N^2) NCDist evaluations per check. Here a new crystal model only
+# adds one row of NCDist distances, i.e. N NCDist calls, and the density peak quantities of
+# Rodriguez_Laio_clustering_2014 are updated in place:
+#   rho    only the points closer than d_c to the new point gain 1
+#   delta  rho only increases, so a point whose rho did not change can only gain points that
+#          come before it in rho_order (the ones whose rho increased), never lose one. Its delta
+#          is the minimum of the old delta and the distances to the gained points. The points
+#          whose rho increased and the new point are searched again over their whole row
+# d_c is estimated with estimate_d_c on the current matrix, like get_uc_consensus does. When
+# the estimate changes rho and delta are rebuilt from the stored distances, without any new
+# NCDist call. Orientational distances are computed once per pair of models that end up in
+# the same unit cell cluster and kept for later checks, the transformations behind them stay
+# in the similarity_transformations of the models for the realignment in union_and_reindex. consensus() returns the same result
+# as get_uc_consensus on the same list of models.
+#
+
+class incremental_density_peaks(object):
+  ''' NCDist distance matrix of a growing set of unit cells with the rho, delta and nearest
+      neighbors of Rodriguez_Laio_clustering_2014 kept up to date for d_c '''
+  def __init__(self, capacity=16):
+    self.n = 0
+    self.d_c = None
+    self.g6 = []
+    self.D = np.zeros((capacity, capacity))
+    self.rho = np.zeros(capacity, dtype=np.int64)
+    # delta and nearest neighbor among the points earlier in rho_order, inf and -1 for the
+    # first point of rho_order
+    self.delta = np.full(capacity, np.inf)
+    self.nearest_neighbor = np.full(capacity, -1, dtype=np.int64)
+    self.rank = np.zeros(capacity, dtype=np.int64)
+    self.n_rebuilds = 0
+
+  def _grow(self):
+    capacity = 2*len(self.D)
+    D = np.zeros((capacity, capacity))
+    D[:self.n, :self.n] = self.D[:self.n, :self.n]
+    self.D = D
+    def grown(array, fill):
+      new = np.full(capacity, fill, dtype=array.dtype)
+      new[:len(array)] = array
+      return new
+    self.rho = grown(self.rho, 0)
+    self.delta = grown(self.delta, np.inf)
+    self.nearest_neighbor = grown(self.nearest_neighbor, -1)
+    self.rank = grown(self.rank, 0)
+
+  def rho_order(self):
+    ''' Same order as flex.sort_permutation(rho, reverse=True) '''
+    return np.argsort(-self.rho[:self.n], kind='mergesort')
+
+  def add(self, mm):
+    ''' Add the unit cell with metrical matrix mm (CellOnlyFrame.mm) '''
+    from cctbx.uctbx.determine_unit_cell import NCDist
+    from exafel_project.ADSE13_25.clustering.sparse_density_peaks import g6_embedding
+    g6 = g6_embedding(mm)[0].tolist()
+    row = np.array([NCDist(g6, other) for other in self.g6])
+    if self.n == len(self.D):
+      self._grow()
+    k = self.n
+    self.g6.append(g6)
+    self.D[k, :k] = row
+    self.D[:k, k] = row
+    self.D[k, k] = 0.0
+    self.n += 1
+    if self.d_c is None:
+      return
+    close = np.flatnonzero(row < self.d_c)
+    self.rho[close] += 1
+    self.rho[k] = 1 + len(close)
+    self.rank[self.rho_order()] = np.arange(self.n)
+    increased = np.append(close, k)
+    unchanged = np.setdiff1d(np.arange(k), close)
+    self._update_delta(unchanged, increased)
+    self._update_delta(increased, np.arange(self.n), replace=True)
+
+  def _update_delta(self, rows, columns, replace=False):
+    ''' delta and nearest neighbor of rows from the points of columns that come before them in
+        rho_order. The nearest point wins, ties go to the earliest in rho_order. With replace
+        the old values are discarded, otherwise they are only improved '''
+    if len(rows) == 0 or len(columns) == 0:
+      return
+    rank = self.rank[:self.n]
+    distances = self.D[np.ix_(rows, columns)]
+    earlier = rank[columns][None, :] < rank[rows][:, None]
+    distances = np.where(earlier, distances, np.inf)
+    best = distances.min(axis=1)
+    tied_rank = np.where(earlier & (distances == best[:, None]), rank[columns][None, :], self.n)
+    best_rank = tied_rank.min(axis=1)
+    best_j = columns[tied_rank.argmin(axis=1)]
+    if replace:
+      better = np.ones(len(rows), dtype=bool)
+    else:
+      old = self.delta[rows]
+      old_rank = np.where(self.nearest_neighbor[rows] >= 0, rank[self.nearest_neighbor[rows]], self.n)
+      better = (best < old) | ((best == old) & (best_rank < old_rank))
+    found = np.isfinite(best)
+    self.delta[rows] = np.where(better, best, self.delta[rows])
+    self.nearest_neighbor[rows] = np.where(better, np.where(found, best_j, -1), self.nearest_neighbor[rows])
+
+  def set_d_c(self, d_c):
+    ''' Use d_c from now on. rho and delta are rebuilt from the stored distances if it changed '''
+    if d_c == self.d_c:
+      return
+    self.d_c = d_c
+    self.n_rebuilds += 1
+    self.rho[:self.n] = (self.D[:self.n, :self.n] < d_c).sum(axis=1)
+    self.rank[self.rho_order()] = np.arange(self.n)
+    all_points = np.arange(self.n)
+    self._update_delta(all_points, all_points, replace=True)
+
+  def density_peaks(self):
+    ''' precomputed_density_peaks for clustering_manager '''
+    from exafel_project.ADSE13_25.clustering.sparse_density_peaks import precomputed_density_peaks
+    assert self.d_c is not None, 'set_d_c has to be called first'
+    rho_order = self.rho_order()
+    delta = self.delta[:self.n].copy()
+    nearest_neighbor = self.nearest_neighbor[:self.n].copy()
+    delta_i_max = float(self.D[rho_order[0], :self.n].max())
+    delta[rho_order[0]] = delta_i_max
+    nearest_neighbor[rho_order[0]] = rho_order[0]
+    return precomputed_density_peaks(self.rho[:self.n].copy(), delta, nearest_neighbor,
+                                     [int(i) for i in rho_order], delta_i_max)
+
+class incremental_consensus(object):
+  '''
+  Consensus of a growing list of single crystal experiments, e.g. the IOTA trials of an event
+  added as they finish. consensus() can be called at any moment and returns what
+  get_uc_consensus(experiments_list) would return for the models added so far. similarity is
+  the similarity_transformations the models are added to, an empty one by default.
+  '''
+  def __init__(self, clustering_params=None, similarity=None):
+    from exafel_project.ADSE13_25.clustering.consensus_functions import clustering_iota_scope
+    if clustering_params is None:
+      clustering_params = clustering_iota_scope.extract().clustering
+    self.clustering_params = clustering_params
+    self.experiments_list = []
+    self.density = incremental_density_peaks()
+    if similarity is None:
+      from exafel_project.ADSE13_25.orientation.similarity_cache import similarity_transformations
+      similarity = similarity_transformations()
+    self.similarity = similarity
+    self.orientation_distances = {}
+    self.result = None
+
+  def __len__(self):
+    return len(self.experiments_list)
+
+  def add(self, experiment):
+    ''' Add one experiment, only its first crystal model is used '''
+    from xfel.clustering.singleframe import CellOnlyFrame
+    if len(experiment.crystals()) >1: print ('IOTA:Should have only one crystal model')
+    crystal = experiment.crystals()[0]
+    self.density.add(CellOnlyFrame(crystal.get_crystal_symmetry()).mm)
+    self.experiments_list.append(experiment)
+    self.similarity.extend_to(self.experiments_list)
+    self.result = None
+
+  def extend(self, experiments_list):
+    for experiment in experiments_list:
+      self.add(experiment)
+
+  def orientation_distance_matrix(self, members):
+    ''' Dij_ori of the models with indices members (increasing), as get_uc_consensus '''
+    from exafel_project.ADSE13_25.clustering.orientation_distance import model_distance
+    from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances
+    n = len(members)
+    values = []
+    for a in range(n-1):
+      for b in range(a+1, n):
+        key = (members[a], members[b])
+        if key not in self.orientation_distances:
+          self.orientation_distances[key] = model_distance(self.similarity, members[a], members[b])
+        values.append(self.orientation_distances[key])
+    return condensed_distances(n, values)
+
+  def consensus(self):
+    ''' (crystal models, cluster of each experiment) as returned by get_uc_consensus '''
+    if self.result is not None:
+      return self.result
+    self.result = self._consensus()
+    return self.result
+
+  def _consensus(self):
+    from scitbx.array_family import flex
+    from collections import Counter
+    from exafel_project.ADSE13_25.clustering.consensus_functions import clustering_manager, estimate_d_c, \
+      prune_close_models
+    experiments_list = self.experiments_list
+    clustering_params = self.clustering_params
+    NN = len(experiments_list)
+    print('There are %d cells'%NN)
+    d_c = estimate_d_c(self.density.D[:NN, :NN])
+    print ('d_c = ',d_c)
+    if NN < 5:
+      return [experiments_list[0].crystals()[0]], None
+    self.density.set_d_c(d_c)
+    CM = clustering_manager(density_peaks=self.density.density_peaks(), d_c=d_c, Z_delta=clustering_params.Z_delta, strategy='strategy_3')
+    n_cluster = 1+flex.max(CM.cluster_id_final)
+    print (NN, ' datapoints have been analyzed')
+    print ('%d CLUSTERS'%n_cluster)
+
+    # Orientational clustering of each unit cell cluster, in the order of get_uc_consensus
+    clustered_experiments_list = flex.int(NN, -1)
+    dxtbx_crystal_models = []
+    uc_cluster_count = Counter(list(CM.cluster_id_final))
+    CM_mapping = {}
+    for i in range(NN):
+      CM_mapping.setdefault(CM.cluster_id_full[i], []).append(i)
+    Dij_ori = {}
+    for cluster in uc_cluster_count:
+      if uc_cluster_count[cluster] < clustering_params.min_datapts:
+        continue
+      Dij_ori[cluster] = self.orientation_distance_matrix(CM_mapping[cluster])
+    for cluster in Dij_ori:
+      d_c_ori = estimate_d_c(Dij_ori[cluster])
+      print ('d_c_ori=',d_c_ori)
+      CM_ori = clustering_manager(Dij=Dij_ori[cluster], d_c=d_c_ori, Z_delta=clustering_params.Z_delta, strategy='strategy_3')
+      n_cluster_ori = 1+flex.max(CM_ori.cluster_id_final)
+      for i in range(n_cluster_ori):
+        if len([zz for zz in CM_ori.cluster_id_final if zz == i]) < clustering_params.min_datapts:
+          continue
+        item = flex.first_index(CM_ori.cluster_id_maxima, i)
+        dxtbx_crystal_models.append(experiments_list[CM_mapping[cluster][item]].crystals()[0])
+        for j,ori_cluster_id in enumerate(CM_ori.cluster_id_final):
+          if ori_cluster_id == i:
+            clustered_experiments_list[CM_mapping[cluster][j]] = len(dxtbx_crystal_models)-1
+    # Same pruning of close models as get_uc_consensus
+    if len(dxtbx_crystal_models) > 10000:
+      dxtbx_crystal_models = prune_close_models(dxtbx_crystal_models, clustered_experiments_list, 5.0,
+                                                similarity=self.similarity)
+    if len(dxtbx_crystal_models) > 0:
+      return dxtbx_crystal_models, list(clustered_experiments_list)
+    # If nothing works, atleast return the 1st crystal model that was found
+    return [experiments_list[0].crystals()[0]], None
+
+  def show_summary(self, rank=0):
+    print('IOTA_INCREMENTAL_CONSENSUS rank %d %d models, %d d_c rebuilds, %d orientational distances'%(
+      rank, len(self), self.density.n_rebuilds, len(self.orientation_distances)))
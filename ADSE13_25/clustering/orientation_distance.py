@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+
+#
+# Pairwise orientational distances for the orientational clustering of get_uc_consensus.
+# The distance between two crystal models is the difference Z-score of their orientations
+# after the second one is brought onto the first by best_similarity_transformation (see
+# get_dij_ori). The engine works on a subset of the models of an
+# orientation.similarity_cache.similarity_transformations, which builds the
+# crystal_orientation of every model once and caches the transformations on the model
+# indices for the later pruning and realignment steps. Only the upper triangle i < j is
+# evaluated and the distances are kept in a condensed 1-d array of n*(n-1)/2 values. The
+# pairs can be split over forked worker processes, which inherit the orientations and the
+# cache from the parent so only row ranges, distances and the new transformations travel
+# between processes.
+#
+
+def orientation_distance(ori1, ori2):
+  ''' Distance between two crystal_orientation objects, as get_dij_ori '''
+  try:
+    best_similarity_transform = ori2.best_similarity_transformation(
+        other = ori1, fractional_length_tolerance = 50.00,
+        unimodular_generator_range=1)
+    ori2_best = ori2.change_basis(best_similarity_transform)
+  except Exception as e:
+    ori2_best = ori2
+  return ori1.difference_Z_score(ori2_best)
+
+def model_distance(similarity, i, j):
+  ''' orientation_distance of the models i and j of a similarity_transformations '''
+  try:
+    ori_j_best = similarity.aligned(i, j, 50.00)
+  except Exception as e:
+    ori_j_best = similarity.orientations[j]
+  return similarity.orientations[i].difference_Z_score(ori_j_best)
+
+def condensed_index(i, j, n):
+  ''' Position of the pair i < j in a condensed array of n points '''
+  return i*n - i*(i+1)//2 + (j-i-1)
+
+# Set by orientational_distance_engine.condensed right before the worker processes are forked
+_worker_engine = None
+
+def _distances_of_rows_in_worker(rows):
+  similarity = _worker_engine.similarity
+  similarity.recorded = []
+  hits = similarity.hits
+  distances = _worker_engine.distances_of_rows(rows[0], rows[1])
+  return distances, similarity.recorded, similarity.hits - hits
+
+class orientational_distance_engine(object):
+  ''' Pairwise orientational distances of the models indices (increasing, all models by
+      default) of similarity, a similarity_transformations shared by the engines of several
+      subsets '''
+  def __init__(self, similarity, indices=None):
+    self.similarity = similarity
+    if indices is None:
+      indices = list(range(len(similarity)))
+    self.indices = indices
+    self.n = len(indices)
+
+  def distances_of_rows(self, first_row, last_row):
+    ''' Distances of the pairs (i,j) with first_row <= i < last_row and j > i, in condensed
+        order '''
+    distances = []
+    for i in range(first_row, last_row):
+      model_i = self.indices[i]
+      for j in range(i+1, self.n):
+        distances.append(model_distance(self.similarity, model_i, self.indices[j]))
+    return distances
+
+  def row_blocks(self, n_blocks):
+    ''' Split the rows in n_blocks consecutive ranges holding about the same number of pairs '''
+    n_pairs = self.n*(self.n-1)//2
+    blocks = []
+    first_row = 0
+    pairs_so_far = 0
+    for block in range(n_blocks):
+      target = (block+1)*n_pairs/n_blocks
+      last_row = first_row
+      while last_row < self.n-1 and pairs_so_far < target:
+        pairs_so_far += self.n-1-last_row
+        last_row += 1
+      if last_row > first_row:
+        blocks.append((first_row, last_row))
+      first_row = last_row
+    return blocks
+
+  def condensed(self, nproc=1):
+    ''' flex.double of the n*(n-1)/2 distances, pair (i,j) at condensed_index(i,j,n) '''
+    from scitbx.array_family import flex
+    import multiprocessing
+    # Daemonic processes, e.g. the workers of the trial runner, cannot fork workers of their own
+    if nproc <= 1 or self.n < 3 or multiprocessing.current_process().daemon:
+      return flex.double(self.distances_of_rows(0, self.n-1))
+    global _worker_engine
+    _worker_engine = self
+    pool = multiprocessing.Pool(processes=nproc)
+    try:
+      blocks = pool.map(_distances_of_rows_in_worker, self.row_blocks(nproc))
+      pool.close()
+      pool.join()
+    except BaseException:
+      pool.terminate()
+      pool.join()
+      raise
+    finally:
+      _worker_engine = None
+    condensed = flex.double()
+    for distances, recorded, hits in blocks:
+      condensed.extend(flex.double(distances))
+      self.similarity.update(recorded, hits)
+    return condensed
+
+  def condensed_matrix(self, nproc=1):
+    ''' condensed_distances (float32 upper triangle) of the distances '''
+    from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances
+    return condensed_distances(self.n, self.condensed(nproc=nproc))
@@ -4,59 +4,6 @@ import sys
 from scitbx.simplex import simplex_opt
 import scitbx.lbfgs
 
-class lbfgs_helper():
-  def __init__(self, x_obs, y_obs, w_obs, initial):
-    assert x_obs.size() == y_obs.size()
-    self.x_obs = x_obs
-    self.y_obs = y_obs
-    self.w_obs = w_obs
-    self.n = len(initial)
-    self.NN = len(initial)//2
-    self.x = initial.deep_copy()
-    self.minimizer = scitbx.lbfgs.run(target_evaluator=self,
-                     termination_params = scitbx.lbfgs.termination_parameters
-                     (traditional_convergence_test_eps=1.e-2, min_iterations=0), core_params =
-                     scitbx.lbfgs.core_parameters(gtol=0.1), log=sys.stdout)
-    self.a = self.x
-
-  def compute_functional_and_gradients(self):
-    self.a = self.x
-    f,g = self.target_func_and_grad()
-    return f,g
-
-  def target_func_and_grad(self):
-    from scitbx.array_family import flex
-    import math
-    coord_x = self.x[0:self.NN]
-    coord_y = self.x[self.NN:2*self.NN]
-    outer_coord_x = coord_x.matrix_outer_product(coord_x)
-    outer_coord_y = coord_y.matrix_outer_product(coord_y)
-    inner = self.y_obs-outer_coord_x-outer_coord_y
-    elements = inner*inner
-    result = flex.sum(elements)
-
-    grad = -2.*inner.matrix_multiply(coord_x)
-    grad = grad.concatenate(-2.*inner.matrix_multiply(coord_y))
-
-    return result,grad
-    # ------- Original Implementation :: Super slow ------------------
-    # Note that plotting should change since here we assume self.x is [x1,y1,x2,y2, .....]
-    #grad = flex.double(self.n)
-    #result = 0.0
-    #NN = self.x.size()//2
-    #for i in range(0,NN-1):
-    #  for j in range(i+1,NN):
-    #    dx = self.x[i]-self.x[j]
-    #    dy = self.x[i+NN]-self.x[j+NN]
-    #    d = math.sqrt(dx*dx+dy*dy)
-    #    y_diff = 1-self.y_obs[(i*NN)+(j)]-d
-    #    grad[i] += -2*y_diff*(self.x[i]-self.x[j])/d
-    #    grad[i+NN] += -2*y_diff*(self.x[i+NN]-self.x[j+NN])/d
-    #    #grad[i+NN] += -2*y_diff*self.x[j+1]
-    #    result += y_diff*y_diff
-    #return result,grad
-    # -------------- End original implementation ----------------------
-
 class SimplexMinimizer(object):
   def __init__(self, r, x, seed=None, plot=False):
     from dials.array_family import flex
@@ -77,40 +24,182 @@ class SimplexMinimizer(object):
     self.x = self.optimizer.get_solution()
 
   def target(self, vector):
-    f2 = 0.0
+    # Same phi as embedding_engine, vector is [x1,y1,x2,y2, .....]
+    import numpy as np
     NN = self.r.focus()[0]
-    for i in range(0,len(vector)-2,2):
-      for j in range(i+2, len(vector),2):
-
-        #from IPython import embed; embed(); exit()
-        f= self.r[(i//2)*NN+(j//2)] - (vector[i]*vector[j]+vector[i+1]*vector[j+1])
-        f2 += f*f
+    if not hasattr(self, 'r_upper'):
+      self.upper = np.triu_indices(NN, k=1)
+      self.r_upper = np.fromiter(self.r.as_1d(), dtype=np.float64, count=NN*NN).reshape(NN, NN)[self.upper]
+    X = np.array(vector).reshape(NN, 2)
+    f = self.r_upper - X.dot(X.T)[self.upper]
+    f2 = (f*f).sum()
     print ('inside target = %d'%f2)
     return f2
 
 
-def plot_with_dimensional_embedding(r, show_plot=True, use_lbfgs=True):
+class embedding_engine(object):
+  '''
+  Brehm & Diederichs (2014) embedding with a vectorized objective and gradient,
+  phi = sum_{i<j} (r_ij - x_i.x_j)^2 over the off diagonal pairs, x_i in n_dim dimensions.
+  r is a square numpy array or flex.double, or a condensed_distances, in which case
+  r_ij = 1 - d_ij/max(d) is evaluated one block of rows at a time. Every evaluation works
+  on blocks of block_size rows so memory stays O(block_size*N).
+  Two minimizers:
+    lbfgs     : scitbx.lbfgs on the full objective, for up to a few thousand points
+    minibatch : for large N. The rows are visited in random batches of batch_size. With the
+                other points fixed, phi is quadratic in x_i, so every x_i of a batch is set to
+                its least squares optimum, (sum_j x_j x_j^T)^-1 sum_j r_ij x_j
+  A previous embedding can be passed as initial (warm start). If it has fewer points than r
+  the new points are placed at their least squares optimum given the old ones.
+  '''
+  def __init__(self, r, n_dim=2, block_size=1024, seed=22):
+    import numpy as np
+    from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances
+    self.n_dim = n_dim
+    self.block_size = block_size
+    self.seed = seed
+    if isinstance(r, condensed_distances):
+      self.distances = r
+      self.distance_scale = r.max() if r.max() > 0 else 1.0
+      self.r = None
+      self.n = r.n
+    else:
+      if hasattr(r, 'focus'):
+        n = r.focus()[0]
+        r = np.fromiter(r.as_1d(), dtype=np.float64, count=n*n).reshape(n, n)
+      self.r = np.asarray(r, dtype=np.float64)
+      assert self.r.shape[0] == self.r.shape[1], 'r matrix has to be square'
+      self.n = self.r.shape[0]
+
+  def similarity_rows(self, rows):
+    ''' r[rows,:] as a (len(rows), N) array '''
+    import numpy as np
+    if self.r is not None:
+      return self.r[rows]
+    return 1.0 - np.array([self.distances.row(i) for i in rows])/self.distance_scale
+
+  def _row_blocks(self):
+    import numpy as np
+    for start in range(0, self.n, self.block_size):
+      yield np.arange(start, min(self.n, start + self.block_size))
+
+  def functional_and_gradient(self, X):
+    ''' phi and its (N,n_dim) gradient at the (N,n_dim) embedding X '''
+    import numpy as np
+    f = 0.0
+    g = np.zeros_like(X)
+    for rows in self._row_blocks():
+      residual = self.similarity_rows(rows) - X[rows].dot(X.T)
+      residual[np.arange(len(rows)), rows] = 0.0
+      # Every pair appears in two rows
+      f += 0.5*(residual*residual).sum()
+      g[rows] = -2.0*residual.dot(X)
+    return f, g
+
+  def functional(self, X):
+    return self.functional_and_gradient(X)[0]
+
+  def _least_squares_rows(self, X, rows, columns=None):
+    ''' Optimum x_i for the rows given the points of columns (all by default, the diagonal
+        term of each row left out) '''
+    import numpy as np
+    r = self.similarity_rows(rows)
+    if columns is not None:
+      r = r[:, columns]
+      Xc = X[columns]
+    else:
+      Xc = X
+    G = np.repeat(Xc.T.dot(Xc)[None], len(rows), axis=0)
+    b = r.dot(Xc)
+    if columns is None:
+      Xi = X[rows]
+      G -= Xi[:,:,None]*Xi[:,None,:]
+      b -= r[np.arange(len(rows)), rows][:,None]*Xi
+    # Small ridge for degenerate starting points
+    ridge = 1.e-12*max(np.trace(Xc.T.dot(Xc)), 1.0)
+    return np.linalg.solve(G + ridge*np.eye(self.n_dim)[None], b[:,:,None])[:,:,0]
+
+  def initial_embedding(self, initial=None):
+    ''' (N,n_dim) starting point, random or warm started from a previous embedding '''
+    import numpy as np
+    rng = np.random.RandomState(self.seed)
+    if initial is None:
+      return rng.uniform(-0.5, 0.5, size=(self.n, self.n_dim))
+    initial = np.asarray(initial, dtype=np.float64).reshape(-1, self.n_dim)
+    if len(initial) >= self.n:
+      return initial[:self.n].copy()
+    X = np.zeros((self.n, self.n_dim))
+    X[:len(initial)] = initial
+    new = np.arange(len(initial), self.n)
+    X[new] = self._least_squares_rows(X, new, columns=np.arange(len(initial)))
+    return X
+
+  def minimize_minibatch(self, X, batch_size=256, max_epochs=50, tolerance=1.e-4):
+    import numpy as np
+    rng = np.random.RandomState(self.seed)
+    f = self.functional(X)
+    for epoch in range(max_epochs):
+      X_previous = X.copy()
+      order = rng.permutation(self.n)
+      for start in range(0, self.n, batch_size):
+        rows = order[start:start+batch_size]
+        X[rows] = self._least_squares_rows(X, rows)
+      f_new = self.functional(X)
+      # The rows of a batch are updated together from the old positions of each other, so an
+      # epoch can make phi worse. Keep the last embedding that improved it
+      if f_new > f:
+        print ('Embedding: phi went up from %.6g to %.6g in epoch %d, keeping the previous embedding'%(f, f_new, epoch))
+        return X_previous
+      converged = f - f_new <= tolerance*max(f, 1.e-12)
+      f = f_new
+      if converged:
+        break
+    return X
+
+  def minimize_lbfgs(self, X):
+    from scitbx.array_family import flex
+    engine = self
+    class target_evaluator(object):
+      def __init__(self):
+        self.x = flex.double(X.ravel())
+      def compute_functional_and_gradients(self):
+        f, g = engine.functional_and_gradient(self.x.as_numpy_array().reshape(-1, engine.n_dim))
+        return f, flex.double(g.ravel())
+    evaluator = target_evaluator()
+    scitbx.lbfgs.run(target_evaluator=evaluator,
+                     termination_params=scitbx.lbfgs.termination_parameters(
+                       traditional_convergence_test_eps=1.e-4, min_iterations=0))
+    return evaluator.x.as_numpy_array().reshape(-1, self.n_dim)
+
+  def minimize(self, initial=None, method=None, max_lbfgs_points=2000, **kwargs):
+    ''' (N,n_dim) embedding. method is lbfgs or minibatch, by default lbfgs up to
+        max_lbfgs_points points '''
+    X = self.initial_embedding(initial)
+    if method is None:
+      method = 'lbfgs' if self.n <= max_lbfgs_points else 'minibatch'
+    if method == 'lbfgs':
+      return self.minimize_lbfgs(X)
+    return self.minimize_minibatch(X, **kwargs)
+
+def plot_with_dimensional_embedding(r, show_plot=True, use_lbfgs=True, initial=None):
   '''
   Plots a high dimensional vector in a 2-d plane using the idea from Diedrichs and Brehms (2014)
   Equation to be minimized is phi = \sum[(rij-xi.xj)^2]
   r = distance metric used. Should be 1-normalized_distance_matrix
+  Returns the (N,2) embedding, which can be passed back as initial to warm start the next one.
+  use_lbfgs=False uses the original simplex minimizer
   '''
   #
   from scitbx.math import flex
-  assert r.focus()[0] == r.focus()[1], 'r matrix has to be square'
-  x = []
-  flex.set_random_seed(22)
-
-  x = flex.random_double(2*r.focus()[0])
-  flex.set_random_seed(22)
   if use_lbfgs:
-    print 'Starting LBFGS'
-    w_obs = flex.double([1.0]*(r.size()))
-    fit = lbfgs_helper(x_obs=r, y_obs=r, w_obs=w_obs,initial=x)
-    x = fit.x
-    xx = x[0:r.focus()[0]]
-    yy = x[r.focus()[0]:2*r.focus()[0]]
+    print ('Starting embedding')
+    x = embedding_engine(r, n_dim=2).minimize(initial=initial)
+    xx = list(x[:,0])
+    yy = list(x[:,1])
   else:
+    assert r.focus()[0] == r.focus()[1], 'r matrix has to be square'
+    flex.set_random_seed(22)
+    x = flex.random_double(2*r.focus()[0])
     x = SimplexMinimizer(r,x,seed=22).x
     xx = []
     yy = []
@@ -127,6 +216,8 @@ def plot_with_dimensional_embedding(r, show_plot=True, use_lbfgs=True):
     #plt.xlim([-1,1])
     #plt.ylim([-1,1])
     plt.show()
+  import numpy as np
+  return np.column_stack((xx, yy))
 
 def run_detail(show_plot, save_plot, use_dummy_data=False):
     file_name = sys.argv[1]
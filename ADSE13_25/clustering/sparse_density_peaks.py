@@ -0,0 +1,194 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import numpy as np
+
+#
+# Sparse version of the density peak quantities of Rodriguez_Laio_clustering_2014 for data
+# sets where the dense N x N distance matrix does not fit in memory (dataset level unit cell
+# clustering with 10^5-10^6 cells). The points are given as coordinates in a metric
+# embedding (e.g. g6_embedding of the unit cells) with Euclidean distances. The definitions
+# are the ones of the dense code:
+#   rho_i   number of points j (i included) with d_ij < d_c
+#   delta_i distance to the nearest point that comes before i in rho_order (decreasing rho,
+#           ties in index order), delta_i_max for the first point of rho_order
+#   nearest neighbor of i: that nearest point, which cluster_assignment propagates the
+#           cluster id from
+# rho comes from a radius count on a k-d tree and delta from the k nearest neighbors of each
+# point. The few points whose k nearest neighbors all come later in rho_order (density
+# peaks and isolated points) fall back to an exact search over the earlier points. Memory
+# is linear in N. The k-d tree is scipy.spatial.cKDTree, without scipy the same quantities
+# are computed by brute force over blocks of rows, which is exact and still linear in
+# memory, but quadratic in time.
+# With g6_embedding this is an approximation of the dense path: NCDist is the shortest
+# G6 distance over the paths through the Niggli reduction boundaries, so it equals the
+# Euclidean G6 distance of the reduced cells unless the cells are close to a boundary, and
+# is never larger. Near a boundary the sparse rho can only be smaller and cells on both
+# sides can end up in different clusters. On lysozyme100.txt and lysozyme1341.txt the two
+# distances agree to 1e-12 and the sparse mode gives the same rho, cluster centers and
+# assignments as the dense path (checked by benchmark_clustering.py, compare_sparse_mode).
+#
+
+def g6_embedding(metrical_matrices):
+  ''' (N,6) array of G6 vectors (a^2, b^2, c^2, 2bc cos(alpha), 2ac cos(beta), 2ab cos(gamma))
+      from the cctbx metrical matrices (a^2, b^2, c^2, ab cos(gamma), ac cos(beta), bc cos(alpha))
+      of the cells, e.g. CellOnlyFrame.mm. Euclidean distances between G6 vectors of reduced
+      cells are an upper bound of the NCDist distance used by the dense path, equal to it away
+      from the Niggli reduction boundaries '''
+  mm = np.asarray(metrical_matrices, dtype=np.float64).reshape(-1, 6)
+  return np.column_stack((mm[:,0], mm[:,1], mm[:,2], 2*mm[:,5], 2*mm[:,4], 2*mm[:,3]))
+
+def _as_flex_int(array):
+  from scitbx.array_family import flex
+  return flex.int(np.ascontiguousarray(array, dtype=np.int32))
+
+def _as_flex_double(array):
+  from scitbx.array_family import flex
+  return flex.double(np.ascontiguousarray(array, dtype=np.float64))
+
+class sparse_density_peaks(object):
+  ''' Drop-in replacement of Rodriguez_Laio_clustering_2014 for clustering_manager working on
+      point coordinates instead of a distance matrix. k is the number of nearest neighbors
+      searched for delta, block_size the number of rows per block in brute force mode '''
+  def __init__(self, points, d_c, k=32, block_size=1024):
+    self.points = np.ascontiguousarray(points, dtype=np.float64)
+    if self.points.ndim == 1:
+      self.points = self.points.reshape(-1, 1)
+    self.n = len(self.points)
+    self.d_c = d_c
+    self.k = max(1, min(k, self.n-1))
+    self.block_size = block_size
+    try:
+      from scipy.spatial import cKDTree
+      self.tree = cKDTree(self.points)
+    except ImportError:
+      print ("Module scipy not available. Sparse density peaks fall back to blockwise brute force")
+      self.tree = None
+    self.nearest_neighbor = None
+    self.n_exact_searches = 0
+
+  def distances_from(self, i, selection=None):
+    ''' Distances from point i to all points, or to the points in selection '''
+    points = self.points if selection is None else self.points[selection]
+    return np.sqrt(((points - self.points[i])**2).sum(axis=1))
+
+  def _blocks(self):
+    for start in range(0, self.n, self.block_size):
+      stop = min(self.n, start + self.block_size)
+      block = self.points[start:stop]
+      d2 = (block*block).sum(axis=1)[:,None] - 2.0*block.dot(self.points.T) + (self.points*self.points).sum(axis=1)[None,:]
+      yield start, stop, np.sqrt(np.maximum(d2, 0.0))
+
+  def get_rho(self):
+    ''' flex.int of the number of points closer than d_c to each point, itself included '''
+    if self.tree is not None:
+      # query_ball_point counts d <= r, the dense definition is d < d_c
+      radius = np.nextafter(self.d_c, 0.0)
+      rho = np.asarray(self.tree.query_ball_point(self.points, r=radius, return_length=True))
+    else:
+      rho = np.zeros(self.n, dtype=np.int64)
+      for start, stop, distances in self._blocks():
+        rho[start:stop] = (distances < self.d_c).sum(axis=1)
+    self.rho = rho
+    return _as_flex_int(rho)
+
+  def max_distance_from(self, i):
+    ''' Largest distance from point i, the delta_i_max of the dense path '''
+    return float(self.distances_from(i).max())
+
+  def _k_nearest(self):
+    ''' (N,k+1) indices and distances of the nearest points of every point, nearest first '''
+    if self.tree is not None:
+      distances, indices = self.tree.query(self.points, k=self.k+1)
+      return indices.reshape(self.n, -1), distances.reshape(self.n, -1)
+    indices = np.zeros((self.n, self.k+1), dtype=np.int64)
+    nearest = np.zeros((self.n, self.k+1))
+    for start, stop, distances in self._blocks():
+      part = np.argpartition(distances, self.k, axis=1)[:, :self.k+1]
+      part_distances = np.take_along_axis(distances, part, axis=1)
+      order = np.argsort(part_distances, axis=1, kind='mergesort')
+      indices[start:stop] = np.take_along_axis(part, order, axis=1)
+      nearest[start:stop] = np.take_along_axis(part_distances, order, axis=1)
+    return indices, nearest
+
+  def get_delta(self, rho_order, delta_i_max):
+    ''' flex.double of delta for every point, see the module description '''
+    rho_order = np.fromiter(rho_order, dtype=np.int64, count=self.n)
+    rank = np.empty(self.n, dtype=np.int64)
+    rank[rho_order] = np.arange(self.n)
+    delta = np.zeros(self.n)
+    nearest_neighbor = np.arange(self.n)
+    if self.n > 1:
+      indices, distances = self._k_nearest()
+      # Among the neighbors coming earlier in rho_order take the nearest one, ties go to
+      # the earliest in rho_order as in the dense loop
+      earlier = rank[indices] < rank[:,None]
+      key = np.where(earlier, distances, np.inf)
+      tie_break = np.where(earlier, rank[indices], self.n)
+      rows = np.arange(self.n)
+      best = np.zeros(self.n, dtype=np.int64)
+      for column in range(1, key.shape[1]):
+        best_key = key[rows, best]
+        better = (key[:,column] < best_key) | \
+                 ((key[:,column] == best_key) & (tie_break[:,column] < tie_break[rows, best]))
+        best[better] = column
+      found = earlier[rows, best]
+      delta[found] = distances[found, best[found]]
+      nearest_neighbor[found] = indices[found, best[found]]
+      # Exact search for the points without an earlier point among their k nearest neighbors
+      for i in np.flatnonzero(~found):
+        if rank[i] == 0:
+          continue
+        self.n_exact_searches += 1
+        candidates = rho_order[:rank[i]]
+        candidate_distances = self.distances_from(i, candidates)
+        j = int(np.argmin(candidate_distances))
+        delta[i] = candidate_distances[j]
+        nearest_neighbor[i] = candidates[j]
+    delta[rho_order[0]] = delta_i_max
+    nearest_neighbor[rho_order[0]] = rho_order[0]
+    self.delta = delta
+    self.nearest_neighbor = nearest_neighbor
+    return _as_flex_double(delta)
+
+  def cluster_assignment(self, rho_order, cluster_id, rho):
+    ''' Give every point without a cluster id the id of its nearest neighbor, in rho order.
+        cluster_id (flex.int) is updated in place '''
+    assert self.nearest_neighbor is not None, 'get_delta has to be called first'
+    assign_to_nearest_neighbor(self.nearest_neighbor, rho_order, cluster_id)
+
+def assign_to_nearest_neighbor(nearest_neighbor, rho_order, cluster_id):
+  ''' cluster_assignment of Rodriguez_Laio_clustering_2014, cluster_id (flex.int) is updated
+      in place '''
+  n = len(nearest_neighbor)
+  ids = np.fromiter(cluster_id, dtype=np.int64, count=n)
+  for item_idx in rho_order:
+    if ids[item_idx] == -1:
+      ids[item_idx] = ids[nearest_neighbor[item_idx]]
+  for i in np.flatnonzero(ids != np.fromiter(cluster_id, dtype=np.int64, count=n)):
+    cluster_id[int(i)] = int(ids[i])
+
+class precomputed_density_peaks(object):
+  ''' rho, delta and nearest neighbors computed elsewhere, e.g. distributed over MPI ranks, in
+      the interface clustering_manager expects. delta and nearest_neighbor have to be computed
+      for rho_order = flex.sort_permutation(rho, reverse=True), with delta_i_max for its first
+      point '''
+  def __init__(self, rho, delta, nearest_neighbor, rho_order, delta_i_max):
+    self.n = len(rho)
+    self.rho = np.asarray(rho)
+    self.delta = np.asarray(delta, dtype=np.float64)
+    self.nearest_neighbor = np.asarray(nearest_neighbor, dtype=np.int64)
+    self.rho_order = list(rho_order)
+    self.delta_i_max = delta_i_max
+
+  def get_rho(self):
+    return _as_flex_int(self.rho)
+
+  def max_distance_from(self, i):
+    return self.delta_i_max
+
+  def get_delta(self, rho_order, delta_i_max):
+    assert list(rho_order) == self.rho_order, 'delta was computed for a different rho order'
+    return _as_flex_double(self.delta)
+
+  def cluster_assignment(self, rho_order, cluster_id, rho):
+    assign_to_nearest_neighbor(self.nearest_neighbor, rho_order, cluster_id)
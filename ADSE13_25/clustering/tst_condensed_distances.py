@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import numpy as np
+
+#
+# condensed_distances and condensed_density_peaks against a dense square matrix. The
+# distances are rounded so that ties in delta are exercised as well.
+# Usage: libtbx.python tst_condensed_distances.py
+#
+
+def random_square(n, seed=0):
+  ''' Symmetric n x n numpy distances with zero diagonal, from random points in 3-d '''
+  rng = np.random.RandomState(seed)
+  points = rng.uniform(0.0, 10.0, size=(n, 3))
+  square = np.sqrt(((points[:, None, :] - points[None, :, :])**2).sum(axis=2))
+  # float32 values, as condensed_distances stores them, rounded to get ties
+  return np.round(square, 1).astype(np.float32).astype(np.float64)
+
+def as_flex_square(square):
+  from scitbx.array_family import flex
+  n = len(square)
+  Dij = flex.double(square.ravel().tolist())
+  Dij.reshape(flex.grid(n, n))
+  return Dij
+
+def dense_delta(square, rho_order, delta_i_max):
+  ''' Distance of each point to the nearest point before it in rho_order, ties go to the
+      earliest in rho_order, from the square matrix '''
+  n = len(square)
+  delta = np.zeros(n)
+  nearest_neighbor = np.arange(n)
+  for rank in range(1, n):
+    i = rho_order[rank]
+    best = None
+    for j in rho_order[:rank]:
+      if best is None or square[i, j] < delta[i]:
+        best = j
+        delta[i] = square[i, j]
+    nearest_neighbor[i] = best
+  delta[rho_order[0]] = delta_i_max
+  return delta, nearest_neighbor
+
+def exercise_rows_and_histogram():
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances
+  for n in [1, 2, 7, 40]:
+    square = random_square(n, seed=n)
+    Dij = as_flex_square(square)
+    distances = condensed_distances.from_square(Dij)
+    assert distances.focus() == (n, n)
+    assert len(distances.values) == n*(n-1)//2
+    for i in range(n):
+      assert np.array_equal(distances.row(i), square[i])
+    assert distances.max() == square.max()
+    assert distances.min() == square.min()
+    assert list(distances.as_square()) == list(Dij)
+    for n_slots in [1, 10, 37]:
+      slots = distances.histogram(n_slots)
+      assert list(slots) == list(flex.histogram(Dij.as_1d(), n_slots=n_slots).slots())
+
+def exercise_density_peaks():
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.condensed_distances import condensed_distances, \
+    condensed_density_peaks
+  n = 60
+  square = random_square(n)
+  distances = condensed_distances.from_square(as_flex_square(square))
+  for d_c in [0.5, 2.0, 5.0]:
+    peaks = condensed_density_peaks(distances, d_c)
+    rho = peaks.get_rho()
+    assert list(rho) == list((square < d_c).sum(axis=1))
+    rho_order = flex.sort_permutation(rho, reverse=True)
+    delta_i_max = peaks.max_distance_from(rho_order[0])
+    assert delta_i_max == square[rho_order[0]].max()
+    delta = peaks.get_delta(rho_order=rho_order, delta_i_max=delta_i_max)
+    expected_delta, expected_nearest_neighbor = dense_delta(square, list(rho_order), delta_i_max)
+    assert np.array_equal(delta.as_numpy_array(), expected_delta)
+    assert np.array_equal(peaks.nearest_neighbor, expected_nearest_neighbor)
+
+if __name__ == '__main__':
+  exercise_rows_and_histogram()
+  exercise_density_peaks()
+  print('OK')
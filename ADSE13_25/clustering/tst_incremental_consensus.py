@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import os
+import numpy as np
+
+#
+# incremental_density_peaks against a rebuild from scratch. The unit cells of lysozyme100.txt
+# are added one at a time, with d_c set early and changed half way, and after every few cells
+# the incrementally updated distances, rho, delta and nearest neighbors are compared with a
+# new incremental_density_peaks holding the same cells, whose set_d_c computes everything
+# from the stored distances, and with NCDist_flatten of the same cells.
+# Usage: libtbx.python tst_incremental_consensus.py
+#
+
+def lysozyme_metrical_matrices():
+  ''' Metrical matrices of the Niggli cells of lysozyme100.txt, as CellOnlyFrame.mm '''
+  from exafel_project.ADSE13_25.clustering.benchmark_clustering import read_cells
+  here = os.path.dirname(os.path.abspath(__file__))
+  return [symmetry.niggli_cell().unit_cell().metrical_matrix()
+          for symmetry in read_cells(os.path.join(here, 'lysozyme100.txt'))]
+
+def rebuilt(metrical_matrices, d_c):
+  from exafel_project.ADSE13_25.clustering.incremental_consensus import incremental_density_peaks
+  density = incremental_density_peaks()
+  for mm in metrical_matrices:
+    density.add(mm)
+  density.set_d_c(d_c)
+  return density
+
+def ncdist_square(metrical_matrices):
+  from scitbx.array_family import flex
+  from cctbx.uctbx.determine_unit_cell import NCDist_flatten
+  MM_double = flex.double()
+  for mm in metrical_matrices:
+    MM_double.extend(flex.double(mm))
+  n = len(metrical_matrices)
+  return NCDist_flatten(MM_double).as_numpy_array().reshape(n, n)
+
+def assert_same_density_peaks(density, reference):
+  n = density.n
+  assert reference.n == n
+  assert np.array_equal(density.D[:n, :n], reference.D[:n, :n])
+  a = density.density_peaks()
+  b = reference.density_peaks()
+  assert np.array_equal(a.rho, b.rho)
+  assert a.rho_order == b.rho_order
+  assert np.array_equal(a.delta, b.delta)
+  assert np.array_equal(a.nearest_neighbor, b.nearest_neighbor)
+  assert a.delta_i_max == b.delta_i_max
+
+def exercise_incremental_density_peaks(check_every=7):
+  from exafel_project.ADSE13_25.clustering.incremental_consensus import incremental_density_peaks
+  from exafel_project.ADSE13_25.clustering.consensus_functions import estimate_d_c
+  metrical_matrices = lysozyme_metrical_matrices()
+  n_total = len(metrical_matrices)
+  square = ncdist_square(metrical_matrices)
+  d_c_first = estimate_d_c(square[:10, :10])
+  d_c_second = estimate_d_c(square)
+  assert d_c_first != d_c_second
+  density = incremental_density_peaks(capacity=4)
+  for k, mm in enumerate(metrical_matrices, 1):
+    density.add(mm)
+    if k == 10:
+      density.set_d_c(d_c_first)
+    elif k == n_total//2:
+      density.set_d_c(d_c_second)
+    if k < 10 or (k % check_every != 0 and k != n_total):
+      continue
+    assert np.allclose(density.D[:k, :k], square[:k, :k], rtol=0, atol=1.e-9)
+    assert np.array_equal(density.rho[:k], (density.D[:k, :k] < density.d_c).sum(axis=1))
+    assert_same_density_peaks(density, rebuilt(metrical_matrices[:k], density.d_c))
+  # Only the two set_d_c calls with a new d_c rebuilt rho and delta, the rest was incremental
+  assert density.n_rebuilds == 2
+
+if __name__ == '__main__':
+  exercise_incremental_density_peaks()
+  print('OK')
@@ -0,0 +1,359 @@
+from __future__ import absolute_import, print_function, division
+
+message = ''' Dataset level unit cell clustering. Streams the crystal models of all the
+refined_experiments.json files found under the input paths and clusters their unit cells with
+the Rodriguez-Laio density peak method of consensus_functions.clustering_manager, using the
+NCDist distance as get_uc_consensus does. The work is spread over MPI ranks (mpi=True) or
+forked processes (nproc), and the N x N distance matrix is never held by a single process.
+Task results go to rank 0 only; the other ranks just get the metrical matrices of the cells
+(6 doubles per cell) and the few per cell arrays their row blocks need:
+  row_blocks : exact. rho and delta are computed from blocks of distance matrix rows, every
+               row is computed twice (once for rho, once for delta) and then dropped
+  landmarks  : approximate. A random subset of n_landmarks cells is clustered with the dense
+               code, then every cell gets the cluster of its nearest landmark. Candidate
+               landmarks are preselected in G6 space, then compared with NCDist
+Writes <prefix>_assignments.txt (one line per crystal model) and <prefix>_centroids.txt
+(one line per cluster) to output.output_dir.
+Usage: libtbx.python cluster_unit_cells.py input_path=<dir> [input_path=<dir> ...] mpi=True
+'''
+
+import sys, os
+import numpy as np
+from libtbx.utils import Sorry
+from libtbx.phil import parse
+from exafel_project.ADSE13_25.command_line.indexing_analytics import params_from_phil
+
+cluster_unit_cells_phil_scope = parse('''
+  input_path = None
+    .multiple = True
+    .type = path
+    .help = Directories searched recursively for *refined_experiments*.json files. \
+            Can be given multiple times
+  mpi = False
+    .type = bool
+    .help = If True, spread the work over MPI ranks
+  nproc = 1
+    .type = int(value_min=1)
+    .help = Number of forked worker processes per rank if mpi is False
+  method = *row_blocks landmarks
+    .type = choice
+    .help = row_blocks: exact clustering of all cells from blocks of distance matrix rows. \
+            landmarks: cluster a random subset of cells and assign every cell to its nearest \
+            landmark
+  block_size = 64
+    .type = int(value_min=1)
+    .help = Number of distance matrix rows or cells per task
+  d_c = None
+    .type = float
+    .help = d_c of the density peak clustering. If None it is estimated with estimate_d_c on \
+            n_sample_d_c randomly chosen cells
+  n_sample_d_c = 1000
+    .type = int(value_min=2)
+    .help = Number of cells used to estimate d_c
+  seed = 0
+    .type = int
+    .help = Seed of the random choice of cells for the d_c estimate and the landmarks
+  landmarks {
+    n_landmarks = 2000
+      .type = int(value_min=2)
+      .help = Number of landmark cells
+    n_candidates = 8
+      .type = int(value_min=1)
+      .help = Number of nearest landmarks in G6 space compared with NCDist during assignment
+  }
+  clustering {
+    Z_delta = 2.0
+      .type = float
+      .help = cutoff for delta values used in clustering
+    strategy = default one_cluster *strategy_3
+      .type = choice
+      .help = Strategy of clustering_manager to pick the cluster centers
+  }
+  output {
+    output_dir = .
+      .type = path
+    prefix = uc_clustering
+      .type = str
+  }
+''')
+
+def find_experiment_files(roots):
+  ''' All refined_experiments json files below the roots, sorted '''
+  filenames = []
+  for root in roots:
+    for dirpath, dirnames, files in os.walk(root):
+      for filename in files:
+        if 'refined_experiments' in os.path.splitext(filename)[0] and os.path.splitext(filename)[1] == '.json':
+          filenames.append(os.path.join(dirpath, filename))
+  return sorted(filenames)
+
+def read_cells(filenames):
+  ''' (identifier, unit cell, metrical matrix, space group) of the Niggli cell of every crystal
+      model in the files. Unreadable files are skipped '''
+  from dxtbx.model.experiment_list import ExperimentListFactory
+  from xfel.clustering.singleframe import CellOnlyFrame
+  cells = []
+  for filename in filenames:
+    try:
+      experiments = ExperimentListFactory.from_json_file(filename, check_format=False)
+    except Exception as e:
+      print ('Could not read %s: %s'%(filename, str(e)))
+      continue
+    for i, crystal in enumerate(experiments.crystals()):
+      crystal_symmetry = crystal.get_crystal_symmetry()
+      cell = CellOnlyFrame(crystal_symmetry)
+      cells.append(('%s:%d'%(filename, i), tuple(cell.uc), tuple(cell.mm),
+                    str(crystal_symmetry.space_group_info())))
+  return cells
+
+# Set by task_runner.map right before the worker processes are forked
+_task_function = None
+
+def _run_task_in_worker(task):
+  return _task_function(task)
+
+class task_runner(object):
+  ''' Runs a function on a list of tasks, spread over the MPI ranks of comm or over nproc
+      forked processes, and returns the results of all tasks in task order on rank 0 (None
+      on the other ranks of comm) '''
+  def __init__(self, comm=None, nproc=1):
+    self.comm = comm
+    self.nproc = nproc
+    self.rank = 0 if comm is None else comm.Get_rank()
+
+  def bcast_array(self, array, dtype):
+    ''' The numpy array of rank 0 on every rank, sent as one buffer '''
+    if self.comm is None:
+      return np.asarray(array, dtype=dtype)
+    shape = self.comm.bcast(None if self.rank != 0 else np.shape(array), root=0)
+    if self.rank == 0:
+      array = np.ascontiguousarray(array, dtype=dtype)
+    else:
+      array = np.empty(shape, dtype=dtype)
+    self.comm.Bcast(array, root=0)
+    return array
+
+  def map(self, function, tasks):
+    if self.comm is not None:
+      size = self.comm.Get_size()
+      mine = [(i, function(task)) for i, task in enumerate(tasks) if i%size == self.rank]
+      parts = self.comm.gather(mine, root=0)
+      if self.rank != 0:
+        return None
+      results = [None]*len(tasks)
+      for part in parts:
+        for i, result in part:
+          results[i] = result
+      return results
+    if self.nproc > 1 and len(tasks) > 1:
+      import multiprocessing
+      global _task_function
+      _task_function = function
+      pool = multiprocessing.Pool(processes=min(self.nproc, len(tasks)))
+      try:
+        results = pool.map(_run_task_in_worker, tasks)
+        pool.close()
+        pool.join()
+      except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+      finally:
+        _task_function = None
+      return results
+    return [function(task) for task in tasks]
+
+def row_blocks(n, block_size):
+  return [(first, min(n, first + block_size)) for first in range(0, n, block_size)]
+
+def estimate_d_c_on_sample(mm, n_sample, seed):
+  ''' estimate_d_c on the dense NCDist matrix of a random sample of the cells '''
+  from scitbx.array_family import flex
+  from cctbx.uctbx.determine_unit_cell import NCDist_flatten
+  from exafel_project.ADSE13_25.clustering.consensus_functions import estimate_d_c
+  n = len(mm)
+  sample = np.sort(np.random.RandomState(seed).choice(n, min(n, n_sample), replace=False))
+  return estimate_d_c(NCDist_flatten(flex.double(mm[sample].ravel())))
+
+class ncdist_rows(object):
+  ''' Rows of the NCDist distance matrix of a set of cells, one at a time '''
+  def __init__(self, mm):
+    from exafel_project.ADSE13_25.clustering.sparse_density_peaks import g6_embedding
+    self.g6 = g6_embedding(mm).tolist()
+
+  def row(self, i, columns=None):
+    from cctbx.uctbx.determine_unit_cell import NCDist
+    g6_i = self.g6[i]
+    if columns is None:
+      return np.array([NCDist(g6_i, g6_j) for g6_j in self.g6])
+    return np.array([NCDist(g6_i, self.g6[j]) for j in columns])
+
+def density_peaks_from_row_blocks(mm, d_c, runner, block_size):
+  ''' precomputed_density_peaks of all the cells on rank 0, None on the other ranks. Every
+      task computes a block of rows, first to count rho and then, once rho_order is known, to
+      find delta and the nearest neighbor of each row among the points earlier in rho_order '''
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.sparse_density_peaks import precomputed_density_peaks
+  n = len(mm)
+  rows = ncdist_rows(mm)
+  blocks = row_blocks(n, block_size)
+  def rho_of_block(block):
+    return [int((rows.row(i) < d_c).sum()) for i in range(block[0], block[1])]
+  rho_parts = runner.map(rho_of_block, blocks)
+  rho = None
+  if runner.rank == 0:
+    rho = np.concatenate([np.array(part, dtype=np.int64) for part in rho_parts])
+  # Every rank needs rho_order for its delta blocks
+  rho = runner.bcast_array(rho, np.int64)
+  # Same order and first maximum as clustering_manager
+  rho_flex = flex.int(np.ascontiguousarray(rho, dtype=np.int32))
+  rho_order = flex.sort_permutation(rho_flex, reverse=True)
+  i_max = flex.max_index(rho_flex)
+  rank = np.empty(n, dtype=np.int64)
+  rank[np.array(list(rho_order), dtype=np.int64)] = np.arange(n)
+  def delta_of_block(block):
+    result = []
+    for i in range(block[0], block[1]):
+      distances = rows.row(i)
+      row_max = float(distances.max()) if i == i_max else None
+      earlier = np.flatnonzero(rank < rank[i])
+      if len(earlier) == 0:
+        result.append((0.0, i, row_max))
+        continue
+      # Nearest earlier point, ties go to the earliest in rho_order as in the dense code
+      candidates = earlier[distances[earlier] == distances[earlier].min()]
+      j = int(candidates[np.argmin(rank[candidates])])
+      result.append((float(distances[j]), j, row_max))
+    return result
+  delta_parts = runner.map(delta_of_block, blocks)
+  if runner.rank != 0:
+    return None
+  delta = np.zeros(n)
+  nearest_neighbor = np.arange(n)
+  delta_i_max = None
+  i = 0
+  for part in delta_parts:
+    for d, j, row_max in part:
+      delta[i] = d
+      nearest_neighbor[i] = j
+      if row_max is not None:
+        delta_i_max = row_max
+      i += 1
+  delta[rho_order[0]] = delta_i_max
+  nearest_neighbor[rho_order[0]] = rho_order[0]
+  return precomputed_density_peaks(rho, delta, nearest_neighbor, rho_order, delta_i_max)
+
+def cluster_by_landmarks(mm, params, d_c, runner):
+  ''' Cluster ids of all cells and the clustering_manager of the landmarks on rank 0, None
+      for both on the other ranks '''
+  from scitbx.array_family import flex
+  from cctbx.uctbx.determine_unit_cell import NCDist_flatten
+  from exafel_project.ADSE13_25.clustering.consensus_functions import clustering_manager
+  from exafel_project.ADSE13_25.clustering.sparse_density_peaks import g6_embedding
+  n = len(mm)
+  landmarks = np.sort(np.random.RandomState(params.seed).choice(n, min(n, params.landmarks.n_landmarks), replace=False))
+  CM = None
+  landmark_cluster = None
+  if runner.rank == 0:
+    Dij = NCDist_flatten(flex.double(mm[landmarks].ravel()))
+    CM = clustering_manager(Dij=Dij, d_c=d_c, Z_delta=params.clustering.Z_delta, strategy=params.clustering.strategy)
+    landmark_cluster = np.array(list(CM.cluster_id_final), dtype=np.int64)
+  landmark_cluster = runner.bcast_array(landmark_cluster, np.int64)
+  rows = ncdist_rows(mm)
+  landmark_g6 = g6_embedding(mm[landmarks])
+  n_candidates = min(params.landmarks.n_candidates, len(landmarks))
+  def assign_block(block):
+    g6 = g6_embedding(mm[block[0]:block[1]])
+    d2 = ((g6[:,None,:] - landmark_g6[None,:,:])**2).sum(axis=2)
+    candidates = np.argsort(d2, axis=1, kind='mergesort')[:, :n_candidates]
+    assigned = []
+    for i, row_candidates in zip(range(block[0], block[1]), candidates):
+      distances = rows.row(i, columns=landmarks[row_candidates])
+      assigned.append(int(landmark_cluster[row_candidates[int(np.argmin(distances))]]))
+    return assigned
+  parts = runner.map(assign_block, row_blocks(n, params.block_size))
+  if runner.rank != 0:
+    return None, landmarks, None
+  cluster_id = np.concatenate([np.array(part, dtype=np.int64) for part in parts])
+  return cluster_id, landmarks, CM
+
+def write_results(params, cells, cluster_id, centers):
+  ''' Assignments and per cluster centroids. centers maps a cluster id to the index of its
+      central cell '''
+  if not os.path.isdir(params.output.output_dir):
+    os.makedirs(params.output.output_dir)
+  prefix = os.path.join(params.output.output_dir, params.output.prefix)
+  with open(prefix + '_assignments.txt', 'w') as f:
+    for (identifier, uc, mm, space_group), cid in zip(cells, cluster_id):
+      f.write('%s %d %s %s\n'%(identifier, cid, ' '.join(['%.4f'%x for x in uc]), space_group.replace(' ', '')))
+  uc = np.array([cell[1] for cell in cells])
+  with open(prefix + '_centroids.txt', 'w') as f:
+    f.write('# cluster n_members central_cell a b c alpha beta gamma space_group mean_a mean_b mean_c mean_alpha mean_beta mean_gamma\n')
+    for cid in sorted(centers):
+      members = cluster_id == cid
+      identifier, center_uc, center_mm, space_group = cells[centers[cid]]
+      f.write('%d %d %s %s %s %s\n'%(cid, members.sum(), identifier, ' '.join(['%.4f'%x for x in center_uc]),
+              space_group.replace(' ', ''), ' '.join(['%.4f'%x for x in uc[members].mean(axis=0)])))
+    f.write('# %d cells not assigned to a cluster\n'%(cluster_id < 0).sum())
+  print ('Wrote %s_assignments.txt and %s_centroids.txt'%(prefix, prefix))
+
+def run(params, comm=None):
+  rank = 0 if comm is None else comm.Get_rank()
+  runner = task_runner(comm=comm, nproc=params.nproc)
+  if rank == 0:
+    filenames = find_experiment_files(params.input_path)
+    print ('Found %d refined_experiments files'%len(filenames))
+  else:
+    filenames = None
+  if comm is not None:
+    filenames = comm.bcast(filenames, root=0)
+  file_blocks = [filenames[i:i+params.block_size] for i in range(0, len(filenames), params.block_size)]
+  # The cells (identifiers, cells, space groups) stay on rank 0 for the output, the row blocks
+  # of every rank only need the metrical matrices
+  cells = runner.map(read_cells, file_blocks)
+  mm = None
+  if rank == 0:
+    cells = [cell for part in cells for cell in part]
+    mm = np.array([cell[2] for cell in cells], dtype=np.float64).reshape(-1, 6)
+  mm = runner.bcast_array(mm, np.float64)
+  if len(mm) < 2:
+    raise Sorry('Need at least 2 crystal models, found %d'%len(mm))
+  if params.d_c is None:
+    d_c = None
+    if rank == 0:
+      d_c = estimate_d_c_on_sample(mm, params.n_sample_d_c, params.seed)
+    if comm is not None:
+      d_c = comm.bcast(d_c, root=0)
+  else:
+    d_c = params.d_c
+  if rank == 0:
+    print ('Clustering %d unit cells with d_c = %f, method %s'%(len(mm), d_c, params.method))
+
+  if params.method == 'row_blocks':
+    density_peaks = density_peaks_from_row_blocks(mm, d_c, runner, params.block_size)
+    if rank != 0:
+      return
+    from exafel_project.ADSE13_25.clustering.consensus_functions import clustering_manager
+    CM = clustering_manager(density_peaks=density_peaks, d_c=d_c, Z_delta=params.clustering.Z_delta, strategy=params.clustering.strategy)
+    cluster_id = np.array(list(CM.cluster_id_final), dtype=np.int64)
+    centers = dict([(int(cid), i) for i, cid in enumerate(CM.cluster_id_maxima) if cid >= 0])
+  else:
+    cluster_id, landmarks, CM = cluster_by_landmarks(mm, params, d_c, runner)
+    if rank != 0:
+      return
+    centers = dict([(int(cid), int(landmarks[i])) for i, cid in enumerate(CM.cluster_id_maxima) if cid >= 0])
+  print ('%d clusters'%len(centers))
+  write_results(params, cells, cluster_id, centers)
+
+if __name__ == '__main__':
+  params = params_from_phil(sys.argv[1:], phil_scope=cluster_unit_cells_phil_scope)
+  if len(params.input_path) == 0:
+    params.input_path = ['.']
+  comm = None
+  if params.mpi:
+    try:
+      from mpi4py import MPI
+    except ImportError:
+      raise Sorry("MPI not found")
+    comm = MPI.COMM_WORLD
+  run(params, comm=comm)
@@ -107,7 +107,7 @@ def run(params, root, common_set=None):
     if os.path.splitext(filename)[1] != ".txt": continue
     iterable.append(filename)
   for filename in os.listdir(root):
-    if 'refined_experiments' not in os.path.splitext(filename)[0] or os.path.splitext(filename)[1] != ".json": continue
+    if not is_experiments_file(filename): continue
     iterable2.append(filename)
   print ('done appending')
   #if command_line.options.mpi:
@@ -352,6 +352,39 @@ def get_hits_and_indexing_stats(filenames, debug_root,rank=0):
   return (len(hits), len(idx_successful_time), sum(idx_attempt_time)/3600.0, sum(idx_successful_time)/3600.0, idx_cutoff_time_exceeded_event, num_of_xray_events, num_of_images_analyzed)
 
 # Extract timing information from log file
+def is_experiments_file(filename):
+  ''' True for refined experiment json files and for shared composite files '''
+  from exafel_project.ADSE13_25.output.shared_file import SHARED_FILE_EXT
+  base, ext = os.path.splitext(filename)
+  if ext == SHARED_FILE_EXT:
+    return True
+  return 'refined_experiments' in base and ext == ".json"
+
+def load_experiments_and_reflections(root, filenames, load_reflections=True):
+  ''' Yield (experiments, indexed reflections) pairs from refined experiments json files and
+      their indexed pickles, and from all ranks of shared composite files. The reflections
+      are None if load_reflections is False '''
+  from exafel_project.ADSE13_25.output.shared_file import SHARED_FILE_EXT, shared_file_reader
+  from dxtbx.model.experiment_list import ExperimentListFactory
+  from libtbx.easy_pickle import load
+  for filename in filenames:
+    if os.path.splitext(filename)[1] == SHARED_FILE_EXT:
+      reader = shared_file_reader(os.path.join(root, filename))
+      for entry in reader.entries:
+        if 'refined_experiments' not in entry['blocks']: continue
+        if load_reflections:
+          # Skip the ranks that wrote no indexed reflections
+          if 'indexed' not in entry['blocks']: continue
+          yield reader.experiments(entry), reader.reflections(entry)
+        else:
+          yield reader.experiments(entry), None
+      continue
+    experiments = ExperimentListFactory.from_json_file(os.path.join(root, filename), check_format=False)
+    if load_reflections:
+      yield experiments, load(os.path.join(root, filename.split('refined_experiments')[0]+'indexed.pickle'))
+    else:
+      yield experiments, None
+
 def get_uc_and_rmsd_stats(filenames, root, rank=0, common_set=None):
   print ('Getting unit cell information')
   # Unit cell and RMSD statistics for that run
@@ -363,15 +396,11 @@ def get_uc_and_rmsd_stats(filenames, root, rank=0, common_set=None):
   all_uc_gamma = flex.double()
   dR = flex.double()
 
-  from dxtbx.model.experiment_list import ExperimentListFactory
   from dials.algorithms.refinement.prediction.managed_predictors import ExperimentsPredictorFactory
-  from libtbx.easy_pickle import load
   from scitbx.matrix import col
   if common_set is not None:
     print ('Using %d common set images to report unit cell and RMSD statistics'%(len(common_set)))
-  for filename in filenames:
-    fjson=os.path.join(root, filename)
-    experiments = ExperimentListFactory.from_json_file(fjson, check_format=False)
+  for experiments, reflections in load_experiments_and_reflections(root, filenames):
     expt_id_common = []
     for ii,crystal in enumerate(experiments.crystals()):
       if common_set is not None:
@@ -384,8 +413,6 @@ def get_uc_and_rmsd_stats(filenames, root, rank=0, common_set=None):
       all_uc_alpha.append(crystal.get_unit_cell().parameters()[3])
       all_uc_beta.append(crystal.get_unit_cell().parameters()[4])
       all_uc_gamma.append(crystal.get_unit_cell().parameters()[5])
-    fpickle = os.path.join(root, filename.split('refined_experiments')[0]+'indexed.pickle')
-    reflections = load(fpickle)
     ref_predictor = ExperimentsPredictorFactory.from_experiments(experiments, force_stills=experiments.all_stills())
     reflections = ref_predictor(reflections)
     for refl in reflections:
@@ -397,7 +424,6 @@ def get_uc_and_rmsd_stats(filenames, root, rank=0, common_set=None):
 def get_common_set(roots, ts_from_cbf=False):
   ''' Function to get common set of images indexed in multiple folders. Based on CBF filenames 
       ts_from_cbf if True is much faster than reading from json files'''
-  from dxtbx.model.experiment_list import ExperimentListFactory
   cbf = {}
   for root in roots:
     cbf[root] = []
@@ -406,9 +432,8 @@ def get_common_set(roots, ts_from_cbf=False):
         if os.path.splitext(filename)[1] != ".cbf": continue
         cbf[root].append(filename)
     else:
-      for filename in os.listdir(root):
-        if 'refined_experiments' not in os.path.splitext(filename)[0] or os.path.splitext(filename)[1] != ".json": continue
-        explist=ExperimentListFactory.from_json_file(os.path.join(root,filename), check_format=False)
+      filenames = [filename for filename in os.listdir(root) if is_experiments_file(filename)]
+      for explist, _ in load_experiments_and_reflections(root, filenames, load_reflections=False):
         for exp in explist:
           cbf[root].append(exp.imageset.get_image_identifier(0).split('/')[-1])
   # Now take intersection
@@ -100,7 +100,10 @@ iota {
   }
   include scope exafel_project.ADSE13_25.clustering.consensus_functions.clustering_iota_scope
   include scope exafel_project.ADSE13_25.refinement.iota_refiner.iota_refiner_scope
+  include scope exafel_project.ADSE13_25.dispatch.cascade.cascade_scope
+  include scope exafel_project.ADSE13_25.indexing.method_race.method_race_scope
 }
+include scope exafel_project.ADSE13_25.dispatch.watchdog.watchdog_scope
 '''
 
 phil_scope = parse(control_phil_str + dials_phil_str + iota_phil_str, process_includes=True).fetch(parse(program_defaults_phil_str))
@@ -426,6 +429,43 @@ class Script_iota(Script):
 class Processor_iota(Processor):
     ''' Processor class with functions customized for iota style processing '''
 
+    watchdog = None
+    indexing_cascade = None
+
+    def debug_start(self, tag):
+        if self.params.watchdog.enable:
+            if self.watchdog is None:
+                from exafel_project.ADSE13_25.dispatch.watchdog import event_watchdog
+                self.watchdog = event_watchdog(self.params.watchdog)
+            self.watchdog.start_event()
+        super(Processor_iota, self).debug_start(tag)
+
+    def debug_write(self, string, state=None):
+        if self.watchdog is not None and string != "":
+            self.watchdog.mark(string, state)
+        super(Processor_iota, self).debug_write(string, state)
+
+    def debug_note(self, string, state=None):
+        ''' Write a line to the debug log without starting a new watchdog stage, e.g. progress
+            notes within a stage '''
+        super(Processor_iota, self).debug_write(string, state)
+
+    def check_budget(self):
+        ''' Cooperative watchdog check, raises Watchdog_TimeoutError if the event or the current
+            stage is over its time budget '''
+        if self.watchdog is not None:
+            self.watchdog.check()
+
+    def budget_exceeded(self, e):
+        ''' If e was raised by the watchdog, log the event with the timeout status so that it
+            can be reprocessed later with bigger budgets, and return True '''
+        from exafel_project.ADSE13_25.dispatch.watchdog import Watchdog_TimeoutError
+        if not isinstance(e, Watchdog_TimeoutError):
+            return False
+        print(str(e), self.tag)
+        self.debug_write("%s_budget_exceeded" % e.stage, "timeout")
+        return True
+
     def process_experiments(self, tag, experiments):
         if not self.params.output.composite_output:
             self.setup_filenames(tag)
@@ -454,6 +494,8 @@ class Processor_iota(Processor):
                 self.debug_write("data_loaded", "done")
                 return
         except Exception as e:
+            if self.budget_exceeded(e):
+                return
             print("Error spotfinding", tag, str(e))
             self.debug_write("spotfinding_exception", "fail")
             if not self.params.dispatch.squash_errors: raise
@@ -462,20 +504,30 @@ class Processor_iota(Processor):
             # Try finding spots that are too close to each other and kick one of them out
             if self.params.dispatch.index:
                 self.debug_write("index_start")
+                self.check_budget()
                 experiments, indexed = self.index(experiments, observed)
+                if self.indexing_cascade is not None:
+                    self.indexing_cascade.escalation_done(True, note=self.debug_note)
             else:
                 print("IOTA based Indexing turned off. Exiting")
                 self.debug_write("spotfinding_ok_%d" % len(observed), "done")
                 return
         except Exception as e:
+            if self.indexing_cascade is not None:
+                self.indexing_cascade.escalation_done(False, note=self.debug_note)
+            if self.budget_exceeded(e):
+                return
             print("Couldnt index using IOTA ", tag, str(e))
             if not self.params.dispatch.squash_errors: raise
             self.debug_write("indexing_failed_iota_%d" % len(observed), "stop")
             return
         try:
             self.debug_write("refine_start")
+            self.check_budget()
             experiments,indexed = self.refine(experiments, indexed)
         except Exception as e:
+            if self.budget_exceeded(e):
+                return
             print("Error refining", tag, str(e))
             self.debug_write("refine_failed_%d" % len(indexed), "fail")
             if not self.params.dispatch.squash_errors: raise
@@ -483,12 +535,15 @@ class Processor_iota(Processor):
         try:
             if self.params.dispatch.integrate:
                 self.debug_write("integrate_start")
+                self.check_budget()
                 integrated = self.integrate(experiments, indexed)
             else:
                 print("Integration turned off. Exiting")
                 self.debug_write("index_ok_%d" % len(indexed), "done")
                 return
         except Exception as e:
+            if self.budget_exceeded(e):
+                return
             print("Error integrating", tag, str(e))
             self.debug_write("integrate_failed_%d" % len(indexed), "fail")
             if self.params.dispatch.squash_errors: raise
@@ -496,13 +551,26 @@ class Processor_iota(Processor):
         self.debug_write("integrate_ok_%d" % len(integrated), "done")
 
 
+    def finalize(self):
+        if self.indexing_cascade is not None:
+            self.indexing_cascade.show_summary()
+        if self.params.indexing.stills.method_list is not None:
+            from exafel_project.ADSE13_25.indexing.method_race import get_method_stats
+            get_method_stats().show_summary()
+        if self.params.iota.method == 'random_sub_sampling':
+            from exafel_project.ADSE13_25.indexing.subsample_bank import get_subsample_bank
+            get_subsample_bank().show_summary()
+        super(Processor_iota, self).finalize()
+
     def conventional_index(self, experiments, reflections):
         ''' Conventional indexing that is with refinement of basis vectors and outlier rejection done'''
         return super(Processor_iota, self).index(experiments, reflections)
 
-    def index_with_iota(self, experiments, reflections):
+    def index_with_iota(self, experiments, reflections, indexing_context=None):
         ''' Special indexing code where no refinement and outlier rejection is done; 
-            HKL frac values are determined for all the spots considered '''
+            HKL frac values are determined for all the spots considered.
+            With an indexing_context (iota_indexing_context), reflections is a selection of
+            its spots and its parameters and experiments are used '''
         from exafel_project.ADSE13_25.indexing.indexer_iota import iota_indexer
         from time import time
         import copy
@@ -514,9 +582,12 @@ class Processor_iota(Processor):
 
         imagesets=experiments.imagesets()
 
-        params = copy.deepcopy(self.params)
-        # don't do scan-varying refinement during indexing
-        params.refinement.parameterisation.scan_varying = False
+        if indexing_context is not None:
+            params = indexing_context.params
+        else:
+            params = copy.deepcopy(self.params)
+            # don't do scan-varying refinement during indexing
+            params.refinement.parameterisation.scan_varying = False
 
         if hasattr(self, 'known_crystal_models'):
             known_crystal_models = self.known_crystal_models
@@ -526,31 +597,24 @@ class Processor_iota(Processor):
         if params.indexing.stills.method_list is None:
             idxr = iota_indexer.from_parameters(
               reflections, experiments, known_crystal_models=known_crystal_models,
-              params=params)
+              params=params, indexing_context=indexing_context)
             idxr.index()
+            indexed = idxr.reflections
+            experiments = idxr.experiments
         else:
-            indexing_error = None
-            for method in params.indexing.stills.method_list:
+            def index_with_method(method):
                 params.indexing.method = method
-                try:
-                    idxr = iota_indexer.from_parameters(
-                      reflections, experiments,
-                      params=params)
-                    idxr.index()
-                except Exception as e:
-                    logger.info("Couldn't index using method %s"%method)
-                    if indexing_error is None:
-                        if e is None:
-                            e = Exception("Couldn't index using method %s"%method)
-                        indexing_error = e
-                else:
-                    indexing_error = None
-                    break
-            if indexing_error is not None:
-                raise indexing_error
-
-        indexed = idxr.reflections
-        experiments = idxr.experiments
+                idxr = iota_indexer.from_parameters(
+                  reflections, experiments,
+                  params=params, indexing_context=indexing_context)
+                idxr.index()
+                return idxr.experiments, idxr.reflections
+            if indexing_context is not None:
+                imageset = indexing_context.experiments.imagesets()[0]
+            else:
+                imageset = imagesets[0]
+            experiments, indexed = self.index_with_method_list(params.indexing.stills.method_list,
+                                                               index_with_method, imageset)
 
         if known_crystal_models is not None:
             from dials.array_family import flex
@@ -567,6 +631,17 @@ class Processor_iota(Processor):
         logger.info('Time Taken = %f seconds' % (time() - st))
         return experiments, indexed
 
+    def index_with_method_list(self, methods, index_with_method, imageset):
+        ''' (experiments, reflections) of index_with_method(method) for the first method of methods
+            that succeeds, see method_race. Experiments indexed in a worker process are rebuilt
+            on imageset '''
+        from exafel_project.ADSE13_25.indexing.method_race import index_with_method_list
+        from exafel_project.ADSE13_25.indexing.trial_runner import pack_experiments, unpack_experiments
+        return index_with_method_list(methods, index_with_method, self.params.iota.method_race,
+                                      check=self.check_budget,
+                                      pack=lambda result: (pack_experiments(result[0]), result[1]),
+                                      unpack=lambda method, packed: (unpack_experiments(packed[0], imageset), packed[1]))
+
     def move_detector_to_bring_calc_spots_onto_obs(self, detector, beam, indexed,image_identifier):
         ''' Function moves detector to ensure that radially the gap between rcalc and robs is minimized
             calculated for each spot using dnew = ((robs-r0)/(rcal-r0))*d  and then mean is taken of dnew values
@@ -615,29 +690,18 @@ class Processor_iota(Processor):
               reflections, experiments , known_crystal_models=known_crystal_models,
               params=params)
             idxr.index()
+            indexed = idxr.refined_reflections
+            experiments = idxr.refined_experiments
         else:
-            indexing_error = None
-            for method in params.indexing.stills.method_list:
+            def index_with_method(method):
                 params.indexing.method = method
-                try:
-                    idxr = StillsIndexer.from_parameters(
-                      reflections, experiments,
-                      params=params)
-                    idxr.index()
-                except Exception as e:
-                    logger.info("Couldn't index using method %s"%method)
-                    if indexing_error is None:
-                        if e is None:
-                            e = Exception("Couldn't index using method %s"%method)
-                        indexing_error = e
-                else:
-                    indexing_error = None
-                    break
-            if indexing_error is not None:
-                raise indexing_error
-
-        indexed = idxr.refined_reflections
-        experiments = idxr.refined_experiments
+                idxr = StillsIndexer.from_parameters(
+                  reflections, experiments,
+                  params=params)
+                idxr.index()
+                return idxr.refined_experiments, idxr.refined_reflections
+            experiments, indexed = self.index_with_method_list(params.indexing.stills.method_list,
+                                                               index_with_method, imagesets[0])
 
         if known_crystal_models is not None:
             from dials.array_family import flex
@@ -653,6 +717,7 @@ class Processor_iota(Processor):
 
     def index(self, experiments, observed):
         ''' Override the index function of Script with this one. The conventional index function is above'''
+        from exafel_project.ADSE13_25.dispatch.watchdog import Watchdog_TimeoutError
         if self.params.iota.filter_spots:
             obs = observed['xyzobs.px.value']
             critical_robs = 5.0
@@ -678,11 +743,23 @@ class Processor_iota(Processor):
 
         print ('TOTAL SPOTS NOW ',len(observed))
 
+        # In cascade mode a hit only escalates to random sub-sampling if one conventional
+        # indexing attempt fails or does not pass the quality gate
+        if self.params.iota.method == 'random_sub_sampling' and self.params.iota.cascade.enable:
+            if self.indexing_cascade is None:
+                from exafel_project.ADSE13_25.dispatch.cascade import indexing_cascade
+                self.indexing_cascade = indexing_cascade(self.params.iota.cascade)
+            self.known_crystal_models = None
+            cascade_result = self.indexing_cascade.try_conventional(lambda: self.conventional_index(experiments, observed),
+                len(observed), note=self.debug_note, fatal_exceptions=(Watchdog_TimeoutError,))
+            if cascade_result is not None:
+                return cascade_result
+            self.check_budget()
+
         if self.params.iota.method == 'random_sub_sampling':
             from dxtbx.model.experiment_list import ExperimentList, Experiment
             from dials.array_family import flex
             len_max_indexed = -999
-            experiments_list = []
             self.known_crystal_models=None
             # Add an id for each strong spot observed in the image
             observed['spot_id'] = flex.size_t(range(len(observed)))
@@ -693,15 +770,28 @@ class Processor_iota(Processor):
                 self.params.indexing.stills.candidate_outlier_rejection=False
                 self.params.indexing.stills.refine_all_candidates=False
 
-            observed_samples_list = []
-            dump_refls=flex.reflection_table()
-            dump_expts=ExperimentList()
-            expt_id=-1
             debug_mode=self.params.iota.random_sub_sampling.debug_mode
             load_pickle_flag=self.params.iota.random_sub_sampling.load_pickle_flag
+            # Every crystal model of a trial is kept as a compact record (A matrix, space group,
+            # sub-sample spots, scores). Experiments are only rebuilt for the models used later
+            from exafel_project.ADSE13_25.indexing.trial_records import iota_trial_records
+            trial_records = iota_trial_records(len(observed), capacity=self.params.iota.random_sub_sampling.ntrials,
+                                               keep_miller_indices=debug_mode)
+            # Sub-sample selections only depend on the spot count, reuse them across events
+            from exafel_project.ADSE13_25.indexing.subsample_bank import get_subsample_bank
+            subsample_bank = get_subsample_bank()
+            # Stills conversion, centroid mapping and symmetry setup are shared by all trials
+            indexing_context = None
+            sample_source = observed
+            if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex' and \
+                not (not debug_mode and load_pickle_flag):
+                from exafel_project.ADSE13_25.indexing.indexer_iota import iota_indexing_context
+                indexing_context = iota_indexing_context(observed, experiments, self.params)
+                sample_source = indexing_context.reflections
             for trial in range(self.params.iota.random_sub_sampling.ntrials):
                 if not debug_mode and load_pickle_flag:
                     continue
+                self.check_budget()
                 flex.set_random_seed(trial+1001)
 
                 if self.params.iota.random_sub_sampling.auto_select_Nspots: 
@@ -715,42 +805,37 @@ class Processor_iota(Processor):
                         #nfrac = 0.7-(len(observed)-30)/(240)
                         nfrac=0.6
                         Nspots = int(len(observed)*nfrac)
-                    observed_sample = observed.select(flex.random_selection(len(observed),Nspots))
+                    observed_sample = sample_source.select(subsample_bank.selection(len(observed), Nspots, trial))
                 elif self.params.iota.random_sub_sampling.Nspots_sub_sample is not None:
                     if len(observed) > self.params.iota.random_sub_sampling.Nspots_sub_sample:
-                        observed_sample =  observed.select(flex.random_selection(len(observed),self.params.iota.random_sub_sampling.Nspots_sub_sample)) 
+                        observed_sample =  sample_source.select(subsample_bank.selection(len(observed), self.params.iota.random_sub_sampling.Nspots_sub_sample, trial))
                 else:
-                    observed_sample = observed.select(flex.random_selection(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)))
+                    observed_sample = sample_source.select(subsample_bank.selection(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample), trial))
                 try:
                     print ('IOTA: SUM_INTENSITY_VALUE',sum(observed_sample['intensity.sum.value']), ' ',trial, len(observed_sample))
                     if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
-                        experiments_tmp, indexed_tmp = self.index_with_iota(experiments, observed_sample)
-                        for ii,expt_tmp in enumerate(experiments_tmp):
-                            expt_id +=1
-                            refl=indexed_tmp.select(indexed_tmp['id']==ii)
-                            refl['id'].set_selected(flex.bool([True]*len(refl['id'])), expt_id)
-                            dump_refls.extend(refl)
-                            dump_expts.append(expt_tmp)
+                        experiments_tmp, indexed_tmp = self.index_with_iota(experiments, observed_sample,
+                                                                             indexing_context=indexing_context)
                     elif self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
                         experiments_tmp, indexed_tmp = self.conventional_index(experiments, observed_sample)
 
                     for ii,expt_tmp in enumerate(experiments_tmp):
-                        # Appending each experiment separately to experiments_list 
-                        # and corresponding observation separately to observerd_samples_list
-                        experiments_list.append(ExperimentList([expt_tmp]))
-                        observed_samples_list.append(observed_sample)
+                        # One record per experiment, with the spots of the sub-sample
+                        sel_ii = indexed_tmp['id']==ii
+                        trial_records.append(trial, expt_tmp.crystal, observed_sample['spot_id'],
+                                             n_indexed=sel_ii.count(True),
+                                             indexed=indexed_tmp.select(sel_ii) if debug_mode else None)
+                except Watchdog_TimeoutError:
+                    raise
                 except Exception as e:
                     print('Indexing failed for some reason', str(e))
 
 
             from libtbx.easy_pickle import dump,load
-            if not load_pickle_flag and self.tag is not None:
-                import copy
-                copy_of_experiments_list=copy.deepcopy(experiments_list)
-                copy_of_observed_samples_list=copy.deepcopy(observed_samples_list)
             if debug_mode:
-                dump('experiments_list.pickle', experiments_list)
-                dump('observed_samples_list.pickle', observed_samples_list)
+                dump('experiments_list.pickle', trial_records.experiment_lists(experiments))
+                dump('observed_samples_list.pickle', trial_records.observed_samples(sample_source))
+                dump_expts, dump_refls = trial_records.indexed_experiments_and_reflections(experiments, sample_source)
                 from dxtbx.model.experiment_list import ExperimentListDumper
                 from dials.algorithms.refinement.prediction.managed_predictors import ExperimentsPredictorFactory
                 ref_predictor = ExperimentsPredictorFactory.from_experiments(dump_expts, force_stills=experiments.all_stills())
@@ -768,19 +853,25 @@ class Processor_iota(Processor):
                 else:
                     experiments_list = load(tag+'_ensemble_exp_list.pickle')
                     observed_samples_list = load(tag+'_ensemble_obs_list.pickle')
+                trial_records = iota_trial_records.from_lists(experiments_list, observed_samples_list, len(observed))
+                del experiments_list, observed_samples_list
 
             # Dump indexing trial files for debugging if necessary
             if self.params.iota.random_sub_sampling.dump_indexing_trials and self.tag is not None:
-                dump(os.path.join(self.params.output.output_dir,self.tag+'_ensemble_exp_list.pickle'), experiments_list)
-                dump(os.path.join(self.params.output.output_dir,self.tag+'_ensemble_obs_list.pickle'), observed_samples_list)
+                dump(os.path.join(self.params.output.output_dir,self.tag+'_ensemble_exp_list.pickle'), trial_records.experiment_lists(experiments))
+                dump(os.path.join(self.params.output.output_dir,self.tag+'_ensemble_obs_list.pickle'), trial_records.observed_samples(sample_source))
+            # best_similarity_transformation between the trial models, cached on the record indices
+            # and shared by the consensus and the realignment in union_and_reindex
+            from exafel_project.ADSE13_25.orientation.similarity_cache import similarity_transformations
+            similarity = similarity_transformations()
             # Dump out json file and pickle file of the indexed reflections as separate ids
             if self.params.iota.random_sub_sampling.consensus_function == 'unit_cell':
                 if self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
                     from exafel_project.ADSE13_25.clustering.old_consensus_functions import get_uc_consensus as get_consensus
-                    known_crystal_models, clustered_experiments_list = get_consensus(experiments_list, show_plot=False, return_only_first_indexed_model=True, finalize_method=None, clustering_params=None)
+                    known_crystal_models, clustered_experiments_list = get_consensus(trial_records, show_plot=False, return_only_first_indexed_model=True, finalize_method=None, clustering_params=None)
                 else:
                     from exafel_project.ADSE13_25.clustering.consensus_functions import get_uc_consensus as get_consensus
-                    known_crystal_models, clustered_experiments_list = get_consensus(experiments_list, show_plot=self.params.iota.random_sub_sampling.show_plot, return_only_first_indexed_model=False, finalize_method=self.params.iota.random_sub_sampling.finalize_method, clustering_params=self.params.iota.clustering)
+                    known_crystal_models, clustered_experiments_list = get_consensus(trial_records, show_plot=self.params.iota.random_sub_sampling.show_plot, return_only_first_indexed_model=False, finalize_method=self.params.iota.random_sub_sampling.finalize_method, clustering_params=self.params.iota.clustering, similarity=similarity)
             print ('IOTA: Finalizing consensus')
             if self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
                 print ('IOTA: Chosen finalize method is reindex_with_known_crystal_models')
@@ -799,29 +890,36 @@ class Processor_iota(Processor):
                 #experiments = ExperimentList()
                 sample = {}
                 all_experimental_models = {}
-                assert len(experiments_list[0].detectors()) == 1, 'IOTA currently supports only one detector when indexing'
+                assert len(experiments.detectors()) == 1, 'IOTA currently supports only one detector when indexing'
                 import copy
-                original_detector = copy.deepcopy(experiments_list[0].detectors()[0])
+                original_detector = copy.deepcopy(experiments.detectors()[0])
                 for idx,crystal_model in enumerate(clustered_experiments_list):
                     if crystal_model >= 0:
                         if crystal_model not in sample:
                             sample[crystal_model] = []
                             all_experimental_models[crystal_model] = []
-                        sample[crystal_model].append(observed_samples_list[idx]['spot_id'])
-                        all_experimental_models[crystal_model].append(experiments_list[idx])
+                        sample[crystal_model].append(trial_records.spot_ids(idx))
+                        all_experimental_models[crystal_model].append(trial_records[idx])
                 # FIXME take out
                 all_experiments_tmp = ExperimentList()
                 tmp_counter = 0
                 unrefined_experiments=ExperimentList()
+                # Spots of the indexing context were mapped with the original detector, which
+                # align_calc_spots_with_obs moves
+                union_context = indexing_context
+                if self.params.iota.random_sub_sampling.align_calc_spots_with_obs:
+                    union_context = None
                 for crystal_model in sample:
                     # Need to have a minimum number of experiments for correct stats
                     # FIXME number should not be hardcoded. ideally a phil param
-                    all_indexed_tmp = flex.reflection_table()
                     if len(all_experimental_models[crystal_model]) < 3:
                         continue
                     self.known_crystal_models = None
                     union_indices=flex.union(len(observed), iselections=sample[crystal_model])
-                    union_observed = observed.select(union_indices)
+                    if union_context is not None:
+                        union_observed = union_context.select(union_indices)
+                    else:
+                        union_observed = observed.select(union_indices)
                     print ('done taking unions')
                     # First index the union set with the central crystal model of the cluster
                     self.known_crystal_models = None #[known_crystal_models[crystal_model]]
@@ -837,7 +935,7 @@ class Processor_iota(Processor):
                         explist_centroid.append(exp)
 
                     from exafel_project.ADSE13_25.indexing.indexer_iota import iota_indexer
-                    reidxr = iota_indexer(union_observed, experiments,params=self.params)
+                    reidxr = iota_indexer(union_observed, experiments,params=self.params, indexing_context=union_context)
                     reidxr.calculate_fractional_hkl_from_Ainverse_q(reidxr.reflections, explist_centroid)
                     experiments_centroid = explist_centroid
                     indexed_centroid = reidxr.reflections
@@ -864,7 +962,7 @@ class Processor_iota(Processor):
                             explist_centroid.append(exp)
 
                     from exafel_project.ADSE13_25.indexing.indexer_iota import iota_indexer
-                    reidxr = iota_indexer(union_observed, experiments,params=self.params)
+                    reidxr = iota_indexer(union_observed, experiments,params=self.params, indexing_context=union_context)
                     reidxr.calculate_fractional_hkl_from_Ainverse_q(reidxr.reflections, explist_centroid)
                     print ('Done taking fractional HKLs')
                     experiments_centroid = explist_centroid
@@ -874,30 +972,28 @@ class Processor_iota(Processor):
                     # Now index with each each experimental model for each of the unioned observations
                     dh_list = flex.double()
                     failed_model_counter = 0
-                    hkl_all_values = {}
+                    from exafel_project.ADSE13_25.indexing.union_and_reindex import union_dh_statistics
+                    dh_statistics = union_dh_statistics(indexed_centroid)
                     print ('Now looping over all the cluster members and calculating fractional HKLs for the union set')
+                    member_crystals = []
                     for obs in all_experimental_models[crystal_model]:
+                        self.check_budget()
                         try:
                             #import pdb; pdb.set_trace()
-                            explist = ExperimentList()
                             self.known_crystal_models = None #[obs.crystals()[0]]
 
                             # Make sure the crystal is rotated using the best_similarity_transformation
                             # with respect to the centroid model. Otherwise dh values will be junk
+                            # The centroid and the members are trial models. The transformation is
+                            # cached, for a member after the centroid it is the one of the Dij_ori pair
                             from cctbx_orientation_ext import crystal_orientation
-                            cryst_ref_ori = crystal_orientation(explist_centroid.crystals()[0].get_A(), True)
-                            cryst_tmp_ori = crystal_orientation(obs.crystals()[0].get_A(), True)
-                            #print ('A-matrix reference=', cryst_ref_ori.direct_matrix())
-                            #print ('A-matrix reference=', cryst_tmp_ori.direct_matrix())
                             #from IPython import embed; embed(); exit()
                             try:
-                                best_similarity_transform = cryst_tmp_ori.best_similarity_transformation(
-                                  other = cryst_ref_ori, fractional_length_tolerance = 50.00,
-                                  unimodular_generator_range=1)
-                                cryst_tmp_ori_best=cryst_tmp_ori.change_basis(best_similarity_transform)
+                                cryst_tmp_ori_best = similarity.align(known_crystal_models[crystal_model], obs.crystals()[0],
+                                  fractional_length_tolerance = 50.00, unimodular_generator_range=1)
                             except Exception as e:
                                 print ('Transforming failed')
-                                cryst_tmp_ori_best=cryst_tmp_ori 
+                                cryst_tmp_ori_best = crystal_orientation(obs.crystals()[0].get_A(), True)
                             obs.crystals()[0].set_A(cryst_tmp_ori_best.reciprocal_matrix())
 
 
@@ -908,99 +1004,43 @@ class Processor_iota(Processor):
                                                goniometer=i_expt.goniometer,
                                                scan=i_expt.scan,
                                                crystal=obs.crystals()[0])
-                                explist.append(exp)
-                            reidxr = iota_indexer(union_observed, experiments, params=self.params)
-                            reidxr.calculate_fractional_hkl_from_Ainverse_q(reidxr.reflections, explist)
-                            experiments_tmp = explist
-                            indexed_tmp = reidxr.reflections
-                            # FIXME take out
-
-                            indexed_tmp['id'].set_selected(flex.size_t(range(len(indexed_tmp))),tmp_counter)
-                            all_indexed_tmp.extend(indexed_tmp)
+                            member_crystals.append(obs.crystals()[0])
                             all_experiments_tmp.append(exp)
                             tmp_counter +=1
-
-                            # find dh = |h_frac - h_centroid|
-                            # indexed_idxlist is list of indices in indexed_tmp if xyzobs.mm.value is in indexed_centroid
-                            indexed_idxlist = [idx for idx,elem in enumerate(indexed_tmp['xyzobs.mm.value'])
-                                              if elem in indexed_centroid['xyzobs.mm.value']]
-                            dh_list_tmp = flex.double()
-                            for idx in indexed_idxlist:
-                                centroid_list_idx = list(indexed_centroid['xyzobs.mm.value']).index(indexed_tmp['xyzobs.mm.value'][idx])
-                                x = indexed_centroid['miller_index'][centroid_list_idx]
-                                y = indexed_tmp['fractional_miller_index'][idx]
-                                if indexed_centroid['miller_index'][centroid_list_idx] != indexed_tmp['miller_index'][idx]:
-                                    continue
-                                #if indexed_centroid['xyzobs.mm.value'][centroid_list_idx] != indexed_tmp['xyzobs.mm.value'][idx]:
-                                #    continue
-                                #from IPython import embed; embed(); exit()
-                                if indexed_centroid['miller_index'][centroid_list_idx] not in hkl_all_values:
-                                    hkl_all_values[indexed_centroid['miller_index'][centroid_list_idx]] = flex.vec3_double()
-                                hkl_all_values[indexed_centroid['miller_index'][centroid_list_idx]].append(y)
-                                if x == (0,0,0): continue
-                            print ('finished evaluating dh_list for crystal model ',crystal_model)
+                        except Watchdog_TimeoutError:
+                            raise
                         except Exception as e:
                             print ('Reindexing with candidate lattices on union set failed', str(e))
+                    # find dh = |h_frac - h_centroid|
+                    # Fractional HKLs of the union spots for all cluster members in one pass. The
+                    # centroid was evaluated on the same union spots, so its rlp are shared
+                    try:
+                        if len(member_crystals) > 0:
+                            from exafel_project.ADSE13_25.indexing.indexer_iota import Ainverse_stack, fractional_hkl_from_Ainverse_stack
+                            member_hkl, member_hkl_frac = fractional_hkl_from_Ainverse_stack(
+                              Ainverse_stack(member_crystals), indexed_centroid['rlp'])
+                            dh_statistics.add_members(member_hkl, member_hkl_frac)
+                        print ('finished evaluating dh_list for crystal model ',crystal_model)
+                    except Exception as e:
+                        print ('Reindexing with candidate lattices on union set failed', str(e))
                     # Get a sense of the variability in dh. Assign Z-score cutoff from there
                     #from IPython import embed; embed(); exit()
                     try:
                         #from IPython import embed; embed(); exit()
                         Z_cutoff = self.params.iota.random_sub_sampling.Z_cutoff
                         # Now go through the spots indexed by the cluster center and reject if dh greater than Z_cutoff
-                        indexed_spots_idx = []
+                        # The ensemble of a spot are the fractional HKLs all cluster members gave it. The
+                        # centroid HKL has to be the majority of the ensemble and the spread of the members
+                        # agreeing with it sets dh_cutoff. Evaluated for all spots at once
+                        import numpy as np
+                        dh_stats = dh_statistics.dh_mask_by_spot(Z_cutoff, min_count=5, max_dh=0.5)
+                        n_spots = len(indexed_centroid)
+                        print ('Centroid HKL is the majority in cluster for %d out of %d spots, %d of them with enough stats'%(
+                               dh_stats.majority.sum(), n_spots, dh_stats.evaluated.sum()))
                         print ('MILLER_INDEX_DH_STATS', ' (H, K, L)', ' ', ' delta_H ','     ','delta_H_cutoff','   ','resolution')
-                        for ii,refl in enumerate(indexed_centroid.rows()):
-                            print ('MOMENT_OF_TRUTH_',ii)
-                            refl_ensemble=all_indexed_tmp.select(all_indexed_tmp['xyzobs.mm.value'].is_equal_to_vec3_double(refl['xyzobs.mm.value']))
-                            # First ensure that the miller_index of the centroid is the majority in the refl_ensemble
-                            #import pdb; pdb.set_trace()
-                            hkl_stats=collections.Counter(refl_ensemble['miller_index'])
-                            hkl_count=list(hkl_stats.viewvalues())
-                            hkl_indexes=list(hkl_stats.viewkeys())
-                            max_hkl_count=max(hkl_count)
-                            max_hkl=[]
-                            
-                            for i_count, count in enumerate(hkl_count):
-                                hkl=hkl_indexes[i_count]
-                                if count == max_hkl_count:
-                                    max_hkl.append(hkl)
-                            # Imposing logic here that the centroid hkl value should represent the majority. If not, print the majority and ignore for now
-                            # The ensemble value could be used to fix misindexing ?
-                            if refl['miller_index'] not in max_hkl:
-                                print ('Miller index %s of centroid is not majority for this spot. Majority HKL is %s'%(refl['miller_index'], max_hkl))
-                                continue
-                            print ('Centroid HKL is the majority in cluster. It has %s entries in the ensemble out of %s'%(max_hkl_count, len(refl_ensemble)))
-                            # Now choose those trials/crystals which predicted the same hkl as the centroid
-                            refl_sameHKL_ensemble=refl_ensemble.select(refl_ensemble['miller_index']==refl['miller_index'])
-                            dh = flex.double([refl['miller_index'][0]-refl['fractional_miller_index'][0],
-                                          refl['miller_index'][1]-refl['fractional_miller_index'][1],
-                                          refl['miller_index'][2]-refl['fractional_miller_index'][2]]).norm()
-                            hfrac,kfrac,lfrac = refl_sameHKL_ensemble['fractional_miller_index'].parts()
-                            # FIXME arbitrary cutoff: if not enough datapoints, cant do a statistical analysis
-                            if len(list(hfrac)) < 5:
-                                #from IPython import embed; embed(); exit()
-                                print ('NOT_ENOUGH_STATS=',refl['miller_index'],dh)
-                                continue
-                            # Trying an idea of using hfrac-h0 standard deviation as dh_cutoff
-                            dh_cutoff = hfrac.sample_standard_deviation()*hfrac.sample_standard_deviation()+ \
-                                        kfrac.sample_standard_deviation()*kfrac.sample_standard_deviation()+ \
-                                        lfrac.sample_standard_deviation()*lfrac.sample_standard_deviation()
-                            dh_cutoff_noZ = math.sqrt(dh_cutoff)
-                            dh_cutoff = math.sqrt(dh_cutoff)*Z_cutoff
-                            panel = experiments_centroid.detectors()[0][0]
-                            beam = experiments_centroid.beams()[0]
-                            resolution = panel.get_resolution_at_pixel(beam.get_s0(),refl['xyzobs.px.value'][0:2])
-                            print ('MILLER_INDEX_DH_STATS', refl['miller_index'], ' ',dh,' ',dh_cutoff,' ',resolution)
-                            # Not sure if there is any point comparing dh with dh_cutoff if the dh_cutoff is too high
-                            if dh > 0.5:
-                                continue
-                            if dh_cutoff > 0.5:
-                                continue
-                            #self.refine(all_experiments_tmp, all_indexed_tmp)
-                            #from IPython import embed; embed(); exit()
-                            #print ('DH = %12.7f and CUTOFF = %12.7f'%(dh, dh_cutoff))
-                            if dh < dh_cutoff and refl['miller_index'] != (0,0,0):
-                                indexed_spots_idx.append(ii)
+                        for ii in np.flatnonzero(dh_stats.evaluated):
+                            print ('MILLER_INDEX_DH_STATS', indexed_centroid['miller_index'][ii], ' ',dh_stats.dh[ii],' ',dh_stats.dh_cutoff[ii],' ',dh_stats.resolution[ii])
+                        indexed_spots_idx = [int(ii) for ii in np.flatnonzero(dh_stats.mask)]
                         # Make sure the number of spots indexed by a model is above a threshold
                         if len(indexed_centroid.select(flex.size_t(indexed_spots_idx))) >= self.params.iota.random_sub_sampling.min_indexed_spots:
                             indexed.extend(indexed_centroid.select(flex.size_t(indexed_spots_idx)))
@@ -1015,6 +1055,8 @@ class Processor_iota(Processor):
                                     expt.detector = original_detector
                                 unrefined_experiments.append(expt)
 
+                    except Watchdog_TimeoutError:
+                        raise
                     except Exception as e:
                         print ('dh_list calculation and outlier rejection failed',str(e))
                 # Ensure that no miller_index is assigned to multiple spots
@@ -1024,6 +1066,7 @@ class Processor_iota(Processor):
                     hkl, count=item
                     if count > 1:
                         indexed.del_selected(indexed['miller_index']==hkl)
+                similarity.show_summary(self.tag)
                 # Make sure crytal model numbers are in sequence, example 0,1,2 instead of 0,2,3
                 # when model 1 was not used for consensus part. Otherwise refine won't work
                 max_id = flex.max(indexed['id'])
@@ -1102,8 +1145,8 @@ class Processor_iota(Processor):
                 #self.known_crystal_models = experiments.crystals()
                 #experiments, indexed = self.index_with_known_orientation(experiments, observed)
                 if debug_mode and not load_pickle_flag and self.tag is not None:
-                    dump(self.tag+'_ensemble_exp_list.pickle', copy_of_experiments_list)
-                    dump(self.tag+'_ensemble_obs_list.pickle', copy_of_observed_samples_list)
+                    dump(self.tag+'_ensemble_exp_list.pickle', trial_records.experiment_lists(experiments))
+                    dump(self.tag+'_ensemble_obs_list.pickle', trial_records.observed_samples(sample_source))
         return experiments, indexed
 
 
@@ -3,6 +3,9 @@ from __future__ import division
 #
 # LIBTBX_SET_DISPATCHER_NAME cctbx.xfel.xtc_process
 #
+import time
+startup_time = time.time()
+
 PSANA2_VERSION = 0
 try:
   import psana
@@ -12,16 +15,14 @@ except ImportError:
 except AttributeError:
   pass
 
-from xfel.cftbx.detector import cspad_cbf_tbx
-from xfel.cxi.cspad_ana import cspad_tbx, rayonix_tbx
-import pycbf, os, sys, copy, socket, math
+# Detector specific modules (xfel.cftbx, xfel.cxi.cspad_ana, pycbf, dxtbx.datablock, numpy)
+# are imported where they are used to keep rank startup short
+import os, sys, copy, socket, math
 import libtbx.load_env
 from libtbx.utils import Sorry, Usage
 from dials.util.options import OptionParser
 from libtbx.phil import parse
-from dxtbx.datablock import DataBlockFactory
 from scitbx.array_family import flex
-import numpy as np
 from libtbx import easy_pickle
 
 xtc_phil_str = '''
@@ -104,11 +105,25 @@ xtc_phil_str = '''
       .type = bool
       .help = If True, will look for diagnostic files in the output directory and use \
               them to skip events that had caused unhandled exceptions previously
+    skip_timeout_events = False
+      .type = bool
+      .help = If True, will look for diagnostic files in the output directory and use \
+              them to skip events that were abandoned previously because they exceeded \
+              their watchdog time budget. By default these events are reprocessed, so \
+              rerunning with skip_processed_events=True and bigger budgets only picks up \
+              the events that timed out (and the unprocessed ones)
     event_timestamp = None
       .type = str
       .multiple = True
       .help = List of timestamps. If set, will only process the events that match them
   }
+  diagnostics
+    .help = Tools to find out where time and memory go on long running ranks
+  {
+    include scope exafel_project.ADSE13_25.diagnostics.memory_diagnostics.memory_diagnostics_scope
+    include scope exafel_project.ADSE13_25.diagnostics.startup_timing.startup_diagnostics_scope
+  }
+  include scope exafel_project.ADSE13_25.dispatch.watchdog.watchdog_scope
   input {
     cfg = None
       .type = str
@@ -312,6 +327,8 @@ xtc_phil_str = '''
     tmp_output_dir = "(NONE)"
       .type = str
       .help = Directory for CBFlib temporary output files
+    include scope exafel_project.ADSE13_25.output.composite_chunks.composite_chunks_scope
+    include scope exafel_project.ADSE13_25.output.shared_file.shared_file_scope
   }
   mp {
     method = *mpi sge
@@ -384,12 +401,14 @@ xtc_phil_str = '''
 
     }
     include scope exafel_project.ADSE13_25.clustering.consensus_functions.clustering_iota_scope
+    include scope exafel_project.ADSE13_25.indexing.trial_runner.trial_runner_scope
+    include scope exafel_project.ADSE13_25.clustering.consensus_functions.sequential_consensus_scope
+    include scope exafel_project.ADSE13_25.dispatch.cascade.cascade_scope
+    include scope exafel_project.ADSE13_25.indexing.method_race.method_race_scope
   }
 
 '''
 
-from dials.command_line.stills_process import dials_phil_str, program_defaults_phil_str
-
 extra_dials_phil_str = '''
   verbosity = 1
    .type = int(value_min=0)
@@ -447,6 +466,7 @@ def run_psana2(ims, params, comm):
 
       for evt in run.events():
         if det:
+          from xfel.cftbx.detector import cspad_cbf_tbx
           ims.base_dxtbx = cspad_cbf_tbx.env_dxtbx_from_slac_metrology(run, params.input.address, metro=metro)
           ims.dials_mask = dials_mask
           ims.spotfinder_mask = None
@@ -461,13 +481,56 @@ class EventOffsetSerializer(object):
     self.offsets = psanaOffset.offsets()
     self.lastBeginCalibCycleDgram = psanaOffset.lastBeginCalibCycleDgram()
 
-from xfel.ui import db_phil_str
-from xfel.command_line.xfel_process import radial_average_phil_str
+def build_phil_scope():
+  """ Parse the full phil scope. Processing the include scopes imports most of dials, so
+  under MPI this is only done on rank 0, see get_phil_scope """
+  from dials.command_line.stills_process import dials_phil_str, program_defaults_phil_str
+  from xfel.ui import db_phil_str
+  from xfel.command_line.xfel_process import radial_average_phil_str
+  return parse(xtc_phil_str + dials_phil_str + extra_dials_phil_str + db_phil_str + radial_average_phil_str, process_includes=True).fetch(parse(program_defaults_phil_str))
+
+phil_scope = None
+
+def get_phil_scope(comm=None):
+  """ Return the phil scope, building it on first use. If an MPI communicator with more than
+  one rank is given, rank 0 builds the scope and broadcasts it as a fully resolved phil
+  string (all attributes, no include scopes left) that the other ranks parse cheaply """
+  global phil_scope
+  if phil_scope is not None:
+    return phil_scope
+  if comm is None or comm.Get_size() == 1:
+    phil_scope = build_phil_scope()
+    return phil_scope
+  if comm.Get_rank() == 0:
+    phil_scope = build_phil_scope()
+    phil_str = phil_scope.as_str(attributes_level=3)
+  else:
+    phil_str = None
+  phil_str = comm.bcast(phil_str, root=0)
+  if comm.Get_rank() != 0:
+    import iotbx.phil
+    try:
+      phil_scope = iotbx.phil.parse(phil_str)
+    except Exception as e:
+      print "Could not parse phil scope broadcast by rank 0, building it locally:", str(e)
+      phil_scope = build_phil_scope()
+  return phil_scope
 
-phil_scope = parse(xtc_phil_str + dials_phil_str + extra_dials_phil_str + db_phil_str + radial_average_phil_str, process_includes=True).fetch(parse(program_defaults_phil_str))
+def get_startup_comm():
+  """ MPI communicator used during startup, before the parameters are known. None if
+  mpi4py is not available """
+  try:
+    from mpi4py import MPI
+  except ImportError:
+    return None
+  return MPI.COMM_WORLD
 
 from xfel.command_line.xfel_process import Script as DialsProcessScript
 from xfel.ui.db.frame_logging import DialsProcessorWithLogging
+from exafel_project.ADSE13_25.diagnostics.startup_timing import startup_timer
+startup = startup_timer(startup_time)
+startup.mark("python_imports")
+
 class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
   """ Script to process XFEL data at LCLS """
   def __init__(self):
@@ -478,9 +541,12 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 %s input.experiment=experimentname input.run_num=N input.address=address
  format.file_format=pickle input.cfg=filename
     """%(libtbx.env.dispatcher_name, libtbx.env.dispatcher_name)
+    self.startup_comm = get_startup_comm()
+    startup.mark("mpi_init")
     self.parser = OptionParser(
       usage = self.usage,
-      phil = phil_scope)
+      phil = get_phil_scope(self.startup_comm))
+    startup.mark("phil_scope")
 
     self.debug_file_path = None
     self.debug_str = None
@@ -495,18 +561,38 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     self.all_integrated_reflections = None
     self.all_int_pickle_filenames = []
     self.all_int_pickles = []
+    self.composite_chunks = None
+    self.shared_comm = None
 
     self.cached_ranges = None
 
     self.tt_low = None
     self.tt_high = None
 
+    self.memory_tracker = None
+    self.watchdog = None
+    self.indexing_cascade = None
+
   def debug_start(self, ts):
     self.debug_str = "%s,%s"%(socket.gethostname(), ts)
     self.debug_str += ",%s,%s,%s\n"
+    if self.memory_tracker is not None:
+      self.memory_tracker.start_event(ts)
+    if self.watchdog is not None:
+      self.watchdog.start_event()
     self.debug_write("start")
 
   def debug_write(self, string, state = None):
+    if self.memory_tracker is not None and string != "":
+      self.memory_tracker.mark(string, state)
+    if self.watchdog is not None and string != "":
+      self.watchdog.mark(string, state)
+    self.debug_note(string, state)
+
+  def debug_note(self, string, state = None):
+    ''' Write a line to the debug log without starting a new stage for the memory tracker and
+        the watchdog, e.g. progress notes within a stage '''
+    from xfel.cxi.cspad_ana import cspad_tbx
     ts = cspad_tbx.evt_timestamp() # Now
     debug_file_handle = open(self.debug_file_path, 'a')
     if string == "":
@@ -523,7 +609,24 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     mpi_log_file_handle.write(string)
     mpi_log_file_handle.close()
 
+  def check_budget(self):
+    ''' Cooperative watchdog check, raises Watchdog_TimeoutError if the event or the current
+        stage is over its time budget '''
+    if self.watchdog is not None:
+      self.watchdog.check()
+
+  def budget_exceeded(self, e):
+    ''' If e was raised by the watchdog, log the event with the timeout status so that it
+        can be reprocessed later with bigger budgets, and return True '''
+    from exafel_project.ADSE13_25.dispatch.watchdog import Watchdog_TimeoutError
+    if not isinstance(e, Watchdog_TimeoutError):
+      return False
+    print str(e), "event", self.timestamp
+    self.debug_write("%s_budget_exceeded"%e.stage, "timeout")
+    return True
+
   def psana_mask_to_dials_mask(self, psana_mask):
+    import numpy as np
     if psana_mask.dtype == np.bool:
       psana_mask = flex.bool(psana_mask)
     else:
@@ -537,9 +640,7 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
       dials_mask[-1].reshape(flex.grid(185,194))
     return dials_mask
 
-  def run(self):
-    """ Process all images assigned to this thread """
-
+  def parse_args(self):
     try:
       params, options = self.parser.parse_args(
         show_diff_phil=True, quick_parse=True)
@@ -552,6 +653,35 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
           if deprecated_params[i] in str(e):
             print "format.cbf.%s"%(deprecated_strs[i]%deprecated_params[i]), "has changed to format.cbf.cspad.%s"%(deprecated_strs[i]%deprecated_params[i])
       raise
+    return params, options
+
+  def parse_args_and_broadcast(self, comm):
+    """ Parse the command line and phil files on rank 0 only and broadcast the resulting
+    phil diff, so that the other ranks don't all read the same phil files """
+    if comm.Get_rank() == 0:
+      try:
+        params, options = self.parse_args()
+        diff_str = phil_scope.fetch_diff(source=phil_scope.format(python_object=params)).as_str()
+      except Exception:
+        comm.bcast(None, root=0)
+        raise
+      comm.bcast((diff_str, options), root=0)
+    else:
+      result = comm.bcast(None, root=0)
+      if result is None:
+        raise Sorry("Parameter parsing failed on rank 0")
+      diff_str, options = result
+      params = phil_scope.fetch(parse(diff_str)).extract()
+    return params, options
+
+  def run(self):
+    """ Process all images assigned to this thread """
+
+    if self.startup_comm is not None and self.startup_comm.Get_size() > 1:
+      params, options = self.parse_args_and_broadcast(self.startup_comm)
+    else:
+      params, options = self.parse_args()
+    startup.mark("parse_args")
 
     # Check inputs
     if params.input.experiment is None or \
@@ -645,6 +775,17 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
       rank = 0
       size = 1
     self.composite_tag = "%04d"%rank
+    if params.output.composite_output:
+      from exafel_project.ADSE13_25.output.composite_chunks import composite_chunk_manifest
+      composite_chunks = composite_chunk_manifest(params.output.composite_chunks, self.composite_tag, params.output.output_dir)
+      if composite_chunks.enabled():
+        self.composite_chunks = composite_chunks
+    if params.output.shared_file.enable:
+      if not params.output.composite_output or params.mp.method != "mpi" or PSANA2_VERSION:
+        raise Sorry("output.shared_file requires output.composite_output=True and mp.method=mpi (psana 1)")
+      if self.composite_chunks is not None:
+        raise Sorry("output.shared_file cannot be combined with output.composite_chunks")
+      self.shared_comm = comm
 
     # Configure the logging
     if params.output.logging_dir is None:
@@ -673,7 +814,8 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
         pass # due to multiprocessing, makedirs can sometimes fail
     assert os.path.exists(debug_dir)
 
-    if params.debug.skip_processed_events or params.debug.skip_unprocessed_events or params.debug.skip_bad_events:
+    if params.debug.skip_processed_events or params.debug.skip_unprocessed_events or params.debug.skip_bad_events or \
+        params.debug.skip_timeout_events:
       print "Reading debug files..."
       self.known_events = {}
       for filename in os.listdir(debug_dir):
@@ -683,11 +825,19 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
           if len(vals) != 5:
             continue
           _, ts, _, status, detail = vals
-          if status in ["done", "stop", "fail"]:
+          if status in ["done", "stop", "fail", "timeout"]:
             self.known_events[ts] = status
           else:
             self.known_events[ts] = "unknown"
 
+    if params.diagnostics.memory.enable:
+      from exafel_project.ADSE13_25.diagnostics.memory_diagnostics import memory_tracker
+      self.memory_tracker = memory_tracker(params.diagnostics.memory, rank)
+
+    if params.watchdog.enable:
+      from exafel_project.ADSE13_25.dispatch.watchdog import event_watchdog
+      self.watchdog = event_watchdog(params.watchdog)
+
     self.debug_file_path = os.path.join(debug_dir, "debug_%d.txt"%rank)
     write_newline = os.path.exists(self.debug_file_path)
     if write_newline: # needed if the there was a crash
@@ -700,11 +850,16 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
         if write_newline: # needed if the there was a crash
           self.mpi_log_write("\n")
 
+    startup.mark("setup_output")
+
     # FIXME MONA: psana 2 has pedestals and geometry hardcoded for cxid9114.
     # We can remove after return code when all interfaces are ready.
     if PSANA2_VERSION:
         print("PSANA2_VERSION", PSANA2_VERSION)
+        self.show_startup_timing(rank)
         run_psana2(self, params, comm)
+        if self.memory_tracker is not None:
+          self.memory_tracker.write_report(os.path.join(debug_dir, "memory_rank%04d.out"%rank))
         return
 
     # set up psana
@@ -741,6 +896,12 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 
     if params.format.file_format == "cbf":
       self.psana_det = psana.Detector(params.input.address, ds.env())
+    startup.mark("psana_datasource")
+
+    from xfel.cftbx.detector import cspad_cbf_tbx
+    from xfel.cxi.cspad_ana import cspad_tbx, rayonix_tbx
+    startup.mark("detector_modules")
+    self.show_startup_timing(rank)
 
     # set this to sys.maxint to analyze all events
     if params.dispatch.max_events is None:
@@ -845,6 +1006,7 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
               print "Rank %d beginning processing"%rank
               try:
                 self.process_event(run, evt)
+                self.flush_composite_output()
               except Exception as e:
                 print "Rank %d unhandled exception processing event"%rank, str(e)
               print "Rank %d event processed"%rank
@@ -872,6 +1034,7 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
           if process_fractions and not process_this_event(nevent): continue
 
           self.process_event(run, evt)
+          self.flush_composite_output()
 
           mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
           if nevent < 50:
@@ -884,12 +1047,25 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
         print 'Total memory leaked in %d cycles: %dkB' % (nevent+1-50, mem - first)
 
     print "Rank %d finalizing"%rank
+    if self.indexing_cascade is not None:
+      self.indexing_cascade.show_summary(rank)
+    if self.params.indexing.stills.method_list is not None:
+      from exafel_project.ADSE13_25.indexing.method_race import get_method_stats
+      get_method_stats().show_summary(rank)
+    if self.params.iota.method == 'random_sub_sampling':
+      from exafel_project.ADSE13_25.indexing.subsample_bank import get_subsample_bank
+      get_subsample_bank().show_summary(rank)
+    if self.memory_tracker is not None:
+      self.memory_tracker.end_event()
     try:
       self.finalize()
     except Exception as e:
       print "Rank %d, exception caught in finalize"%rank
       print str(e)
 
+    if self.memory_tracker is not None:
+      self.memory_tracker.write_report(os.path.join(debug_dir, "memory_rank%04d.out"%rank))
+
     if params.format.file_format == "cbf" and params.output.tmp_output_dir == "(NONE)":
       try:
         os.rmdir(tmp_dir)
@@ -973,6 +1149,15 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
             print "Couldn't reintegrate", img_file, str(e)
     print "Rank %d signing off"%rank
 
+  def show_startup_timing(self, rank):
+    """ Print the startup phases of this rank and, under MPI, a summary over all ranks.
+    Has to be reached by every rank """
+    if not self.params.diagnostics.startup.report:
+      return
+    startup.show(rank)
+    if self.startup_comm is not None and self.startup_comm.Get_size() > 1:
+      startup.show_summary(self.startup_comm)
+
   def get_run_and_timestamp(self, obj):
     # Used by database logger
     return self.run.run(), self.timestamp
@@ -983,6 +1168,8 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     @param run psana run object
     @param timestamp psana timestamp object
     """
+    from xfel.cftbx.detector import cspad_cbf_tbx
+    from xfel.cxi.cspad_ana import cspad_tbx, rayonix_tbx
     if PSANA2_VERSION:
       sec  = evt.seconds
       nsec = evt.nanoseconds
@@ -1001,9 +1188,14 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
       return
     self.run = run
 
-    if self.params_cache.debug.skip_processed_events or self.params_cache.debug.skip_unprocessed_events or self.params_cache.debug.skip_bad_events:
+    if self.params_cache.debug.skip_processed_events or self.params_cache.debug.skip_unprocessed_events or self.params_cache.debug.skip_bad_events or \
+        self.params_cache.debug.skip_timeout_events:
       if ts in self.known_events:
-        if self.known_events[ts] not in ["stop", "done", "fail"]:
+        if self.known_events[ts] == "timeout":
+          if self.params_cache.debug.skip_timeout_events:
+            print "Skipping event %s: exceeded its time budget previously"%ts
+            return
+        elif self.known_events[ts] not in ["stop", "done", "fail"]:
           if self.params_cache.debug.skip_bad_events:
             print "Skipping event %s: possibly caused an unknown exception previously"%ts
             return
@@ -1137,6 +1329,7 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
       if tt_low is not None or tt_high is not None:
         print "Warning, mod_radial_average is being used while also using xtc_process radial averaging. mod_radial_averaging results will not be logged to the database."
 
+    from dxtbx.datablock import DataBlockFactory
     datablock = DataBlockFactory.from_imageset(imgset)[0]
 
     try:
@@ -1188,6 +1381,8 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     try:
       observed = self.find_spots(datablock)
     except Exception as e:
+      if self.budget_exceeded(e):
+        return
       import traceback; traceback.print_exc()
       print str(e), "event", timestamp
       self.debug_write("spotfinding_exception", "fail")
@@ -1230,12 +1425,26 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 
     # index and refine
     self.debug_write("index_start")
+    from exafel_project.ADSE13_25.dispatch.watchdog import Watchdog_TimeoutError
     try:
+      self.check_budget()
       if self.params.dispatch.index:
-        if self.params.iota.method == 'random_sub_sampling':
+        # In cascade mode a hit only escalates to random sub-sampling if one conventional
+        # indexing attempt fails or does not pass the quality gate
+        cascade_result = None
+        if self.params.iota.method == 'random_sub_sampling' and self.params.iota.cascade.enable:
+          if self.indexing_cascade is None:
+            from exafel_project.ADSE13_25.dispatch.cascade import indexing_cascade
+            self.indexing_cascade = indexing_cascade(self.params.iota.cascade)
+          self.known_crystal_models = None
+          cascade_result = self.indexing_cascade.try_conventional(lambda: self.index(datablock, observed),
+            len(observed), note=self.debug_note, fatal_exceptions=(Watchdog_TimeoutError,))
+          self.check_budget()
+        if cascade_result is not None:
+          experiments, indexed = cascade_result
+        elif self.params.iota.method == 'random_sub_sampling':
           from scitbx.array_family import flex
           len_max_indexed = -999
-          experiments_list = []
           # Add an id for each strong spot observed in the image
           observed['spot_id'] = flex.size_t(range(len(observed)))
           # No outlier rejection or refinement should be done for the candidate basis vectors
@@ -1246,21 +1455,57 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
             self.params.indexing.stills.candidate_outlier_rejection=False
             self.params.indexing.stills.refine_all_candidates=False
 
-          observed_samples_list = []
-          for trial in range(self.params.iota.random_sub_sampling.ntrials):
-            flex.set_random_seed(trial+1001)
-            observed_sample = observed.select(flex.random_selection(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)))
-            try:
-              print ('IOTA: SUM_INTENSITY_VALUE',sum(observed_sample['intensity.sum.value']), ' ',trial)
-              if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
-                experiments_tmp, indexed_tmp = self.index_with_iota(datablock, observed_sample)
-              elif self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
-                experiments_tmp, indexed_tmp = self.index(datablock, observed_sample)
-
-              experiments_list.append(experiments_tmp)
-              observed_samples_list.append(observed_sample)
-            except Exception:
-              print('Indexing failed for some reason')
+          # The crystal model of every trial is kept as a compact record (A matrix, space group,
+          # sub-sample spots). Crystal models are rebuilt from it for the consensus
+          from exafel_project.ADSE13_25.indexing.trial_records import iota_trial_records
+          trial_records = iota_trial_records(len(observed), capacity=self.params.iota.random_sub_sampling.ntrials)
+          # best_similarity_transformation between the trial models, cached on the record indices
+          # and shared by the consensus and the realignment in union_and_reindex
+          from exafel_project.ADSE13_25.orientation.similarity_cache import similarity_transformations
+          similarity = similarity_transformations()
+          # Trials run serially or on a process pool, results come back in trial order
+          from exafel_project.ADSE13_25.indexing.trial_runner import run_trials, pack_experiments, unpack_experiments
+          trial_imageset = datablock.extract_imagesets()[0]
+          ntrials = self.params.iota.random_sub_sampling.ntrials
+          # In sequential consensus mode the trials run in batches until the consensus is stable
+          sequential_consensus = None
+          if self.params.iota.sequential_consensus.enable and \
+              self.params.iota.random_sub_sampling.consensus_function == 'unit_cell':
+            from exafel_project.ADSE13_25.clustering.consensus_functions import sequential_consensus as sequential_consensus_tracker
+            sequential_consensus = sequential_consensus_tracker(self.params.iota.sequential_consensus,
+              clustering_params=self.params.iota.clustering,
+              finalize_method=self.params.iota.random_sub_sampling.finalize_method,
+              similarity=similarity)
+            batches = sequential_consensus.batches(ntrials)
+          else:
+            batches = [(0, ntrials)]
+          n_trials_run = 0
+          from exafel_project.ADSE13_25.indexing.subsample_bank import get_subsample_bank
+          for first_trial, n_batch in batches:
+            # The sub-samples of a batch are selected at once in the rank, so forked trial workers
+            # inherit them and the packed results are matched with them without a new selection
+            samples = get_subsample_bank().select_trials(observed, self.trial_sample_size(observed),
+                                                         n_batch, first_trial)
+            results = run_trials(n_batch,
+                                 lambda trial: self.index_trial(datablock, observed, trial),
+                                 self.params.iota.trial_runner,
+                                 check=self.check_budget,
+                                 pack=lambda result: pack_experiments(result[0]),
+                                 unpack=lambda trial, packed: (unpack_experiments(packed, trial_imageset),
+                                                               samples[trial-first_trial]),
+                                 fatal_exceptions=(Watchdog_TimeoutError,),
+                                 first_trial=first_trial)
+            n_trials_run += n_batch
+            for trial, result in enumerate(results, first_trial):
+              if result is None:
+                continue
+              experiments_tmp, observed_sample = result
+              trial_records.append(trial, experiments_tmp.crystals()[0], observed_sample['spot_id'])
+            if sequential_consensus is not None and sequential_consensus.update(trial_records):
+              break
+          if sequential_consensus is not None:
+            print ('IOTA_TRIALS_SAVED', timestamp, n_trials_run, ntrials, ntrials-n_trials_run)
+            self.debug_note("iota_trials_saved_%d_of_%d"%(ntrials-n_trials_run, ntrials))
           #from libtbx.easy_pickle import dump,load
           #dump('experiments_list.pickle', experiments_list)
           #dump('observed_samples_list.pickle', observed_samples_list)
@@ -1271,8 +1516,12 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 
           if self.params.iota.random_sub_sampling.consensus_function == 'unit_cell':
             from exafel_project.ADSE13_25.clustering.consensus_functions import get_uc_consensus as get_consensus
-            if len(experiments_list) > 0:
-              known_crystal_models, clustered_experiments_list = get_consensus(experiments_list, show_plot=self.params.iota.random_sub_sampling.show_plot, return_only_first_indexed_model=False, finalize_method=self.params.iota.random_sub_sampling.finalize_method, clustering_params=self.params.iota.clustering)
+            if len(trial_records) > 0 and sequential_consensus is not None and \
+                sequential_consensus.n_experiments == len(trial_records):
+              # Consensus of the last batch is already up to date
+              known_crystal_models, clustered_experiments_list = sequential_consensus.result
+            elif len(trial_records) > 0:
+              known_crystal_models, clustered_experiments_list = get_consensus(trial_records, show_plot=self.params.iota.random_sub_sampling.show_plot, return_only_first_indexed_model=False, finalize_method=self.params.iota.random_sub_sampling.finalize_method, clustering_params=self.params.iota.clustering, similarity=similarity)
             else:
               known_crystal_models=None
               cluster_experiments_list=None
@@ -1297,17 +1546,16 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
             experiments = ExperimentList()
             sample = {}
             all_experimental_models = {}
-            assert len(experiments_list[0].detectors()) == 1, 'IOTA currently supports only one detector when indexing'
-            original_detector = copy.deepcopy(experiments_list[0].detectors()[0])
+            # IOTA currently supports only one detector when indexing
+            original_detector = copy.deepcopy(trial_imageset.get_detector())
             for idx,crystal_model in enumerate(clustered_experiments_list):
               if crystal_model >= 0:
                 if crystal_model not in sample:
                   sample[crystal_model] = []
                   all_experimental_models[crystal_model] = []
-                sample[crystal_model].append(observed_samples_list[idx]['spot_id'])
-                all_experimental_models[crystal_model].append(experiments_list[idx])
+                sample[crystal_model].append(trial_records.spot_ids(idx))
+                all_experimental_models[crystal_model].append(trial_records[idx])
             # FIXME take out
-            all_indexed_tmp = dials_flex.reflection_table()
             all_experiments_tmp = ExperimentList()
             tmp_counter = 0
             for crystal_model in sample:
@@ -1369,21 +1617,19 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
               # Now index with each each experimental model for each of the unioned observations
               dh_list = flex.double()
               failed_model_counter = 0
-              hkl_all_values = {}
+              from exafel_project.ADSE13_25.indexing.union_and_reindex import union_dh_statistics
+              dh_statistics = union_dh_statistics(indexed_centroid)
+              member_crystals = []
               for obs in all_experimental_models[crystal_model]:
+                self.check_budget()
                 try:
-                  explist = ExperimentList()
                   self.known_crystal_models = None #[obs.crystals()[0]]
 
                   # Make sure the crystal is rotated using the best_similarity_transformation
                   # with respect to the centroid model. Otherwise dh values will be junk
-                  from cctbx_orientation_ext import crystal_orientation
-                  cryst_ref_ori = crystal_orientation(explist_centroid.crystals()[0].get_A(), True)
-                  cryst_tmp_ori = crystal_orientation(obs.crystals()[0].get_A(), True)
-                  best_similarity_transform = cryst_tmp_ori.best_similarity_transformation(
-                    other = cryst_ref_ori, fractional_length_tolerance = 10.00,
-                    unimodular_generator_range=1)
-                  cryst_tmp_ori_best=cryst_tmp_ori.change_basis(best_similarity_transform)
+                  # The centroid and the members are trial models, the transformation is cached
+                  cryst_tmp_ori_best = similarity.align(known_crystal_models[crystal_model], obs.crystals()[0],
+                    fractional_length_tolerance = 10.00, unimodular_generator_range=1)
                   obs.crystals()[0].set_A(cryst_tmp_ori_best.reciprocal_matrix())
 
                   for i,imageset in enumerate(imagesets):
@@ -1393,63 +1639,37 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
                                    goniometer=imageset.get_goniometer(),
                                    scan=imageset.get_scan(),
                                    crystal=obs.crystals()[0])
-                    explist.append(exp)
-                  reidxr = iota_indexer(union_observed, imagesets,params=self.params)
-                  reidxr.calculate_fractional_hkl_from_Ainverse_q(reidxr.reflections, explist)
-                  experiments_tmp = explist
-                  indexed_tmp = reidxr.reflections
-                  # FIXME take out
-
-                  indexed_tmp['id'].set_selected(flex.size_t(range(len(indexed_tmp))),tmp_counter)
-                  all_indexed_tmp.extend(indexed_tmp)
+                  member_crystals.append(obs.crystals()[0])
                   all_experiments_tmp.append(exp)
                   tmp_counter +=1
-
-                  # find dh = |h_frac - h_centroid|
-                  indexed_idxlist = [idx for idx,elem in enumerate(indexed_tmp['xyzobs.mm.value'])
-                                     if elem in indexed_centroid['xyzobs.mm.value']]
-                  dh_list_tmp = flex.double()
-                  for idx in indexed_idxlist:
-                    centroid_list_idx = list(indexed_centroid['xyzobs.mm.value']).index(indexed_tmp['xyzobs.mm.value'][idx])
-                    x = indexed_centroid['miller_index'][centroid_list_idx]
-                    y = indexed_tmp['fractional_miller_index'][idx]
-                    if indexed_centroid['miller_index'][centroid_list_idx] != indexed_tmp['miller_index'][idx]:
-                      continue
-                    if indexed_centroid['miller_index'][centroid_list_idx] not in hkl_all_values:
-                      hkl_all_values[indexed_centroid['miller_index'][centroid_list_idx]] = flex.vec3_double()
-                    hkl_all_values[indexed_centroid['miller_index'][centroid_list_idx]].append(y)
-                    if x == (0,0,0): continue
-                  print ('finished evaluating dh_list for crystal model ',crystal_model)
+                except Watchdog_TimeoutError:
+                  raise
                 except Exception as e:
                   print ('Reindexing with candidate lattices on union set failed',str(e))
+              # find dh = |h_frac - h_centroid|
+              # Fractional HKLs of the union spots for all cluster members in one pass. The
+              # centroid was evaluated on the same union spots, so its rlp are shared
+              try:
+                if len(member_crystals) > 0:
+                  from exafel_project.ADSE13_25.indexing.indexer_iota import Ainverse_stack, fractional_hkl_from_Ainverse_stack
+                  member_hkl, member_hkl_frac = fractional_hkl_from_Ainverse_stack(
+                    Ainverse_stack(member_crystals), indexed_centroid['rlp'])
+                  dh_statistics.add_members(member_hkl, member_hkl_frac)
+                print ('finished evaluating dh_list for crystal model ',crystal_model)
+              except Exception as e:
+                print ('Reindexing with candidate lattices on union set failed',str(e))
               # Get a sense of the variability in dh. Assign Z-score cutoff from there
               try:
                 #import pdb; pdb.set_trace()
                 Z_cutoff = self.params.iota.random_sub_sampling.Z_cutoff
                 # Now go through the spots indexed by the cluster center and reject if dh greater than Z_cutoff
-                indexed_spots_idx = []
-                #import pdb; pdb.set_trace()
-                for ii,refl in enumerate(indexed_centroid):
-                  dh = flex.double([refl['miller_index'][0]-refl['fractional_miller_index'][0],
-                                refl['miller_index'][1]-refl['fractional_miller_index'][1],
-                                refl['miller_index'][2]-refl['fractional_miller_index'][2]]).norm()
-                  hfrac,kfrac,lfrac = hkl_all_values[refl['miller_index']].parts()
-                  # FIXME arbitrary cutoff: if not enough datapoints, cant do a statistical analysis
-                  if len(list(hfrac)) < 3:
-                    continue
-                  dh_cutoff = hfrac.sample_standard_deviation()*hfrac.sample_standard_deviation()+ \
-                              kfrac.sample_standard_deviation()*kfrac.sample_standard_deviation()+ \
-                              lfrac.sample_standard_deviation()*lfrac.sample_standard_deviation()
-                  dh_cutoff = math.sqrt(dh_cutoff)*Z_cutoff
-                  panel = experiments_centroid.detectors()[0][0]
-                  beam = experiments_centroid.beams()[0]
-                  resolution = panel.get_resolution_at_pixel(beam.get_s0(),refl['xyzobs.px.value'][0:2])
-                  print ('MILLER_INDEX_DH_STATS', refl['miller_index'], ' ',dh,' ',dh_cutoff,' ',resolution)
-
-                  #self.refine(all_experiments_tmp, all_indexed_tmp)
-                  #from IPython import embed; embed(); exit()
-                  if dh < dh_cutoff and refl['miller_index'] != (0,0,0):
-                    indexed_spots_idx.append(ii)
+                # dh_cutoff comes from the spread of the fractional HKLs the cluster members gave to
+                # spots with the same HKL as the centroid. Evaluated for all spots at once
+                import numpy as np
+                dh_stats = dh_statistics.dh_mask_by_miller_index(Z_cutoff, min_count=3)
+                for ii in np.flatnonzero(dh_stats.evaluated):
+                  print ('MILLER_INDEX_DH_STATS', indexed_centroid['miller_index'][ii], ' ',dh_stats.dh[ii],' ',dh_stats.dh_cutoff[ii],' ',dh_stats.resolution[ii])
+                indexed_spots_idx = [int(ii) for ii in np.flatnonzero(dh_stats.mask)]
                 # Make sure the number of spots indexed by a model is above a threshold
                 if len(indexed_centroid.select(flex.size_t(indexed_spots_idx))) > self.params.iota.random_sub_sampling.min_indexed_spots:
                   indexed.extend(indexed_centroid.select(flex.size_t(indexed_spots_idx)))
@@ -1464,9 +1684,12 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
                       expt.detector = original_detector
                     experiments.append(expt)
 
+              except Watchdog_TimeoutError:
+                raise
               except Exception as e:
                 print ('dh_list calculation and outlier rejection failed', str(e))
 
+            similarity.show_summary(timestamp)
             # Make sure crytal model numbers are in sequence, example 0,1,2 instead of 0,2,3
             # when model 1 was not used for consensus part. Otherwise refine won't work
             max_id = flex.max(indexed['id'])
@@ -1482,11 +1705,18 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
             self.params.indexing.stills.refine_all_candidates=refine_all_candidates_flag
             # Perform refinement and outlier rejection
             from exafel_project.ADSE13_25.refinement.iota_refiner import iota_refiner
+            self.check_budget()
             refiner=iota_refiner(experiments, indexed, imagesets,self.params)
             experiments,indexed = refiner.run_refinement_and_outlier_rejection()
         else:
           experiments, indexed = self.index(datablock, observed)
+        if self.indexing_cascade is not None:
+          self.indexing_cascade.escalation_done(True, note=self.debug_note)
     except Exception as e:
+      if self.indexing_cascade is not None:
+        self.indexing_cascade.escalation_done(False, note=self.debug_note)
+      if self.budget_exceeded(e):
+        return
       import traceback; traceback.print_exc()
       print str(e), "event", timestamp
       self.debug_write("indexing_failed_%d"%len(observed), "stop")
@@ -1507,8 +1737,11 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     self.debug_write("refine_start")
 
     try:
+      self.check_budget()
       experiments, indexed = self.refine(experiments, indexed)
     except Exception as e:
+      if self.budget_exceeded(e):
+        return
       import traceback; traceback.print_exc()
       print str(e), "event", timestamp
       self.debug_write("refine_failed_%d"%len(indexed), "fail")
@@ -1517,8 +1750,11 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     if self.params.dispatch.reindex_strong:
       self.debug_write("reindex_start")
       try:
+        self.check_budget()
         self.reindex_strong(experiments, observed)
       except Exception as e:
+        if self.budget_exceeded(e):
+          return
         import traceback; traceback.print_exc()
         print str(e), "event", timestamp
         self.debug_write("reindexstrong_failed_%d"%len(indexed), "fail")
@@ -1548,8 +1784,11 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
       self.params.integration.lookup.mask = tuple([a&b for a, b in zip(mask,self.integration_mask)])
 
     try:
+      self.check_budget()
       integrated = self.integrate(experiments, indexed)
     except Exception as e:
+      if self.budget_exceeded(e):
+        return
       import traceback; traceback.print_exc()
       print str(e), "event", timestamp
       self.debug_write("integrate_failed_%d"%len(indexed), "fail")
@@ -1558,6 +1797,26 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 
     self.debug_write("integrate_ok_%d"%len(integrated), "done")
 
+  def trial_sample_size(self, observed):
+    ''' Number of strong spots in the sub-sample of an IOTA trial '''
+    return int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)
+
+  def trial_sample(self, observed, trial):
+    ''' Random sub-sample of the strong spots used by IOTA trial number trial. The selections
+        only depend on the number of spots, so they are reused from the rank's subsample bank '''
+    from exafel_project.ADSE13_25.indexing.subsample_bank import get_subsample_bank
+    return observed.select(get_subsample_bank().selection(len(observed), self.trial_sample_size(observed), trial))
+
+  def index_trial(self, datablock, observed, trial):
+    ''' Index the sub-sample of one IOTA trial. Returns the experiments and the sub-sample '''
+    observed_sample = self.trial_sample(observed, trial)
+    print ('IOTA: SUM_INTENSITY_VALUE',sum(observed_sample['intensity.sum.value']), ' ',trial)
+    if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
+      experiments_tmp, indexed_tmp = self.index_with_iota(datablock, observed_sample)
+    elif self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
+      experiments_tmp, indexed_tmp = self.index(datablock, observed_sample)
+    return experiments_tmp, observed_sample
+
   def save_image(self, image, params, root_path):
     """ Save an image, in either cbf or pickle format.
     @param image dxtbx format object
@@ -1572,6 +1831,7 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 
     try:
       if params.format.file_format == 'cbf':
+        import pycbf
         image._cbf_handle.write_widefile(dest_path, pycbf.CBF,\
           pycbf.MIME_HEADERS|pycbf.MSG_DIGEST|pycbf.PAD_4K, 0)
       elif params.format.file_format == 'pickle':
@@ -1606,29 +1866,23 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
         reflections, imagesets, known_crystal_models=known_crystal_models,
         params=params)
       idxr.index()
+      indexed = idxr.reflections
+      experiments = idxr.experiments
     else:
-      indexing_error = None
-      for method in params.indexing.stills.method_list:
+      # The methods are tried in order or raced on worker processes, see method_race
+      from exafel_project.ADSE13_25.indexing.method_race import index_with_method_list
+      from exafel_project.ADSE13_25.indexing.trial_runner import pack_experiments, unpack_experiments
+      def index_with_method(method):
         params.indexing.method = method
-        try:
-          idxr = iota_indexer.from_parameters(
-            reflections, imagesets,
-            params=params)
-          idxr.index()
-        except Exception as e:
-          print("Couldn't index using method %s"%method)
-          if indexing_error is None:
-            if e is None:
-              e = Exception("Couldn't index using method %s"%method)
-            indexing_error = e
-        else:
-          indexing_error = None
-          break
-      if indexing_error is not None:
-        raise indexing_error
-
-    indexed = idxr.reflections
-    experiments = idxr.experiments
+        idxr = iota_indexer.from_parameters(
+          reflections, imagesets,
+          params=params)
+        idxr.index()
+        return idxr.experiments, idxr.reflections
+      experiments, indexed = index_with_method_list(params.indexing.stills.method_list, index_with_method,
+        self.params.iota.method_race, check=self.check_budget,
+        pack=lambda result: (pack_experiments(result[0]), result[1]),
+        unpack=lambda method, packed: (unpack_experiments(packed[0], imagesets[0]), packed[1]))
 
     if known_crystal_models is not None:
       from dials.array_family import flex
@@ -1711,15 +1965,83 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
     print "Indexed %d strong reflections out of %d"%(len(indexed_reflections), len(strong))
     self.save_reflections(indexed_reflections, self.params.output.reindexedstrong_filename)
 
+  def set_composite_filenames(self, s):
+    ''' Fill in the composite output file names for tag s from the templates in params_cache '''
+    templates = self.params_cache.output
+    self.params.output.indexed_filename                = os.path.join(self.params.output.output_dir, templates.indexed_filename%("idx-" + s))
+    self.params.output.refined_experiments_filename    = os.path.join(self.params.output.output_dir, templates.refined_experiments_filename%("idx-" + s))
+    self.params.output.integrated_filename             = os.path.join(self.params.output.output_dir, templates.integrated_filename%("idx-" + s))
+    self.params.output.integrated_experiments_filename = os.path.join(self.params.output.output_dir, templates.integrated_experiments_filename%("idx-" + s))
+    self.params.output.reindexedstrong_filename        = os.path.join(self.params.output.output_dir, templates.reindexedstrong_filename%("idx-" + s))
+
+  def flush_composite_output(self, force=False):
+    ''' With output.composite_chunks limits set, write the composite accumulators as the next
+        numbered chunk once a limit is reached (or whenever there is something to write if
+        force is True) and start over with empty accumulators, so rank memory stays flat '''
+    if self.composite_chunks is None:
+      return
+    n_experiments = max(len(self.all_indexed_experiments), len(self.all_integrated_experiments))
+    n_reflections = len(self.all_indexed_reflections) + len(self.all_integrated_reflections)
+    if force:
+      if n_experiments == 0 and len(self.all_int_pickles) == 0:
+        return
+    elif not self.composite_chunks.is_due(n_experiments, n_reflections):
+      return
+    counts = dict(n_indexed_experiments    = len(self.all_indexed_experiments),
+                  n_indexed_reflections    = len(self.all_indexed_reflections),
+                  n_integrated_experiments = len(self.all_integrated_experiments),
+                  n_integrated_reflections = len(self.all_integrated_reflections),
+                  n_integration_pickles    = len(self.all_int_pickles))
+    chunk_tag = self.composite_chunks.chunk_tag()
+    self.set_composite_filenames(chunk_tag)
+    int_pickle_tar = None
+    if len(self.all_int_pickles) > 0 and self.params.output.integration_pickle:
+      int_pickle_tar = os.path.join(self.params.output.output_dir,
+        self.params.output.integration_pickle.replace('%d', '%s')%('x', chunk_tag)) + ".tar"
+    # The base class writes the accumulators using composite_tag for the pickle tar file
+    s = self.composite_tag
+    self.composite_tag = chunk_tag
+    try:
+      super(InMemScript, self).finalize()
+    finally:
+      self.composite_tag = s
+    self.composite_chunks.add_chunk(self.params.output, counts, int_pickle_tar)
+
+    from dxtbx.model.experiment_list import ExperimentList
+    from dials.array_family import flex
+    self.all_indexed_experiments = ExperimentList()
+    self.all_indexed_reflections = flex.reflection_table()
+    self.all_integrated_experiments = ExperimentList()
+    self.all_integrated_reflections = flex.reflection_table()
+    self.all_int_pickle_filenames = []
+    self.all_int_pickles = []
+
   def finalize(self):
     if self.params.output.composite_output:
+      if self.composite_chunks is not None:
+        # Write what is left as the last chunk and list all chunks in the manifest
+        self.flush_composite_output(force=True)
+        self.composite_chunks.write()
+        return
+      if self.shared_comm is not None:
+        # All ranks write their results collectively into the shared file(s). The write is a
+        # collective call, so a rank that fails to serialize its results reports the error and
+        # takes part with no blocks instead of leaving the others blocked in the collective
+        from exafel_project.ADSE13_25.output.shared_file import serialize_composite_output, write_shared_file
+        rank = self.shared_comm.Get_rank()
+        error = None
+        try:
+          blocks = serialize_composite_output(self)
+        except Exception as e:
+          print "Rank %d, exception caught while serializing the composite output"%rank
+          print str(e)
+          blocks = []
+          error = "serialization failed: %s"%str(e)
+        write_shared_file(self.shared_comm, self.params.output.shared_file, self.params.output.output_dir,
+                          self.composite_tag, blocks, error=error)
+        return
       # Each process will write its own set of output files
-      s = self.composite_tag
-      self.params.output.indexed_filename                = os.path.join(self.params.output.output_dir, self.params.output.indexed_filename%("idx-" + s))
-      self.params.output.refined_experiments_filename    = os.path.join(self.params.output.output_dir, self.params.output.refined_experiments_filename%("idx-" + s))
-      self.params.output.integrated_filename             = os.path.join(self.params.output.output_dir, self.params.output.integrated_filename%("idx-" + s))
-      self.params.output.integrated_experiments_filename = os.path.join(self.params.output.output_dir, self.params.output.integrated_experiments_filename%("idx-" + s))
-      self.params.output.reindexedstrong_filename        = os.path.join(self.params.output.output_dir, self.params.output.reindexedstrong_filename%("idx-" + s))
+      self.set_composite_filenames(self.composite_tag)
 
     super(InMemScript, self).finalize()
 
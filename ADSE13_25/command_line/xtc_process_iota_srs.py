@@ -52,6 +52,7 @@ iota_phil_str = '''
         .help = Flag to indicate if candidate basis vectors should be refined and whether \
                 outlier rejectionis needed
   }
+  include scope exafel_project.ADSE13_25.indexing.trial_runner.trial_runner_scope
 }
 
 '''
@@ -90,20 +91,25 @@ class InMemScript_iota(InMemScript):
         self.params.indexing.stills.refine_all_candidates=False
 
       # Adding timeout option for IOTA
-      initial_time = time.time()
-      for trial in range(self.params.iota.random_sub_sampling.ntrials):
-        curr_time = time.time()
-        if self.params.iota.timeout_cutoff_sec is not None:
-          if curr_time - initial_time > self.params.iota.timeout_cutoff_sec:
-            raise IOTA_TimeoutError('IOTA_TIMEOUT ',curr_time-initial_time)
-        flex.set_random_seed(trial+1001)
-        observed_sample = observed.select(flex.random_selection(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)))
-        try:
-          print('IOTA:SUM_INTENSITY_VALUE=%d',sum(observed_sample['intensity.sum.value']),' ', trial)
-          experiments_tmp, indexed_tmp = self.index_with_iota(experiments, observed_sample)
-          experiments_list.append(experiments_tmp)
-        except Exception as e:
-          print('Indexing failed for some reason', str(e))
+      from exafel_project.ADSE13_25.indexing.trial_runner import run_trials, elapsed_time_check, \
+        pack_experiments, unpack_experiments
+      from exafel_project.ADSE13_25.indexing.subsample_bank import get_subsample_bank
+      n_sample = int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)
+      if self.params.iota.trial_runner.method == 'process_pool':
+        # Select all the sub-samples in the rank, so the forked workers inherit them
+        get_subsample_bank().index_matrix(len(observed), n_sample, self.params.iota.random_sub_sampling.ntrials)
+      def index_trial(trial):
+        observed_sample = observed.select(get_subsample_bank().selection(len(observed), n_sample, trial))
+        print('IOTA:SUM_INTENSITY_VALUE=%d',sum(observed_sample['intensity.sum.value']),' ', trial)
+        experiments_tmp, indexed_tmp = self.index_with_iota(experiments, observed_sample)
+        return experiments_tmp
+      results = run_trials(self.params.iota.random_sub_sampling.ntrials, index_trial,
+                           self.params.iota.trial_runner,
+                           check=elapsed_time_check(self.params.iota.timeout_cutoff_sec, IOTA_TimeoutError),
+                           pack=pack_experiments,
+                           unpack=lambda trial, packed: unpack_experiments(packed, experiments[0].imageset),
+                           fatal_exceptions=(IOTA_TimeoutError,))
+      experiments_list = [experiments_tmp for experiments_tmp in results if experiments_tmp is not None]
       if self.params.iota.random_sub_sampling.consensus_function == 'unit_cell':
         #from IPython import embed; embed(); exit()
         from exafel_project.ADSE13_25.clustering.old_consensus_functions import get_uc_consensus as get_consensus
@@ -0,0 +1,206 @@
+from __future__ import absolute_import, division, print_function
+from libtbx.phil import parse
+
+#
+# Memory diagnostics for long running xtc_process ranks.
+# The tracker is driven by the debug_start/debug_write calls of InMemScript, so every
+# step written to the debug log (spotfind, index, refine, reindex, integrate ...) is
+# treated as a pipeline stage. For the sampled events, resident memory (RSS) and, if
+# available, a tracemalloc snapshot are taken at every stage boundary. Growth is
+# attributed to the stage that was running and to the source lines that allocated it.
+# Note that tracemalloc only sees allocations made through the Python allocator; memory
+# allocated by C++ extensions (flex arrays, reflection tables) only shows up in RSS and
+# is reported as the untraced part of the stage growth.
+#
+memory_diagnostics_phil_str = '''
+memory {
+  enable = False
+    .type = bool
+    .help = If True, sample RSS and tracemalloc snapshots around each pipeline stage \
+            and write a per-rank report (memory_rankXXXX.out) to the debug folder
+  skip_events = 0
+    .type = int(value_min=0)
+    .help = Number of events processed by a rank before sampling starts. Useful to \
+            leave out the warm up events where caches are being filled
+  event_stride = 1
+    .type = int(value_min=1)
+    .help = Sample every Nth event processed by a rank
+  max_sampled_events = None
+    .type = int(value_min=1)
+    .help = Stop sampling after this many events have been sampled on a rank
+  tracemalloc_frames = 1
+    .type = int(value_min=0)
+    .help = Number of frames stored per allocation by tracemalloc. Set to 0 to only \
+            record RSS. Ignored if tracemalloc is not available
+  top_sites = 10
+    .type = int(value_min=1)
+    .help = Number of allocation sites to report for each stage
+}
+'''
+memory_diagnostics_scope = parse(memory_diagnostics_phil_str)
+
+def get_rss_kb():
+  ''' Current resident set size of this process in kB. Falls back to the peak RSS
+      (ru_maxrss) on systems without /proc '''
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1])
+  except (IOError, OSError, ValueError):
+    pass
+  import resource
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def stage_name(step):
+  ''' Map a debug log step like index_start to the stage name index '''
+  step = step.strip()
+  if step.endswith('_start'):
+    step = step[:-len('_start')]
+  return step
+
+class memory_tracker(object):
+  ''' Keeps per-stage memory statistics for the sampled events of one rank '''
+  def __init__(self, params, rank=0):
+    self.params = params
+    self.rank = rank
+    self.n_events = 0
+    self.n_sampled = 0
+    self.sampling = False
+    self.stage = None
+    self.stage_rss = None
+    self.stage_snapshot = None
+    self.event_ts = None
+    self.event_rss = None
+    self.stage_order = []
+    self.stage_stats = {} # stage -> [count, total_kB, max_kB, traced_kB]
+    self.site_stats = {}  # stage -> {allocation site: bytes}
+    self.event_stats = [] # (timestamp, rss at start, rss at end)
+    self.first_rss = None
+    self.tracemalloc = None
+    if params.tracemalloc_frames > 0:
+      try:
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+          tracemalloc.start(params.tracemalloc_frames)
+        self.tracemalloc = tracemalloc
+      except ImportError:
+        print("Memory diagnostics: tracemalloc not available, only RSS will be recorded")
+
+  def _take_snapshot(self):
+    if self.tracemalloc is None:
+      return None
+    snapshot = self.tracemalloc.take_snapshot()
+    return snapshot.filter_traces((
+      self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+      self.tracemalloc.Filter(False, __file__),
+      self.tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+
+  def _is_sampled(self):
+    n = self.n_events - 1 - self.params.skip_events
+    if n < 0 or n % self.params.event_stride != 0:
+      return False
+    if self.params.max_sampled_events is not None and \
+        self.n_sampled >= self.params.max_sampled_events:
+      return False
+    return True
+
+  def start_event(self, ts):
+    ''' Called once per event, before the first stage is marked '''
+    self.end_event()
+    self.n_events += 1
+    self.sampling = self._is_sampled()
+    if not self.sampling:
+      return
+    self.n_sampled += 1
+    self.event_ts = ts
+    self.event_rss = get_rss_kb()
+    if self.first_rss is None:
+      self.first_rss = self.event_rss
+
+  def mark(self, step, state=None):
+    ''' Close the running stage and open the next one. A step written with a state
+        (done, stop, fail, skip) terminates the event, anything measured after that
+        and before the next event starts is accounted to between_events '''
+    if not self.sampling:
+      return
+    self._close_stage()
+    if state is None:
+      self._open_stage(stage_name(step))
+    else:
+      self._open_stage('between_events')
+
+  def end_event(self):
+    if not self.sampling:
+      return
+    self._close_stage()
+    self.event_stats.append((self.event_ts, self.event_rss, get_rss_kb()))
+    self.sampling = False
+
+  def _open_stage(self, name):
+    self.stage = name
+    self.stage_snapshot = self._take_snapshot()
+    self.stage_rss = get_rss_kb()
+
+  def _close_stage(self):
+    if self.stage is None:
+      return
+    rss = get_rss_kb()
+    growth = rss - self.stage_rss
+    traced = 0
+    if self.stage not in self.stage_stats:
+      self.stage_order.append(self.stage)
+      self.stage_stats[self.stage] = [0, 0, 0, 0]
+      self.site_stats[self.stage] = {}
+    if self.stage_snapshot is not None:
+      snapshot = self._take_snapshot()
+      sites = self.site_stats[self.stage]
+      for stat in snapshot.compare_to(self.stage_snapshot, 'lineno'):
+        if stat.size_diff == 0:
+          continue
+        traced += stat.size_diff
+        site = str(stat.traceback[0])
+        sites[site] = sites.get(site, 0) + stat.size_diff
+    stats = self.stage_stats[self.stage]
+    stats[0] += 1
+    stats[1] += growth
+    stats[2] = max(stats[2], growth)
+    stats[3] += traced//1024
+    self.stage = None
+    self.stage_snapshot = None
+
+  def write_report(self, filename):
+    ''' Write the per-rank report. Stages are listed in the order first seen '''
+    self.end_event()
+    rss = get_rss_kb()
+    f = open(filename, 'w')
+    f.write("Memory diagnostics for rank %d\n"%self.rank)
+    f.write("Sampled %d of %d events (skip_events=%d, event_stride=%d)\n"%(
+      self.n_sampled, self.n_events, self.params.skip_events, self.params.event_stride))
+    if self.first_rss is not None:
+      f.write("RSS at first sampled event %d kB, at report %d kB, growth %d kB\n"%(
+        self.first_rss, rss, rss - self.first_rss))
+    if self.tracemalloc is None:
+      f.write("tracemalloc not used, allocation sites are not available\n")
+    f.write("\n%-24s %8s %12s %12s %12s %12s %12s\n"%(
+      "stage", "count", "total_kB", "mean_kB", "max_kB", "traced_kB", "untraced_kB"))
+    for stage in self.stage_order:
+      count, total, max_growth, traced = self.stage_stats[stage]
+      f.write("%-24s %8d %12d %12.1f %12d %12d %12d\n"%(
+        stage, count, total, total/count, max_growth, traced, total - traced))
+    if self.tracemalloc is not None:
+      f.write("\nTop allocation sites per stage (net bytes over all sampled events)\n")
+      for stage in self.stage_order:
+        sites = self.site_stats[stage]
+        if len(sites) == 0:
+          continue
+        f.write("%s:\n"%stage)
+        top = sorted(sites.items(), key=lambda item: item[1], reverse=True)
+        for site, size in top[:self.params.top_sites]:
+          f.write("  %+12.1f kB  %s\n"%(size/1024, site))
+    f.write("\nPer event RSS (timestamp, start_kB, end_kB, growth_kB)\n")
+    for ts, rss_start, rss_end in self.event_stats:
+      f.write("%s %d %d %d\n"%(ts, rss_start, rss_end, rss_end - rss_start))
+    f.close()
+    print("Memory diagnostics written to %s"%filename)
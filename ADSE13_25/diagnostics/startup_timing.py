@@ -0,0 +1,60 @@
+from __future__ import absolute_import, division, print_function
+import time
+from libtbx.phil import parse
+
+#
+# Startup timing for xtc_process ranks. Records the wall time spent in each startup
+# phase (Python imports, phil scope construction, parameter parsing, psana setup ...)
+# so that the "Python imports" part of the weather plots can be broken down further.
+#
+startup_diagnostics_phil_str = '''
+startup {
+  report = False
+    .type = bool
+    .help = If True, every rank prints the time spent in each startup phase and rank 0 \
+            prints a min/mean/max summary over all ranks (one extra gather over all ranks)
+}
+'''
+startup_diagnostics_scope = parse(startup_diagnostics_phil_str)
+
+class startup_timer(object):
+  ''' Accumulates (phase, seconds) pairs. Each mark closes the phase that started at the
+      previous mark, the first phase starts at t0 '''
+  def __init__(self, t0=None):
+    if t0 is None:
+      t0 = time.time()
+    self.t0 = t0
+    self.last = t0
+    self.phases = []
+
+  def mark(self, phase):
+    now = time.time()
+    self.phases.append((phase, now - self.last))
+    self.last = now
+
+  def total(self):
+    return self.last - self.t0
+
+  def show(self, rank=0):
+    print("STARTUP_TIMING rank %d %s total %.3f"%(rank,
+      " ".join(["%s %.3f"%(phase, seconds) for phase, seconds in self.phases]), self.total()))
+
+  def show_summary(self, comm):
+    ''' Gather the phase timings of all ranks on rank 0 and print min/mean/max for each
+        phase. Has to be called by every rank of comm '''
+    all_phases = comm.gather(self.phases + [('total', self.total())], root=0)
+    if comm.Get_rank() != 0:
+      return
+    names = []
+    seconds = {}
+    for phases in all_phases:
+      for phase, t in phases:
+        if phase not in seconds:
+          names.append(phase)
+          seconds[phase] = []
+        seconds[phase].append(t)
+    print("Startup timing summary over %d ranks (seconds)"%len(all_phases))
+    print("%-24s %10s %10s %10s"%("phase", "min", "mean", "max"))
+    for phase in names:
+      t = seconds[phase]
+      print("%-24s %10.3f %10.3f %10.3f"%(phase, min(t), sum(t)/len(t), max(t)))
@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, print_function
+import math, time
+from collections import OrderedDict
+from libtbx.phil import parse
+from libtbx import group_args
+
+#
+# Dispatch cascade for IOTA processing. Most hits index fine with a single conventional
+# indexing attempt, so in cascade mode every hit first gets one conventional index call and
+# its result is checked against a quality gate (RMSD between observed and predicted spot
+# positions, fraction of the strong spots indexed). Only hits that fail to index or do not
+# pass the gate escalate to the random sub-sampling trials, which cost ntrials indexing
+# attempts. The path taken by each hit and the time spent on it are written to the debug
+# log as notes, and a per-rank summary is printed at the end of the run.
+#
+cascade_phil_str = '''
+cascade
+  .help = Try conventional indexing first and only escalate to random sub-sampling for \
+          hits that fail to index or give a low quality result
+{
+  enable = False
+    .type = bool
+    .help = If True, every hit first gets one conventional indexing attempt
+  max_rmsd_px = 1.5
+    .type = float(value_min=0)
+    .help = Largest RMSD (px) between observed and predicted positions of the indexed spots \
+            for the conventional result to be accepted
+  min_fraction_indexed = 0.5
+    .type = float(value_min=0, value_max=1)
+    .help = Smallest fraction of the strong spots that must be indexed for the conventional \
+            result to be accepted
+}
+'''
+cascade_scope = parse(cascade_phil_str)
+
+# Paths a hit can take through the cascade
+CASCADE_PATHS = ('conventional_accepted', 'conventional_rejected', 'conventional_failed',
+                 'escalated_indexed', 'escalated_failed')
+
+def indexing_quality(experiments, indexed, n_observed):
+  ''' Number and fraction of the n_observed strong spots that were indexed and the RMSD (px)
+      between their observed and predicted positions. The RMSD is None if the reflections
+      carry no predictions '''
+  n_indexed = len(indexed)
+  fraction_indexed = n_indexed/n_observed if n_observed > 0 else 0.0
+  rmsd_px = None
+  if n_indexed > 0:
+    if 'xyzcal.px' in indexed and 'xyzobs.px.value' in indexed:
+      x_obs, y_obs, _ = indexed['xyzobs.px.value'].parts()
+      x_cal, y_cal, _ = indexed['xyzcal.px'].parts()
+      scale = 1.0
+    elif 'xyzcal.mm' in indexed and 'xyzobs.mm.value' in indexed:
+      x_obs, y_obs, _ = indexed['xyzobs.mm.value'].parts()
+      x_cal, y_cal, _ = indexed['xyzcal.mm'].parts()
+      # IOTA supports a single detector, pixels are assumed square
+      scale = 1.0/experiments.detectors()[0][0].get_pixel_size()[0]
+    else:
+      return group_args(n_indexed=n_indexed, fraction_indexed=fraction_indexed, rmsd_px=None)
+    dx = x_obs - x_cal
+    dy = y_obs - y_cal
+    rmsd_px = scale*math.sqrt((dx.dot(dx) + dy.dot(dy))/n_indexed)
+  return group_args(n_indexed=n_indexed, fraction_indexed=fraction_indexed, rmsd_px=rmsd_px)
+
+class indexing_cascade(object):
+  ''' Counts and times of the paths taken by the hits of one rank. Call try_conventional for
+      every hit and, if it returns None, escalation_done once the escalated indexing has
+      finished or failed '''
+  def __init__(self, params):
+    self.params = params
+    self.counts = OrderedDict([(path, 0) for path in CASCADE_PATHS])
+    self.times = OrderedDict([(path, 0.0) for path in CASCADE_PATHS])
+    self.escalation_start = None
+
+  def _record(self, path, elapsed, note=None):
+    self.counts[path] += 1
+    self.times[path] += elapsed
+    if note is not None:
+      note('index_cascade_%s_%.2fs'%(path, elapsed))
+
+  def accept(self, quality):
+    ''' True if the quality of a conventional indexing result passes the gate '''
+    if quality.n_indexed == 0 or quality.fraction_indexed < self.params.min_fraction_indexed:
+      return False
+    return quality.rmsd_px is not None and quality.rmsd_px <= self.params.max_rmsd_px
+
+  def try_conventional(self, index_function, n_observed, note=None, fatal_exceptions=()):
+    ''' Run index_function(), which returns (experiments, indexed), once. Returns its result if
+        it passes the gate and None if the hit has to be escalated. note(string) writes a line
+        to the debug log. Exceptions in fatal_exceptions are passed on '''
+    start = time.time()
+    try:
+      experiments, indexed = index_function()
+    except fatal_exceptions:
+      raise
+    except Exception as e:
+      print('IOTA_CASCADE: conventional indexing failed', str(e))
+      self._record('conventional_failed', time.time() - start, note)
+      self.escalation_start = time.time()
+      return None
+    quality = indexing_quality(experiments, indexed, n_observed)
+    accepted = self.accept(quality)
+    print('IOTA_CASCADE: conventional indexing %d/%d spots indexed, rmsd %s px, %s'%(
+      quality.n_indexed, n_observed,
+      'n/a' if quality.rmsd_px is None else '%.2f'%quality.rmsd_px,
+      'accepted' if accepted else 'escalating'))
+    if accepted:
+      self._record('conventional_accepted', time.time() - start, note)
+      return experiments, indexed
+    self._record('conventional_rejected', time.time() - start, note)
+    self.escalation_start = time.time()
+    return None
+
+  def escalation_done(self, indexed, note=None):
+    ''' Record the end of the escalated indexing of the last hit, indexed tells if it worked '''
+    if self.escalation_start is None:
+      return
+    path = 'escalated_indexed' if indexed else 'escalated_failed'
+    self._record(path, time.time() - self.escalation_start, note)
+    self.escalation_start = None
+
+  def show_summary(self, rank=0):
+    for path in CASCADE_PATHS:
+      count = self.counts[path]
+      print('IOTA_CASCADE rank %d %s %d hits, %.1f s total, %.2f s per hit'%(
+        rank, path, count, self.times[path], self.times[path]/count if count > 0 else 0.0))
@@ -0,0 +1,173 @@
+from __future__ import absolute_import, division, print_function
+import signal, threading, time
+from libtbx.phil import parse
+
+#
+# Per-event and per-stage time budgets for xtc_process/stills_process style processors.
+# Like the memory diagnostics, the watchdog is driven by the debug_start/debug_write calls
+# of the processor: debug_start starts the event clock, every "<stage>_start" step starts a
+# stage clock and a step written with a state (done, stop, fail, skip) ends the event.
+# Budgets are enforced cooperatively through check(), which the processing code calls at
+# stage and IOTA trial boundaries. Optionally a SIGALRM based hard alarm is armed as a
+# fallback for stages that never reach a check. The alarm handler only runs once control
+# is back in the Python interpreter, so it cannot interrupt a single long C++ call.
+# Once a budget is spent the watchdog stays armed until the processor logs the event with
+# the timeout status: a Watchdog_TimeoutError swallowed by an "except Exception" somewhere
+# in DIALS is raised again at the next check, or by the hard alarm after the grace period.
+#
+watchdog_phil_str = '''
+watchdog
+  .help = Time budgets for processing a single event. Events that exceed their budget are \
+          abandoned and logged with the status timeout in the debug files, so that they can \
+          be reprocessed later with bigger budgets (see debug.skip_timeout_events)
+{
+  enable = False
+    .type = bool
+    .help = If True, enforce the budgets below
+  event_budget_sec = None
+    .type = float(value_min=0)
+    .help = Maximum wall time for one event, from the start of the event to its final status
+  stage_budget_sec
+    .help = Maximum wall time for each stage. None means no limit for that stage
+  {
+    spotfind = None
+      .type = float(value_min=0)
+    index = None
+      .type = float(value_min=0)
+    refine = None
+      .type = float(value_min=0)
+    reindex = None
+      .type = float(value_min=0)
+    integrate = None
+      .type = float(value_min=0)
+  }
+  hard_alarm = True
+    .type = bool
+    .help = If True, also arm a SIGALRM timer that fires hard_alarm_grace_sec after a budget \
+            ran out, for code that does not reach a cooperative check. Only available on the \
+            main thread of Unix systems
+  hard_alarm_grace_sec = 30
+    .type = float(value_min=0)
+    .help = Grace period given to the cooperative checks before the hard alarm fires
+}
+'''
+watchdog_scope = parse(watchdog_phil_str)
+
+class Watchdog_TimeoutError(Exception):
+  """Raised when an event or one of its stages used up its time budget """
+  def __init__(self, stage, elapsed, budget, scope='stage'):
+    Exception.__init__(self, 'WATCHDOG_TIMEOUT %s %s took %.1f s, budget %.1f s'%(scope, stage, elapsed, budget))
+    self.stage = stage
+    self.elapsed = elapsed
+    self.budget = budget
+    self.scope = scope
+
+class event_watchdog(object):
+  ''' Keeps the event and stage clocks and raises Watchdog_TimeoutError once a budget is spent '''
+  def __init__(self, params):
+    self.params = params
+    self.active = False
+    self.stage = None
+    self.event_start = None
+    self.stage_start = None
+    self.timed_out = None
+    self.use_alarm = False
+    if params.hard_alarm and hasattr(signal, 'setitimer') and \
+        isinstance(threading.current_thread(), threading._MainThread):
+      try:
+        signal.signal(signal.SIGALRM, self._alarm)
+        self.use_alarm = True
+      except ValueError:
+        pass
+
+  def stage_budget(self, stage):
+    return getattr(self.params.stage_budget_sec, stage, None)
+
+  def start_event(self):
+    self.active = True
+    self.timed_out = None
+    self.event_start = self.stage_start = time.time()
+    self.stage = 'start'
+    self._arm()
+
+  def mark(self, step, state=None):
+    ''' Follow a debug log step. A step with a state ends the event '''
+    if not self.active:
+      return
+    if state is not None:
+      if self.timed_out is not None and state != 'timeout':
+        print('WATCHDOG: event ended with status %s after a swallowed timeout: %s'%(state.strip(), self.timed_out))
+      self.end_event()
+      return
+    step = step.strip()
+    if step.endswith('_start'):
+      step = step[:-len('_start')]
+    self.stage = step
+    self.stage_start = time.time()
+    self._arm()
+
+  def end_event(self):
+    self.active = False
+    self._disarm()
+
+  def _exceeded(self, now):
+    ''' Return (scope, elapsed, budget) of a spent budget, or None '''
+    budget = self.stage_budget(self.stage)
+    if budget is not None and now - self.stage_start > budget:
+      return 'stage', now - self.stage_start, budget
+    budget = self.params.event_budget_sec
+    if budget is not None and now - self.event_start > budget:
+      return 'event', now - self.event_start, budget
+    return None
+
+  def _remaining(self, now):
+    ''' Seconds until the first budget runs out, None if there is no budget '''
+    remaining = []
+    budget = self.stage_budget(self.stage)
+    if budget is not None:
+      remaining.append(budget - (now - self.stage_start))
+    if self.params.event_budget_sec is not None:
+      remaining.append(self.params.event_budget_sec - (now - self.event_start))
+    if len(remaining) == 0:
+      return None
+    return min(remaining)
+
+  def check(self):
+    ''' Cooperative check, to be called at stage and trial boundaries '''
+    if not self.active:
+      return
+    exceeded = self._exceeded(time.time())
+    if exceeded is not None:
+      scope, elapsed, budget = exceeded
+      error = Watchdog_TimeoutError(self.stage, elapsed, budget, scope)
+      if self.timed_out is None:
+        self.timed_out = str(error)
+      # Stays active until the event is logged, see mark. The hard alarm fires again after the
+      # grace period in case the error is swallowed before it reaches the processor
+      self._arm_grace()
+      raise error
+
+  def _arm(self):
+    if not self.use_alarm:
+      return
+    remaining = self._remaining(time.time())
+    if remaining is None:
+      self._disarm()
+      return
+    signal.setitimer(signal.ITIMER_REAL, max(remaining, 0.0) + self.params.hard_alarm_grace_sec)
+
+  def _arm_grace(self):
+    if self.use_alarm:
+      signal.setitimer(signal.ITIMER_REAL, max(self.params.hard_alarm_grace_sec, 1.0))
+
+  def _disarm(self):
+    if self.use_alarm:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+
+  def _alarm(self, signum, frame):
+    if not self.active:
+      return
+    print('WATCHDOG: hard alarm in stage %s'%self.stage)
+    self.check()
+    # Only reached if the budgets changed underneath the timer
+    self._arm()
@@ -34,9 +34,76 @@ from dxtbx.model.experiment_list import ExperimentList
 from dials.algorithms.indexing.stills_indexer import StillsIndexer
 import pkg_resources
 
+def reset_experiments_to_stills(experiments):
+  ''' Ensure the indexer and downstream applications treat the experiments as a set of stills '''
+  from dxtbx.imageset import ImageSet
+  # DIALS 2.0 stuff here
+  for experiment in experiments:
+    experiment.imageset=ImageSet(experiment.imageset.data(), experiment.imageset.indices())
+    experiment.imageset.set_scan(None)
+    experiment.imageset.set_goniometer(None)
+    experiment.scan=None
+    experiment.goniometer=None
+
+def Ainverse_stack(crystals):
+  ''' (M,3,3) numpy array of the inverse A matrices of M crystal models '''
+  import numpy as np
+  A = np.array([crystal.get_A() for crystal in crystals], dtype=np.float64).reshape(-1, 3, 3)
+  return np.linalg.inv(A)
+
+def fractional_hkl_from_Ainverse_stack(Ainverse, rlp):
+  ''' hkl_frac = A^-1*q for a stack of M inverse A matrices, an (M,3,3) array (see
+      Ainverse_stack), and the rlp of N reflections, a flex.vec3_double or (N,3) array, in one
+      vectorized pass. Returns the integer hkl, rounded half away from zero like
+      flex.vec3_double.iround, and the fractional hkl as (M,N,3) numpy arrays '''
+  import numpy as np
+  Ainverse = np.asarray(Ainverse, dtype=np.float64).reshape(-1, 3, 3)
+  if hasattr(rlp, 'as_double'):
+    rlp = rlp.as_double().as_numpy_array()
+  q = np.asarray(rlp, dtype=np.float64).reshape(-1, 3)
+  hkl_frac = np.einsum('mij,nj->mni', Ainverse, q)
+  hkl = (np.sign(hkl_frac)*np.floor(np.abs(hkl_frac) + 0.5)).astype(np.int64)
+  return hkl, hkl_frac
+
+class iota_indexing_context(object):
+  ''' Per event state shared by all the IOTA trials of an event. Every trial indexes a
+      different sub-sample of the same strong spots on the same image, so the parts of the
+      indexer setup that do not depend on the sub-sample are done once here:
+        - the indexing parameters are copied once (no scan-varying refinement),
+        - the experiments are reset to stills once,
+        - the spot centroids are mapped to mm and reciprocal space (rlp) once for all spots,
+        - the symmetry handler is built by the first indexer and then reused.
+      A trial is then just a selection of rows of reflections, see select. Pass the context
+      to iota_indexer.from_parameters or iota_indexer to skip the repeated setup '''
+  def __init__(self, reflections, experiments, params):
+    import copy
+    self.params = copy.deepcopy(params)
+    # don't do scan-varying refinement during indexing
+    self.params.refinement.parameterisation.scan_varying = False
+    if self.params.indexing.basis_vector_combinations.max_refine is libtbx.Auto:
+      self.params.indexing.basis_vector_combinations.max_refine = 5
+    self.experiments = experiments
+    reset_experiments_to_stills(self.experiments)
+    self.reflections = reflections.copy()
+    if 'imageset_id' not in self.reflections:
+      self.reflections['imageset_id'] = self.reflections['id']
+    self.reflections.centroid_px_to_mm(self.experiments)
+    self.reflections.map_centroids_to_reciprocal_space(self.experiments)
+    self.reflections.calculate_entering_flags(self.experiments)
+    self.symmetry_handler = None
+
+  def select(self, selection):
+    ''' Rows of the mapped spots used by one trial, e.g. a sub-sample selection or the union
+        of the sub-samples of a cluster '''
+    return self.reflections.select(selection)
+
 class iota_indexer(StillsIndexer):
 
-  def __init__(self, reflections, experiments, params=None):
+  # iota_indexing_context of the event, if any. Set before the base class __init__ runs
+  # because it calls _setup_symmetry and setup_indexing as well
+  indexing_context = None
+
+  def __init__(self, reflections, experiments, params=None, indexing_context=None):
     '''Init function for iota_indexer is different from indexer_base in that
        _setup_symmetry function is not called. All features only work for stills'''
 
@@ -44,6 +111,8 @@ class iota_indexer(StillsIndexer):
     # FIXME this should not be called the stills_indexer __init__ method
     # FIXME need to write own __init__ function
     #stills_indexer.__init__(self, reflections, imagesets, params)
+    if indexing_context is not None:
+      self.indexing_context = indexing_context
     self.reflections = reflections
     self.experiments = experiments
     #if params is None: params = master_params
@@ -83,12 +152,44 @@ class iota_indexer(StillsIndexer):
     self.d_min = None
     self.setup_indexing()
 
+  def _setup_symmetry(self):
+    ''' Build the symmetry handler, or reuse the one of the indexing context '''
+    context = self.indexing_context
+    if context is not None and context.symmetry_handler is not None:
+      self._symmetry_handler = context.symmetry_handler
+      return
+    super(iota_indexer, self)._setup_symmetry()
+    if context is not None:
+      context.symmetry_handler = self._symmetry_handler
+
+  def setup_indexing(self):
+    ''' Same as the DIALS setup_indexing, except that the centroids of spots coming from an
+        indexing context are already mapped to mm and reciprocal space '''
+    if self.indexing_context is None or 'rlp' not in self.reflections:
+      super(iota_indexer, self).setup_indexing()
+      return
+    if len(self.reflections) == 0:
+      raise Sorry("No reflections left to index!")
+    self.find_max_cell()
+    if self.params.sigma_phi_deg is not None:
+      import math
+      var_x, var_y, _ = self.reflections['xyzobs.mm.variance'].parts()
+      var_phi_rad = flex.double(var_x.size(), (math.pi/180*self.params.sigma_phi_deg)**2)
+      self.reflections['xyzobs.mm.variance'] = flex.vec3_double(var_x, var_y, var_phi_rad)
+    self.reflections['id'] = flex.int(len(self.reflections), -1)
+
   @staticmethod
   def from_parameters(reflections, experiments,
-                      known_crystal_models=None, params=None):
-    '''Sets up indexer object that will be used for indexing '''
+                      known_crystal_models=None, params=None, indexing_context=None):
+    '''Sets up indexer object that will be used for indexing. With an indexing_context,
+       reflections should be a selection of the context (see iota_indexing_context.select);
+       its experiments are used and params defaults to its parameters '''
 #    if params is None:
 #      params = master_params
+    if indexing_context is not None:
+      experiments = indexing_context.experiments
+      if params is None:
+        params = indexing_context.params
 
     if known_crystal_models is not None:
       #from dials.algorithms.indexing.known_orientation \
@@ -129,14 +230,9 @@ class iota_indexer(StillsIndexer):
       params.indexing.basis_vector_combinations.max_refine = 5
 
     # Ensure the indexer and downstream applications treat this as set of stills
-    from dxtbx.imageset import ImageSet
-    # DIALS 2.0 stuff here
-    for experiment in experiments:
-      experiment.imageset=ImageSet(experiment.imageset.data(), experiment.imageset.indices())
-      experiment.imageset.set_scan(None)
-      experiment.imageset.set_goniometer(None)
-      experiment.scan=None
-      experiment.goniometer=None
+    # The experiments of an indexing context have been reset once for the event
+    if indexing_context is None:
+      reset_experiments_to_stills(experiments)
 
     # Old code prior to DIALS 2.0
     #reset_sets = []
@@ -157,7 +253,8 @@ class iota_indexer(StillsIndexer):
       #  reflections, experiments, params, known_crystal_models)
     for entry_point in pkg_resources.iter_entry_points("dials.index.basis_vector_search"):
       if params.indexing.method==entry_point.name:
-        idxr=IOTA_StillsIndexerBasisVectorSearch(reflections, experiments, params=params)
+        idxr=IOTA_StillsIndexerBasisVectorSearch(reflections, experiments, params=params,
+                                                 indexing_context=indexing_context)
         return idxr
           
     #elif params.indexing.method == "fft3d":
@@ -391,15 +488,15 @@ class iota_indexer(StillsIndexer):
                 hklfrac=flex.mat3_double(len(miller_indices), sqr(cryst.get_A()).inverse())*self.reflections['rlp'].select(self.reflections['id']==i_expt)
                 self.reflections['fractional_miller_index'].set_selected(self.reflections['id']==i_expt, hklfrac)
 
-
 class IOTA_StillsIndexerKnownOrientation(IndexerKnownOrientation, iota_indexer):
     pass
 
 
 class IOTA_StillsIndexerBasisVectorSearch(iota_indexer, BasisVectorSearch):
-    def __init__(self, reflections, experiments, params):
+    def __init__(self, reflections, experiments, params, indexing_context=None):
+      self.indexing_context = indexing_context
       BasisVectorSearch.__init__(self,reflections, experiments, params)
-      iota_indexer.__init__(self,reflections, experiments, params)
+      iota_indexer.__init__(self,reflections, experiments, params, indexing_context=indexing_context)
     #pass
 
 
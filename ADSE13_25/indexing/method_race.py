@@ -0,0 +1,176 @@
+from __future__ import absolute_import, division, print_function
+import time
+from collections import OrderedDict
+from libtbx.phil import parse
+
+#
+# Runs the indexing methods of indexing.stills.method_list for one set of spots. The methods
+# used to be tried one after the other until one succeeded, so a hit that only indexes with
+# the last method paid for all the failed attempts before it. With method_race.enable every
+# method is started at once on a forked worker process and the result of the first method in
+# priority order that succeeds is taken, i.e. the same result as the sequential loop, but
+# without waiting for the failed methods one after the other. Workers of methods that are no
+# longer needed are terminated. Per-method success counts and latencies are kept for the
+# rank, and with auto_reorder the priority order follows the observed success rate.
+#
+method_race_phil_str = '''
+method_race
+  .help = How the methods of indexing.stills.method_list are tried
+{
+  enable = False
+    .type = bool
+    .help = If True, all methods of the method_list are started concurrently on forked worker \
+            processes and the first success in priority order is used. Otherwise they are \
+            tried one after the other. The workers are forked after MPI_Init, which \
+            several MPI transports (e.g. InfiniBand verbs, Cray/Slingshot) do not support: \
+            check the MPI library of the site before enabling it with mp.method=mpi
+  poll_interval_sec = 0.1
+    .type = float(value_min=0)
+    .help = How often the rank checks the timeout while waiting for the workers
+  auto_reorder = False
+    .type = bool
+    .help = If True, order the method_list by the success rate (then the mean latency) seen so \
+            far on this rank. Methods with less than min_attempts attempts are tried first
+  min_attempts = 20
+    .type = int(value_min=1)
+    .help = Number of attempts after which the statistics of a method are used by auto_reorder
+}
+'''
+method_race_scope = parse(method_race_phil_str)
+
+class indexing_method_stats(object):
+  ''' Success counts and latencies of the indexing methods of one rank '''
+  def __init__(self):
+    self.attempts = OrderedDict()
+    self.successes = OrderedDict()
+    self.seconds = OrderedDict()
+
+  def record(self, method, success, elapsed):
+    if method not in self.attempts:
+      self.attempts[method] = 0
+      self.successes[method] = 0
+      self.seconds[method] = 0.0
+    self.attempts[method] += 1
+    self.successes[method] += int(success)
+    self.seconds[method] += elapsed
+
+  def success_rate(self, method):
+    if self.attempts.get(method, 0) == 0:
+      return 0.0
+    return self.successes[method]/self.attempts[method]
+
+  def mean_latency(self, method):
+    if self.attempts.get(method, 0) == 0:
+      return 0.0
+    return self.seconds[method]/self.attempts[method]
+
+  def ordered(self, methods, min_attempts):
+    ''' methods by decreasing success rate, then increasing mean latency. Methods attempted
+        less than min_attempts times count as always successful, so they are tried early until
+        their statistics are known. Ties keep the given order '''
+    def key(method):
+      if self.attempts.get(method, 0) < min_attempts:
+        return (-1.0, 0.0)
+      return (-self.success_rate(method), self.mean_latency(method))
+    return sorted(methods, key=key)
+
+  def show_summary(self, rank=0):
+    for method in self.attempts:
+      print('IOTA_INDEXING_METHOD rank %d %s %d/%d indexed, %.2f s per attempt'%(
+        rank, method, self.successes[method], self.attempts[method], self.mean_latency(method)))
+
+_stats = None
+def get_method_stats():
+  ''' The indexing_method_stats of this rank '''
+  global _stats
+  if _stats is None:
+    _stats = indexing_method_stats()
+  return _stats
+
+# Set by index_with_method_list right before the worker processes are forked
+_index_function = None
+_pack_function = None
+
+def _run_method_in_worker(method):
+  st = time.time()
+  try:
+    result = _index_function(method)
+    if _pack_function is not None:
+      result = _pack_function(result)
+    return True, time.time() - st, result
+  except Exception as e:
+    return False, time.time() - st, str(e)
+
+def _run_serial(methods, index_function, stats, check):
+  indexing_error = None
+  for method in methods:
+    if check is not None:
+      check()
+    st = time.time()
+    try:
+      result = index_function(method)
+    except Exception as e:
+      stats.record(method, False, time.time() - st)
+      print("Couldn't index using method %s"%method)
+      if indexing_error is None:
+        indexing_error = e
+    else:
+      stats.record(method, True, time.time() - st)
+      return result
+  raise indexing_error
+
+def index_with_method_list(methods, index_function, params, check=None, pack=None, unpack=None):
+  ''' Return index_function(method) of the first method of methods, in priority order, that
+      does not raise. If all of them fail the error of the first one is raised.
+      params: the method_race scope
+      check: called while waiting for the workers, raises to abandon the event
+      pack, unpack: pack(result) runs in the worker to make the result picklable and
+             unpack(method, packed) rebuilds it in the rank '''
+  import multiprocessing
+  from libtbx.utils import Sorry
+  if len(methods) == 0:
+    raise Sorry('No indexing method given')
+  stats = get_method_stats()
+  if params.auto_reorder:
+    methods = stats.ordered(methods, params.min_attempts)
+  # Daemonic processes, e.g. the workers of the trial runner, cannot fork workers of their own
+  if not params.enable or len(methods) <= 1 or multiprocessing.current_process().daemon:
+    return _run_serial(methods, index_function, stats, check)
+
+  global _index_function, _pack_function
+  _index_function = index_function
+  _pack_function = pack
+  pool = multiprocessing.Pool(processes=len(methods))
+  try:
+    pending = [pool.apply_async(_run_method_in_worker, (method,)) for method in methods]
+    pool.close()
+    indexing_error = None
+    for method, async_result in zip(methods, pending):
+      while True:
+        if check is not None:
+          check()
+        try:
+          success, elapsed, result = async_result.get(params.poll_interval_sec)
+          break
+        except multiprocessing.TimeoutError:
+          continue
+      stats.record(method, success, elapsed)
+      if success:
+        # Methods further down the list are no longer needed
+        pool.terminate()
+        pool.join()
+        if unpack is not None:
+          result = unpack(method, result)
+        return result
+      print("Couldn't index using method %s"%method)
+      if indexing_error is None:
+        indexing_error = Exception(result)
+    pool.join()
+  except BaseException:
+    pool.terminate()
+    pool.join()
+    raise
+  finally:
+    _index_function = None
+    _pack_function = None
+  raise indexing_error
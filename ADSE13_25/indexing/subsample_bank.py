@@ -0,0 +1,99 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+from collections import OrderedDict
+
+#
+# Per-rank cache of the random sub-sample selections used by the IOTA trials.
+# Trial number trial always selects flex.random_selection(n_spots, n_sample) right after
+# flex.set_random_seed(trial+1001), so the selected indices only depend on the number of
+# strong spots, the sub-sample size and the trial number, not on the event. The bank keeps
+# the selections of every (n_spots, n_sample) seen so far, together with the state of the
+# flex random generator right after each of them was drawn. A later event with the same spot
+# count gets the cached selection and the generator is set back to the cached state instead
+# of drawing again, so what the indexing that follows draws does not depend on which
+# selections happened to be cached. A whole batch of trials can be selected at once with
+# index_matrix/select_trials, e.g. in the rank before the trial workers are forked.
+# A cached trial holds its selection plus the 624 word generator state (about 5 kB), hence
+# the small default number of banks.
+#
+class subsample_bank(object):
+  ''' Sub-sample selections keyed by (n_spots, n_sample), entry i of a bank is the
+      (selection, generator state) of trial i. At most max_banks banks are kept, least
+      recently used first out '''
+  def __init__(self, max_banks=16):
+    self.max_banks = max_banks
+    self.banks = OrderedDict() # (n_spots, n_sample) -> list of (flex.size_t, state)
+    self.hits = 0
+    self.misses = 0
+
+  def _bank(self, n_spots, n_sample):
+    key = (n_spots, n_sample)
+    bank = self.banks.pop(key, None)
+    if bank is None:
+      bank = []
+      if len(self.banks) >= self.max_banks:
+        self.banks.popitem(last=False)
+    self.banks[key] = bank
+    return bank
+
+  def _fill(self, bank, n_spots, n_sample, last_trial):
+    ''' Draw the selections of the trials up to last_trial that are not in bank yet '''
+    from scitbx.array_family import flex
+    if last_trial < len(bank):
+      self.hits += 1
+      return
+    self.misses += 1
+    for missing_trial in range(len(bank), last_trial+1):
+      flex.set_random_seed(missing_trial+1001)
+      selection = flex.random_selection(n_spots, n_sample)
+      bank.append((selection, flex.random_generator.getstate()))
+
+  def selection(self, n_spots, n_sample, trial):
+    ''' Same as flex.set_random_seed(trial+1001); flex.random_selection(n_spots, n_sample),
+        including the state the global random generator is left in '''
+    from scitbx.array_family import flex
+    bank = self._bank(n_spots, n_sample)
+    self._fill(bank, n_spots, n_sample, trial)
+    selection, state = bank[trial]
+    # Seeding is cheap and also resets scitbx.random, the flex generator gets the state it
+    # had right after drawing the selection
+    flex.set_random_seed(trial+1001)
+    flex.random_generator.setstate(state)
+    return selection
+
+  def index_matrix(self, n_spots, n_sample, ntrials, first_trial=0):
+    ''' Selections of ntrials consecutive trials as one flex.size_t with an
+        (ntrials, n_sample) grid. The global random generator is left as it was '''
+    from scitbx.array_family import flex
+    state = flex.random_generator.getstate()
+    bank = self._bank(n_spots, n_sample)
+    self._fill(bank, n_spots, n_sample, first_trial + ntrials - 1)
+    flex.random_generator.setstate(state)
+    matrix = flex.size_t()
+    for selection, trial_state in bank[first_trial:first_trial + ntrials]:
+      matrix.extend(selection)
+    matrix.reshape(flex.grid(ntrials, n_sample))
+    return matrix
+
+  def select_trials(self, observed, n_sample, ntrials, first_trial=0):
+    ''' Sub-samples of observed for ntrials consecutive trials, using a single select on the
+        flattened index matrix. The global random generator is left as it was '''
+    from scitbx.array_family import flex
+    if ntrials == 0:
+      return []
+    matrix = self.index_matrix(len(observed), n_sample, ntrials, first_trial)
+    matrix.reshape(flex.grid(len(matrix)))
+    selected = observed.select(matrix)
+    return [selected[i*n_sample:(i+1)*n_sample] for i in range(ntrials)]
+
+  def show_summary(self, rank=0):
+    print('IOTA_SUBSAMPLE_BANK rank %d %d spot counts, %d hits, %d misses'%(
+      rank, len(self.banks), self.hits, self.misses))
+
+_bank = None
+def get_subsample_bank():
+  ''' The subsample_bank of this rank '''
+  global _bank
+  if _bank is None:
+    _bank = subsample_bank()
+  return _bank
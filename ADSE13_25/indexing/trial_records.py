@@ -0,0 +1,174 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import copy
+import numpy as np
+
+#
+# Compact record of the IOTA random sub-sampling trials of one event. Instead of keeping an
+# ExperimentList and a sub-sampled reflection table per trial for the whole event, every
+# crystal model found by a trial is stored as one row of preallocated arrays: the A matrix,
+# the space group (an index into the distinct space groups seen), the spots of the
+# sub-sample (a boolean row over the strong spots of the event) and a few scalar scores.
+# Crystal models are rebuilt from the arrays when the consensus needs them and full
+# experiments only for the models that are used after the consensus, e.g. the members of
+# the winning clusters or the debugging dumps.
+#
+
+class trial_record_view(object):
+  ''' Stand-in for the single crystal ExperimentList of one trial, which is all the
+      consensus functions use (experiments_list[i].crystals()[0]) '''
+  def __init__(self, crystal):
+    self.crystal = crystal
+
+  def crystals(self):
+    return [self.crystal]
+
+class iota_trial_records(object):
+  ''' Crystal models of the trials of one event. n_spots is the number of strong spots the
+      spot_id column refers to, capacity the expected number of models (the arrays grow if
+      needed). With keep_miller_indices the miller indices the trial assigned to its spots are
+      kept as well, for the debugging dumps '''
+  def __init__(self, n_spots, capacity=1, keep_miller_indices=False):
+    self.n_spots = n_spots
+    self.count = 0
+    capacity = max(1, capacity)
+    self.A = np.zeros((capacity, 9))
+    self.space_group_id = np.zeros(capacity, dtype=np.int32)
+    self.trial = np.zeros(capacity, dtype=np.int32)
+    self.n_sample = np.zeros(capacity, dtype=np.int32)
+    self.n_indexed = np.full(capacity, -1, dtype=np.int32)
+    self.selection = np.zeros((capacity, n_spots), dtype=bool)
+    if keep_miller_indices:
+      self.miller_index = np.zeros((capacity, n_spots, 3), dtype=np.int32)
+    else:
+      self.miller_index = None
+    # One crystal model per distinct space group, used as template when rebuilding models
+    self.space_group_templates = []
+    self._space_group_keys = {}
+    self._crystals = []
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.count
+    if i < 0 or i >= self.count:
+      raise IndexError('trial record index out of range')
+    return trial_record_view(self.crystal(i))
+
+  def __iter__(self):
+    for i in range(self.count):
+      yield self[i]
+
+  def _grow(self):
+    capacity = 2*len(self.A)
+    def grown(array, fill=0):
+      new = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+      new[:len(array)] = array
+      return new
+    self.A = grown(self.A)
+    self.space_group_id = grown(self.space_group_id)
+    self.trial = grown(self.trial)
+    self.n_sample = grown(self.n_sample)
+    self.n_indexed = grown(self.n_indexed, fill=-1)
+    self.selection = grown(self.selection)
+    if self.miller_index is not None:
+      self.miller_index = grown(self.miller_index)
+
+  def append(self, trial, crystal, spot_ids, n_indexed=-1, indexed=None):
+    ''' Add the crystal model found by trial on the sub-sample with the given spot_ids.
+        indexed, the reflections indexed by this crystal with their spot_id, is only used
+        with keep_miller_indices '''
+    if self.count == len(self.A):
+      self._grow()
+    i = self.count
+    key = str(crystal.get_space_group().info())
+    if key not in self._space_group_keys:
+      self._space_group_keys[key] = len(self.space_group_templates)
+      self.space_group_templates.append(copy.deepcopy(crystal))
+    self.A[i] = crystal.get_A()
+    self.space_group_id[i] = self._space_group_keys[key]
+    self.trial[i] = trial
+    self.n_sample[i] = len(spot_ids)
+    self.n_indexed[i] = n_indexed
+    self.selection[i, np.fromiter(spot_ids, dtype=np.int64, count=len(spot_ids))] = True
+    if self.miller_index is not None and indexed is not None:
+      rows = np.fromiter(indexed['spot_id'], dtype=np.int64, count=len(indexed))
+      hkl = np.array(list(indexed['miller_index']), dtype=np.int32).reshape(-1, 3)
+      self.miller_index[i, rows] = hkl
+    self.count += 1
+
+  def new_crystal(self, i):
+    ''' A new crystal model rebuilt from record i '''
+    crystal = copy.deepcopy(self.space_group_templates[self.space_group_id[i]])
+    crystal.set_A(tuple(self.A[i]))
+    return crystal
+
+  def crystal(self, i):
+    ''' Crystal model of record i, rebuilt once and then shared '''
+    while len(self._crystals) <= i:
+      self._crystals.append(self.new_crystal(len(self._crystals)))
+    return self._crystals[i]
+
+  def spot_ids(self, i):
+    ''' flex.size_t of the spots in the sub-sample of record i '''
+    from scitbx.array_family import flex
+    return flex.size_t([int(spot) for spot in np.flatnonzero(self.selection[i])])
+
+  def experiment_list(self, i, experiments):
+    ''' ExperimentList of record i on the imageset, beam and detector of the event '''
+    from dxtbx.model.experiment_list import ExperimentList, Experiment
+    explist = ExperimentList()
+    for expt in experiments:
+      explist.append(Experiment(imageset=expt.imageset,
+                                beam=expt.beam,
+                                detector=expt.detector,
+                                goniometer=expt.goniometer,
+                                scan=expt.scan,
+                                crystal=self.new_crystal(i)))
+    return explist
+
+  def experiment_lists(self, experiments):
+    ''' One ExperimentList per record, as the trials used to keep them '''
+    return [self.experiment_list(i, experiments) for i in range(self.count)]
+
+  def observed_samples(self, observed):
+    ''' The sub-sampled reflection table of every record, as the trials used to keep them '''
+    return [observed.select(self.spot_ids(i)) for i in range(self.count)]
+
+  def indexed_experiments_and_reflections(self, experiments, observed):
+    ''' All the records as one ExperimentList and the spots they indexed as one reflection
+        table with the experiment id of each record, for debugging dumps. Needs
+        keep_miller_indices '''
+    from scitbx.array_family import flex
+    from dials.array_family import flex as dials_flex
+    from dxtbx.model.experiment_list import ExperimentList
+    assert self.miller_index is not None, 'Miller indices were not kept'
+    all_experiments = ExperimentList()
+    all_reflections = dials_flex.reflection_table()
+    for i in range(self.count):
+      explist = self.experiment_list(i, experiments)
+      rows = np.flatnonzero(np.any(self.miller_index[i] != 0, axis=1))
+      reflections = observed.select(flex.size_t([int(row) for row in rows]))
+      reflections['miller_index'] = flex.miller_index([tuple(int(x) for x in hkl) for hkl in self.miller_index[i, rows]])
+      reflections['id'] = flex.int(len(reflections), len(all_experiments))
+      all_reflections.extend(reflections)
+      all_experiments.extend(explist)
+    return all_experiments, all_reflections
+
+  @staticmethod
+  def from_lists(experiments_list, observed_samples_list, n_spots):
+    ''' Records of trial results saved as lists of experiments and sub-samples '''
+    records = iota_trial_records(n_spots, capacity=len(experiments_list))
+    for trial, (explist, observed_sample) in enumerate(zip(experiments_list, observed_samples_list)):
+      records.append(trial, explist.crystals()[0], observed_sample['spot_id'])
+    return records
+
+  def nbytes(self):
+    ''' Memory used by the arrays '''
+    total = sum([array.nbytes for array in [self.A, self.space_group_id, self.trial, self.n_sample,
+                                            self.n_indexed, self.selection]])
+    if self.miller_index is not None:
+      total += self.miller_index.nbytes
+    return total
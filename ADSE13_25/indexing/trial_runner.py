@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import time
+from libtbx.phil import parse
+
+#
+# Runs the independent IOTA sub-sampling trials of an event, either one after the other or
+# on a pool of forked worker processes. The workers are forked when the trials of an event
+# start, so they inherit the event (image, strong spots, parameters) from the rank and
+# nothing but the trial number is sent to them. Each worker returns a packed, picklable
+# version of its result (see pack_experiments) that the rank unpacks against its own
+# imagesets. Results are always returned in trial order, so the consensus does not depend
+# on which worker finished first. With the process pool a node can be run with fewer MPI
+# ranks, each using several cores per event, which lowers the latency per event.
+# Note that the workers must not make MPI calls.
+#
+trial_runner_phil_str = '''
+trial_runner
+  .help = How the random sub-sampling trials of an event are run
+{
+  method = *serial process_pool
+    .type = choice
+    .help = serial: run the trials one after the other in the rank. \
+            process_pool: fork nproc worker processes per event and run the trials concurrently. \
+            The workers are forked after MPI_Init, which several MPI transports (e.g. \
+            InfiniBand verbs, Cray/Slingshot) do not support: check the MPI library of \
+            the site before using process_pool with mp.method=mpi
+  nproc = 4
+    .type = int(value_min=1)
+    .help = Number of worker processes for the process_pool method
+  poll_interval_sec = 0.5
+    .type = float(value_min=0)
+    .help = How often the rank checks the timeout while waiting for the workers
+}
+'''
+trial_runner_scope = parse(trial_runner_phil_str)
+
+# Set by run_trials right before the worker processes are forked
+_trial_function = None
+_pack_function = None
+
+def _run_trial_in_worker(trial):
+  try:
+    result = _trial_function(trial)
+    if _pack_function is not None:
+      result = _pack_function(result)
+    return result
+  except Exception as e:
+    print('Indexing failed for some reason', str(e))
+    return None
+
+def pack_experiments(experiments):
+  ''' Picklable version of an experiment list: the beam, detector and crystal models '''
+  return [(expt.beam, expt.detector, expt.crystal) for expt in experiments]
+
+def unpack_experiments(packed, imageset):
+  ''' Rebuild the experiment list packed by pack_experiments on top of imageset '''
+  from dxtbx.model.experiment_list import ExperimentList, Experiment
+  experiments = ExperimentList()
+  for beam, detector, crystal in packed:
+    experiments.append(Experiment(imageset=imageset,
+                                  beam=beam,
+                                  detector=detector,
+                                  goniometer=imageset.get_goniometer(),
+                                  scan=imageset.get_scan(),
+                                  crystal=crystal))
+  return experiments
+
+def run_trials(ntrials, trial_function, params, check=None, pack=None, unpack=None,
+               fatal_exceptions=(), first_trial=0):
+  ''' Run trial_function(trial) for the ntrials trials starting at first_trial and return the
+      results in trial order, with None for the trials that failed.
+      check: called between trials (and while waiting for workers), raises to abandon the
+             event, e.g. on a timeout
+      pack, unpack: with the process pool, pack(result) runs in the worker to make the result
+             picklable and unpack(trial, packed) rebuilds it in the rank
+      fatal_exceptions: exception types that are not treated as a failed trial '''
+  trials = range(first_trial, first_trial + ntrials)
+  if params.method == 'serial' or ntrials <= 1:
+    results = []
+    for trial in trials:
+      if check is not None:
+        check()
+      try:
+        results.append(trial_function(trial))
+      except fatal_exceptions:
+        raise
+      except Exception as e:
+        print('Indexing failed for some reason', str(e))
+        results.append(None)
+    return results
+
+  import multiprocessing
+  global _trial_function, _pack_function
+  _trial_function = trial_function
+  _pack_function = pack
+  pool = multiprocessing.Pool(processes=min(params.nproc, ntrials))
+  try:
+    pending = [pool.apply_async(_run_trial_in_worker, (trial,)) for trial in trials]
+    pool.close()
+    results = []
+    for trial, async_result in zip(trials, pending):
+      while True:
+        if check is not None:
+          check()
+        try:
+          packed = async_result.get(params.poll_interval_sec)
+          break
+        except multiprocessing.TimeoutError:
+          continue
+      if packed is not None and unpack is not None:
+        results.append(unpack(trial, packed))
+      else:
+        results.append(packed)
+    pool.join()
+  except BaseException:
+    pool.terminate()
+    pool.join()
+    raise
+  finally:
+    _trial_function = None
+    _pack_function = None
+  return results
+
+class elapsed_time_check(object):
+  ''' check for run_trials raising error_type once timeout_sec have passed since creation.
+      A timeout of None never raises '''
+  def __init__(self, timeout_sec, error_type):
+    self.timeout_sec = timeout_sec
+    self.error_type = error_type
+    self.start = time.time()
+
+  def __call__(self):
+    if self.timeout_sec is None:
+      return
+    elapsed = time.time() - self.start
+    if elapsed > self.timeout_sec:
+      raise self.error_type('IOTA_TIMEOUT ', elapsed)
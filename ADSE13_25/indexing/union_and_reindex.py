@@ -0,0 +1,124 @@
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from libtbx import group_args
+
+#
+# Helpers for the union_and_reindex finalize method of IOTA. All the member models of a
+# cluster are evaluated on the spots indexed by the cluster centroid (see
+# fractional_hkl_from_Ainverse_stack), and their fractional miller indices are collected in
+# flat arrays. The per miller index (or per spot) spread, dh and Z-score cutoff of all the
+# centroid spots are then computed at once by sorting on a packed key and reducing over the
+# segments.
+#
+
+# Packing of a miller index into one int64 key, for |h|,|k|,|l| < 2**19
+MILLER_KEY_OFFSET = 2**19
+MILLER_KEY_SPAN = 2**20
+
+def pack_miller_indices(hkl):
+  ''' int64 key per row of an (n,3) integer array of miller indices '''
+  hkl = np.asarray(hkl, dtype=np.int64) + MILLER_KEY_OFFSET
+  return (hkl[:,0]*MILLER_KEY_SPAN + hkl[:,1])*MILLER_KEY_SPAN + hkl[:,2]
+
+def vec3_as_numpy(column):
+  ''' (n,3) numpy array of a flex.vec3_double column '''
+  return column.as_double().as_numpy_array().reshape(-1, 3)
+
+def grouped_sample_spread(keys, values):
+  ''' Group the rows of values, an (n,3) array, by keys. Returns the sorted distinct keys,
+      the number of rows per key and sqrt(var_h + var_k + var_l) per key, where var is the
+      sample variance (n-1 in the denominator) as in flex.double.sample_standard_deviation.
+      The spread of a key with a single row is nan '''
+  if len(keys) == 0:
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+  order = np.argsort(keys, kind='mergesort')
+  keys = keys[order]
+  values = values[order]
+  starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+  counts = np.diff(np.concatenate((starts, [len(keys)])))
+  means = np.add.reduceat(values, starts, axis=0)/counts[:,None]
+  deviations = values - np.repeat(means, counts, axis=0)
+  sum_of_squares = np.add.reduceat(deviations*deviations, starts, axis=0).sum(axis=1)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    spread = np.sqrt(sum_of_squares/(counts-1))
+  spread[counts < 2] = np.nan
+  return keys[starts], counts, spread
+
+class union_dh_statistics(object):
+  ''' Fractional miller indices that the member models of a cluster give to the spots indexed
+      by the cluster centroid. Add the members with add_members, then get the dh statistics
+      and the Z-score cutoff mask of all the centroid spots with dh_mask_by_miller_index or
+      dh_mask_by_spot. dh = |h - h_frac| of the centroid spot, the cutoff is Z_cutoff times
+      the spread of the member fractional miller indices '''
+  def __init__(self, centroid):
+    self.centroid = centroid
+    self.centroid_hkl = vec3_as_numpy(centroid['miller_index'].as_vec3_double()).astype(np.int64)
+    self.dh = np.sqrt(((self.centroid_hkl - vec3_as_numpy(centroid['fractional_miller_index']))**2).sum(axis=1))
+    self.indexed = np.any(self.centroid_hkl != 0, axis=1)
+    # d = 1/|rlp| of the observed centroid
+    rlp_norms = np.sqrt((vec3_as_numpy(centroid['rlp'])**2).sum(axis=1))
+    with np.errstate(divide='ignore'):
+      self.resolution = 1.0/rlp_norms
+    self._rows = []
+    self._hkl = []
+    self._fractional_hkl = []
+
+  def add_members(self, hkl, fractional_hkl):
+    ''' Add M member models at once from (M,N,3) arrays of integer and fractional hkl of the
+        N centroid spots in centroid order, see fractional_hkl_from_Ainverse_stack '''
+    n_members, n_spots = hkl.shape[0], hkl.shape[1]
+    assert n_spots == len(self.centroid_hkl), 'Members must be evaluated on the centroid spots'
+    self._rows.append(np.tile(np.arange(n_spots, dtype=np.int64), n_members))
+    self._hkl.append(np.asarray(hkl, dtype=np.int64).reshape(-1, 3))
+    self._fractional_hkl.append(np.asarray(fractional_hkl, dtype=np.float64).reshape(-1, 3))
+
+  def members(self):
+    ''' Centroid row, miller index and fractional miller index of every member spot '''
+    if len(self._rows) == 0:
+      return np.zeros(0, dtype=np.int64), np.zeros((0,3), dtype=np.int64), np.zeros((0,3))
+    return np.concatenate(self._rows), np.concatenate(self._hkl), np.concatenate(self._fractional_hkl)
+
+  def dh_mask_by_miller_index(self, Z_cutoff, min_count=3):
+    ''' Spread per miller index over all the member spots that got the same miller index as
+        the centroid. A centroid spot is accepted if its miller index has at least min_count
+        member values and dh < dh_cutoff '''
+    rows, hkl, fractional_hkl = self.members()
+    same_hkl = np.all(hkl == self.centroid_hkl[rows], axis=1)
+    keys, counts, spread = grouped_sample_spread(pack_miller_indices(hkl[same_hkl]), fractional_hkl[same_hkl])
+    centroid_keys = pack_miller_indices(self.centroid_hkl)
+    n_values = np.zeros(len(centroid_keys), dtype=np.int64)
+    dh_cutoff = np.full(len(centroid_keys), np.nan)
+    if len(keys) > 0:
+      position = np.minimum(np.searchsorted(keys, centroid_keys), len(keys)-1)
+      found = keys[position] == centroid_keys
+      n_values[found] = counts[position[found]]
+      dh_cutoff[found] = spread[position[found]]*Z_cutoff
+    enough = n_values >= min_count
+    with np.errstate(invalid='ignore'):
+      mask = enough & (self.dh < dh_cutoff) & self.indexed
+    return group_args(mask=mask, dh=self.dh, dh_cutoff=dh_cutoff, n_values=n_values,
+                      evaluated=enough, resolution=self.resolution)
+
+  def dh_mask_by_spot(self, Z_cutoff, min_count=5, max_dh=0.5):
+    ''' Spread per spot over the members that gave the spot the same miller index as the
+        centroid. A centroid spot is accepted if its miller index is the most frequent one
+        among the members (ties included), at least min_count members agree with it,
+        neither dh nor dh_cutoff exceed max_dh and dh < dh_cutoff '''
+    n_spots = len(self.centroid_hkl)
+    rows, hkl, fractional_hkl = self.members()
+    # Number of members giving each (spot, miller index) pair, and the largest one per spot
+    max_count = np.zeros(n_spots, dtype=np.int64)
+    if len(rows) > 0:
+      pairs, pair_counts = np.unique(np.column_stack((rows, pack_miller_indices(hkl))), axis=0, return_counts=True)
+      np.maximum.at(max_count, pairs[:,0], pair_counts)
+    same_hkl = np.all(hkl == self.centroid_hkl[rows], axis=1)
+    n_values = np.bincount(rows[same_hkl], minlength=n_spots)
+    majority = (n_values > 0) & (n_values == max_count)
+    keys, counts, spread = grouped_sample_spread(rows[same_hkl], fractional_hkl[same_hkl])
+    dh_cutoff = np.full(n_spots, np.nan)
+    dh_cutoff[keys] = spread*Z_cutoff
+    enough = majority & (n_values >= min_count)
+    with np.errstate(invalid='ignore'):
+      mask = enough & (self.dh <= max_dh) & (dh_cutoff <= max_dh) & (self.dh < dh_cutoff) & self.indexed
+    return group_args(mask=mask, dh=self.dh, dh_cutoff=dh_cutoff, n_values=n_values,
+                      majority=majority, evaluated=enough, resolution=self.resolution)
@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import math
+import numpy as np
+
+#
+# Spatial index over crystal orientations, used to find near-duplicate crystal models without
+# comparing every pair with difference_rotation_matrix_axis_angle. Every orientation U is
+# stored as a unit quaternion in a 4-d grid of cubic bins. Two rotations that differ by an
+# angle t have quaternions q1, q2 with min(|q1-q2|, |q1+q2|) = 2 sin(t/4), so with bins of
+# that edge length for t = max_angle all orientations within max_angle of a query fall in the
+# 3^4 bins around q or -q. The angle reported by difference_rotation_matrix_axis_angle is the
+# smallest one over the symmetry equivalent settings of the second crystal, so queries are
+# made with all the symmetry equivalent orientations (symmetry_rotations) of the query
+# crystal, and the stored orientations need no reduction. The index only proposes
+# candidates, callers still run the exact comparison on them, so results are the same as
+# with the all pairs loop as long as no true pair is missed. margin widens the search to cover
+# the difference between the quaternion angle and the angle of the exact comparison (e.g.
+# when the exact comparison first reindexes the crystals onto each other).
+#
+
+def quaternion_from_rotation(R):
+  ''' Unit quaternion (w, x, y, z) of the 3x3 rotation matrix R (row major 9-tuple or array) '''
+  R = np.asarray(R, dtype=np.float64).reshape(3, 3)
+  trace = R[0,0] + R[1,1] + R[2,2]
+  if trace > 0:
+    s = 2.0*math.sqrt(1.0 + trace)
+    q = (0.25*s, (R[2,1]-R[1,2])/s, (R[0,2]-R[2,0])/s, (R[1,0]-R[0,1])/s)
+  elif R[0,0] > R[1,1] and R[0,0] > R[2,2]:
+    s = 2.0*math.sqrt(1.0 + R[0,0] - R[1,1] - R[2,2])
+    q = ((R[2,1]-R[1,2])/s, 0.25*s, (R[0,1]+R[1,0])/s, (R[0,2]+R[2,0])/s)
+  elif R[1,1] > R[2,2]:
+    s = 2.0*math.sqrt(1.0 + R[1,1] - R[0,0] - R[2,2])
+    q = ((R[0,2]-R[2,0])/s, (R[0,1]+R[1,0])/s, 0.25*s, (R[1,2]+R[2,1])/s)
+  else:
+    s = 2.0*math.sqrt(1.0 + R[2,2] - R[0,0] - R[1,1])
+    q = ((R[1,0]-R[0,1])/s, (R[0,2]+R[2,0])/s, (R[1,2]+R[2,1])/s, 0.25*s)
+  q = np.array(q)
+  return q/np.sqrt((q*q).sum())
+
+def rotation_angle_between(q1, q2):
+  ''' Angle in degrees of the rotation taking the orientation of quaternion q1 to q2 '''
+  c = min(1.0, abs(float(np.dot(q1, q2))))
+  return 2.0*math.degrees(math.acos(c))
+
+def symmetry_rotations(crystal, lattice_symmetry=False, max_delta=3.0):
+  ''' U matrices of the symmetry equivalent settings of a dxtbx crystal model, its own first.
+      By default the proper rotations of the Laue group of its space group, the settings
+      difference_rotation_matrix_axis_angle compares. With lattice_symmetry the crystal is
+      first put in P1 on its Niggli cell and the rotations of the lattice symmetry within
+      max_delta degrees are used, for models whose basis is not known to be consistent '''
+  from cctbx import sgtbx
+  if lattice_symmetry:
+    from cctbx.sgtbx import lattice_symmetry as lattice_symmetry_module
+    from dxtbx.model import Crystal
+    crystal = Crystal(*crystal.get_real_space_vectors(), space_group_symbol='P 1')
+    crystal = crystal.change_basis(crystal.get_crystal_symmetry().change_of_basis_op_to_niggli_cell())
+    group = lattice_symmetry_module.group(crystal.get_unit_cell(), max_delta=max_delta)
+  else:
+    group = crystal.get_space_group().build_derived_laue_group()
+  rotations = [crystal.get_U()]
+  for op in group.all_ops():
+    if op.r().determinant() < 0 or not op.t().is_zero() or op.r().is_unit_mx():
+      continue
+    rotations.append(crystal.change_basis(sgtbx.change_of_basis_op(op.inverse())).get_U())
+  return rotations
+
+class rotation_index(object):
+  ''' Orientations binned by quaternion. max_angle and margin are in degrees '''
+  def __init__(self, max_angle, margin=0.0):
+    self.max_angle = max_angle + margin
+    # Bin edge = largest quaternion distance of two orientations within max_angle
+    self.bin_size = max(2.0*math.sin(math.radians(min(self.max_angle, 180.0))/4.0), 1.e-6)
+    self.bins = {}
+    self.keys = []
+    self.quaternions = []
+
+  def _bin(self, q):
+    return tuple(np.floor(q/self.bin_size).astype(np.int64))
+
+  def add(self, key, rotation):
+    ''' Store the orientation U (3x3) of the model with key '''
+    q = quaternion_from_rotation(rotation)
+    self.bins.setdefault(self._bin(q), []).append(len(self.keys))
+    self.keys.append(key)
+    self.quaternions.append(q)
+
+  def query(self, rotations):
+    ''' Sorted keys of the stored orientations within max_angle of any of the rotations, e.g.
+        the symmetry_rotations of a crystal '''
+    found = set()
+    for rotation in rotations:
+      q = quaternion_from_rotation(rotation)
+      for signed_q in (q, -q):
+        center = self._bin(signed_q)
+        for offset in _neighbor_offsets:
+          for entry in self.bins.get(tuple(c + o for c, o in zip(center, offset)), []):
+            if entry not in found and rotation_angle_between(q, self.quaternions[entry]) < self.max_angle:
+              found.add(entry)
+    return sorted([self.keys[entry] for entry in found])
+
+  def __len__(self):
+    return len(self.keys)
+
+_neighbor_offsets = [(i, j, k, l) for i in (-1, 0, 1) for j in (-1, 0, 1)
+                     for k in (-1, 0, 1) for l in (-1, 0, 1)]
+
+def close_pairs(crystals, max_angle, margin=1.0, lattice_symmetry=True):
+  ''' Sorted pairs (i_a, i_b), i_a < i_b, of the crystal models whose orientations are
+      within max_angle + margin degrees of each other, the candidates of a near-duplicate
+      pruning '''
+  index = rotation_index(max_angle, margin=margin)
+  pairs = []
+  for i_b, crystal in enumerate(crystals):
+    rotations = symmetry_rotations(crystal, lattice_symmetry=lattice_symmetry)
+    pairs.extend([(i_a, i_b) for i_a in index.query(rotations)])
+    index.add(i_b, rotations[0])
+  return sorted(pairs)
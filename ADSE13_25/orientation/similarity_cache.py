@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+from collections import OrderedDict
+
+#
+# best_similarity_transformation between the crystal models of one event, cached on the
+# indices of the models. The consensus of an event needs the transformation between the same
+# two IOTA trial models several times: for the orientational distance of every pair of a unit
+# cell cluster (again at every batch in sequential consensus mode), in the pruning of close
+# models and when the members of a cluster are realigned onto the cluster centroid, which is
+# itself one of the trial models, in union_and_reindex. Model i is the i-th crystal added, its
+# crystal_orientation is built once when it is added and the transformations are keyed on
+# (i, j, fractional_length_tolerance, unimodular_generator_range), so the key does not depend
+# on later changes of the models (union_and_reindex sets the realigned A matrix on the trial
+# models). Searches that find no transformation are cached as well and raise again on a hit.
+# At most max_size transformations are kept, least recently used first out.
+#
+
+class similarity_transformations(object):
+  ''' Cached best_similarity_transformation between the crystal models added to it '''
+  def __init__(self, crystals=(), is_reciprocal=True, max_size=200000):
+    self.is_reciprocal = is_reciprocal
+    self.max_size = max_size
+    self.orientations = []
+    self.crystals = [] # keeps the models alive, their id() is the lookup key of index()
+    self._index = {}
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    # Set to a list to collect the (key, entry) of the searches done, e.g. in a worker process
+    self.recorded = None
+    self.extend(crystals)
+
+  def __len__(self):
+    return len(self.orientations)
+
+  def add(self, crystal):
+    ''' Add a crystal model, it gets the next index '''
+    from cctbx_orientation_ext import crystal_orientation
+    self._index.setdefault(id(crystal), len(self.orientations))
+    self.crystals.append(crystal)
+    self.orientations.append(crystal_orientation(crystal.get_A(), self.is_reciprocal))
+
+  def extend(self, crystals):
+    for crystal in crystals:
+      self.add(crystal)
+
+  def extend_to(self, experiments_list):
+    ''' Add the first crystal model of the experiments of experiments_list that are not in yet.
+        The models added so far have to be the ones of the beginning of experiments_list '''
+    for i in range(len(self), len(experiments_list)):
+      self.add(experiments_list[i].crystals()[0])
+
+  def index(self, crystal):
+    ''' Index of a crystal model that was added, None for any other model '''
+    return self._index.get(id(crystal))
+
+  def transformation(self, i, j, fractional_length_tolerance, unimodular_generator_range=1):
+    ''' Change of basis that brings model j onto model i, i.e.
+        orientations[j].best_similarity_transformation(other=orientations[i], ...) '''
+    key = (i, j, fractional_length_tolerance, unimodular_generator_range)
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      try:
+        entry = (self.orientations[j].best_similarity_transformation(other=self.orientations[i],
+                   fractional_length_tolerance=fractional_length_tolerance,
+                   unimodular_generator_range=unimodular_generator_range), None)
+      except RuntimeError as e:
+        # The search found no transformation. Anything else, e.g. a watchdog timeout
+        # interrupting the search, is not a property of the models and is not cached
+        entry = (None, str(e))
+      if len(self.entries) >= self.max_size:
+        self.entries.popitem(last=False)
+      if self.recorded is not None:
+        self.recorded.append((key, entry))
+    # Most recently used entries are kept at the end
+    self.entries[key] = entry
+    transform, error = entry
+    if transform is None:
+      raise RuntimeError(error)
+    return transform
+
+  def aligned(self, i, j, fractional_length_tolerance, unimodular_generator_range=1):
+    ''' crystal_orientation of model j brought onto model i '''
+    return self.orientations[j].change_basis(self.transformation(i, j,
+      fractional_length_tolerance, unimodular_generator_range))
+
+  def align(self, reference, crystal, fractional_length_tolerance, unimodular_generator_range=1):
+    ''' crystal_orientation of the crystal model crystal brought onto the crystal model
+        reference. Models that were not added are transformed without the cache '''
+    i = self.index(reference)
+    j = self.index(crystal)
+    if i is not None and j is not None:
+      return self.aligned(i, j, fractional_length_tolerance, unimodular_generator_range)
+    from cctbx_orientation_ext import crystal_orientation
+    ori = crystal_orientation(crystal.get_A(), self.is_reciprocal)
+    other = crystal_orientation(reference.get_A(), self.is_reciprocal)
+    return ori.change_basis(ori.best_similarity_transformation(other=other,
+      fractional_length_tolerance=fractional_length_tolerance,
+      unimodular_generator_range=unimodular_generator_range))
+
+  def update(self, recorded, hits=0):
+    ''' Add the (key, entry) pairs recorded by another process and its hits '''
+    self.hits += hits
+    self.misses += len(recorded)
+    for key, entry in recorded:
+      if key not in self.entries and len(self.entries) >= self.max_size:
+        self.entries.popitem(last=False)
+      self.entries[key] = entry
+
+  def hit_rate(self):
+    if self.hits + self.misses == 0:
+      return 0.0
+    return self.hits/(self.hits + self.misses)
+
+  def show_summary(self, label=''):
+    ''' One line of statistics, label is e.g. the event timestamp '''
+    print('IOTA_SIMILARITY_CACHE %s %d models, %d entries, %d hits, %d misses, hit rate %.3f'%(
+      label, len(self), len(self.entries), self.hits, self.misses, self.hit_rate()))
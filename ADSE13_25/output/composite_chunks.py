@@ -0,0 +1,91 @@
+from __future__ import absolute_import, division, print_function
+import json, os
+from libtbx.phil import parse
+
+#
+# Rolling flush of the composite output of xtc_process style processors.
+# Without it the composite accumulators (all_indexed_experiments, all_indexed_reflections,
+# all_integrated_experiments, all_integrated_reflections and all_int_pickles) grow for the
+# whole job and are only written in finalize. With a limit set, the processor writes the
+# accumulated results as a numbered chunk (idx-<rank>_chunk<N>_*) as soon as the limit is
+# reached, empties the accumulators and carries on. At finalize the last chunk is written
+# together with a manifest (idx-<rank>_composite_manifest.json) listing all the chunks.
+#
+composite_chunks_phil_str = '''
+composite_chunks
+  .help = Rolling flush of the composite output. If any limit is set, the accumulated \
+          results are written as numbered chunks during the run instead of once in finalize
+{
+  max_experiments = None
+    .type = int(value_min=1)
+    .help = Write a chunk once this many indexed or integrated experiments have been accumulated
+  max_reflections = None
+    .type = int(value_min=1)
+    .help = Write a chunk once this many indexed plus integrated reflections have been accumulated
+}
+'''
+composite_chunks_scope = parse(composite_chunks_phil_str)
+
+# Output file parameters written by finalize, keyed by the name used in the manifest
+composite_file_params = [
+  ('indexed', 'indexed_filename'),
+  ('refined_experiments', 'refined_experiments_filename'),
+  ('integrated', 'integrated_filename'),
+  ('integrated_experiments', 'integrated_experiments_filename'),
+]
+
+class composite_chunk_manifest(object):
+  ''' Decides when a chunk is due and keeps the list of chunks written by one rank '''
+  def __init__(self, params, composite_tag, output_dir):
+    self.params = params
+    self.composite_tag = composite_tag
+    self.output_dir = output_dir
+    self.chunks = []
+
+  def enabled(self):
+    return self.params.max_experiments is not None or self.params.max_reflections is not None
+
+  def chunk_tag(self):
+    return "%s_chunk%04d"%(self.composite_tag, len(self.chunks))
+
+  def is_due(self, n_experiments, n_reflections):
+    if self.params.max_experiments is not None and n_experiments >= self.params.max_experiments:
+      return True
+    if self.params.max_reflections is not None and n_reflections >= self.params.max_reflections:
+      return True
+    return False
+
+  def add_chunk(self, output_params, counts, int_pickle_tar=None):
+    ''' Record a written chunk. output_params holds the filenames used for the chunk, counts
+        the number of experiments/reflections/pickles it contains '''
+    files = {}
+    for name, attr in composite_file_params:
+      filename = getattr(output_params, attr)
+      if filename is not None and os.path.exists(filename):
+        files[name] = os.path.basename(filename)
+    if int_pickle_tar is not None and os.path.exists(int_pickle_tar):
+      files['integration_pickles'] = os.path.basename(int_pickle_tar)
+    chunk = dict(chunk=len(self.chunks), tag=self.chunk_tag(), files=files)
+    chunk.update(counts)
+    self.chunks.append(chunk)
+
+  def manifest_filename(self):
+    return os.path.join(self.output_dir, "idx-%s_composite_manifest.json"%self.composite_tag)
+
+  def write(self):
+    filename = self.manifest_filename()
+    f = open(filename, 'w')
+    json.dump(dict(composite_tag=self.composite_tag, chunks=self.chunks), f, indent=2)
+    f.close()
+    print("Composite manifest with %d chunks written to %s"%(len(self.chunks), filename))
+
+def read_composite_manifest(filename):
+  ''' Return the list of chunks of a manifest, with file names made absolute '''
+  f = open(filename)
+  manifest = json.load(f)
+  f.close()
+  dirname = os.path.dirname(os.path.abspath(filename))
+  for chunk in manifest['chunks']:
+    for name in chunk['files']:
+      chunk['files'][name] = os.path.join(dirname, chunk['files'][name])
+  return manifest['chunks']
@@ -0,0 +1,189 @@
+from __future__ import absolute_import, division, print_function
+import json, os, struct, sys
+from six.moves import cPickle as pickle
+from libtbx.phil import parse
+
+#
+# Collective MPI-IO output of the composite results of xtc_process style processors.
+# Instead of every rank writing its own idx-XXXX_* files in finalize, the ranks of a group
+# (the whole job, or e.g. the ranks of one node) serialize their composite experiments,
+# reflection tables and integration pickles and write them into a single shared file with
+# one collective MPI-IO call. Each rank writes at the offset given by an exclusive prefix
+# sum of the block sizes, so no data goes through rank 0. Rank 0 of the group then appends
+# a JSON index with the (offset, length) of every block and a fixed size footer.
+# A rank that could not serialize its results still takes part in the collective calls with
+# no blocks, so one failing rank does not stall or abort the others. Its index entry gets
+# an error field instead, as does the entry of a rank whose part of the write failed.
+#
+#   [rank 0 blocks][rank 1 blocks]...[JSON index][footer: index offset, index length, magic]
+#
+# Experiments are stored as ExperimentList.to_dict JSON, reflection tables and the list of
+# (filename, integration pickle) pairs as pickles. Use shared_file_reader to read the file
+# back, or extract_shared_file to write the usual per rank files for tools that need them,
+#   libtbx.python shared_file.py composite_g0000.shared output_dir
+#
+shared_file_phil_str = '''
+shared_file
+  .help = Write the composite output of all ranks collectively into one shared file per job \
+          (or per group of ranks) with an offset index, instead of one set of files per rank. \
+          Requires composite_output and mp.method=mpi
+{
+  enable = False
+    .type = bool
+    .help = If True, use the shared file backend in finalize
+  ranks_per_file = None
+    .type = int(value_min=1)
+    .help = Number of consecutive ranks that share a file. None means one file for the \
+            whole job. Matching it to the number of ranks per node keeps the collective \
+            writes within a node
+  filename = composite_g%04d.shared
+    .type = str
+    .help = File name template in the output directory, formatted with the group number
+}
+'''
+shared_file_scope = parse(shared_file_phil_str)
+
+SHARED_FILE_EXT = '.shared'
+SHARED_FILE_MAGIC = b'IOTASHF1'
+# index offset, index length, magic
+SHARED_FILE_FOOTER = '<QQ8s'
+
+# Block names and the file name suffix used when a block is extracted to its own file
+shared_file_blocks = [
+  ('refined_experiments', '_refined_experiments.json'),
+  ('indexed', '_indexed.pickle'),
+  ('integrated_experiments', '_integrated_experiments.json'),
+  ('integrated', '_integrated.pickle'),
+  ('integration_pickles', '_integration_pickles.pickle'),
+]
+
+def serialize_composite_output(processor):
+  ''' Return the (name, bytes) blocks for the composite accumulators of a processor.
+      Empty accumulators are left out '''
+  blocks = []
+  for name, experiments in [('refined_experiments', processor.all_indexed_experiments),
+                            ('integrated_experiments', processor.all_integrated_experiments)]:
+    if experiments is not None and len(experiments) > 0:
+      blocks.append((name, json.dumps(experiments.to_dict()).encode('utf-8')))
+  for name, reflections in [('indexed', processor.all_indexed_reflections),
+                            ('integrated', processor.all_integrated_reflections)]:
+    if reflections is not None and len(reflections) > 0:
+      blocks.append((name, pickle.dumps(reflections, protocol=2)))
+  if len(processor.all_int_pickles) > 0:
+    frames = list(zip(processor.all_int_pickle_filenames, processor.all_int_pickles))
+    blocks.append(('integration_pickles', pickle.dumps(frames, protocol=2)))
+  return blocks
+
+def write_shared_file(comm, params, output_dir, composite_tag, blocks, error=None):
+  ''' Collectively write the blocks of every rank of comm. Has to be called by all ranks,
+      a rank with nothing to write passes no blocks and the reason in error.
+      Returns the name of the file this rank wrote to '''
+  from mpi4py import MPI
+  rank = comm.Get_rank()
+  if params.ranks_per_file is None:
+    group = 0
+  else:
+    group = rank // params.ranks_per_file
+  group_comm = comm.Split(group, rank)
+
+  local_size = sum([len(data) for name, data in blocks])
+  offset = group_comm.exscan(local_size)
+  if offset is None: # exscan is undefined on the first rank
+    offset = 0
+  total_size = group_comm.allreduce(local_size)
+
+  entry = dict(rank=rank, composite_tag=composite_tag, blocks={})
+  if error is not None:
+    entry['error'] = error
+  block_offset = offset
+  for name, data in blocks:
+    entry['blocks'][name] = [block_offset, len(data)]
+    block_offset += len(data)
+
+  filename = os.path.join(output_dir, params.filename%group)
+  fh = MPI.File.Open(group_comm, filename, MPI.MODE_WRONLY | MPI.MODE_CREATE)
+  fh.Set_size(0) # drop the contents of a previous run
+  try:
+    fh.Write_at_all(offset, bytearray(b''.join([data for name, data in blocks])))
+  except Exception as e:
+    print("Rank %d, exception caught while writing the shared file"%rank)
+    print(str(e))
+    entry['blocks'] = {}
+    entry['error'] = str(e)
+  entries = group_comm.gather(entry, root=0)
+  if group_comm.Get_rank() == 0:
+    index = json.dumps(dict(version=1, group=group, entries=entries)).encode('utf-8')
+    fh.Write_at(total_size, bytearray(index))
+    fh.Write_at(total_size + len(index),
+      bytearray(struct.pack(SHARED_FILE_FOOTER, total_size, len(index), SHARED_FILE_MAGIC)))
+  fh.Close()
+  group_comm.Free()
+  return filename
+
+class shared_file_reader(object):
+  ''' Random access to the blocks of a shared composite file. entries lists one dictionary
+      per rank with its rank, composite_tag and blocks '''
+  def __init__(self, filename):
+    self.filename = filename
+    footer_size = struct.calcsize(SHARED_FILE_FOOTER)
+    f = open(filename, 'rb')
+    f.seek(-footer_size, os.SEEK_END)
+    index_offset, index_length, magic = struct.unpack(SHARED_FILE_FOOTER, f.read(footer_size))
+    if magic != SHARED_FILE_MAGIC:
+      f.close()
+      raise ValueError("%s is not a shared composite file"%filename)
+    f.seek(index_offset)
+    index = json.loads(f.read(index_length).decode('utf-8'))
+    f.close()
+    self.group = index['group']
+    self.entries = index['entries']
+
+  def read_block(self, entry, name):
+    ''' Raw bytes of block name of entry, None if that rank did not write it '''
+    if name not in entry['blocks']:
+      return None
+    offset, length = entry['blocks'][name]
+    f = open(self.filename, 'rb')
+    f.seek(offset)
+    data = f.read(length)
+    f.close()
+    return data
+
+  def experiments(self, entry, name='refined_experiments'):
+    from dxtbx.model.experiment_list import ExperimentListFactory
+    data = self.read_block(entry, name)
+    if data is None:
+      return None
+    return ExperimentListFactory.from_dict(json.loads(data.decode('utf-8')), check_format=False)
+
+  def reflections(self, entry, name='indexed'):
+    data = self.read_block(entry, name)
+    if data is None:
+      return None
+    return pickle.loads(data)
+
+  def integration_pickles(self, entry):
+    ''' List of (filename, frame dictionary) pairs '''
+    data = self.read_block(entry, 'integration_pickles')
+    if data is None:
+      return []
+    return pickle.loads(data)
+
+def extract_shared_file(filename, output_dir):
+  ''' Write every block of a shared file to the file a rank would have written itself
+      (idx-<composite_tag>_refined_experiments.json etc.) '''
+  reader = shared_file_reader(filename)
+  for entry in reader.entries:
+    if 'error' in entry:
+      print("Rank %d wrote no results: %s"%(entry['rank'], entry['error']))
+    for name, suffix in shared_file_blocks:
+      data = reader.read_block(entry, name)
+      if data is None:
+        continue
+      out = open(os.path.join(output_dir, "idx-%s%s"%(entry['composite_tag'], suffix)), 'wb')
+      out.write(data)
+      out.close()
+  print("Extracted %d ranks from %s"%(len(reader.entries), filename))
+
+if __name__ == '__main__':
+  extract_shared_file(sys.argv[1], sys.argv[2])